@@ -0,0 +1,271 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+
+from logger import logger
+from token_manager import CAPACITY_RETRY_INTERVAL
+
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message, status_code=429, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class ApiKeyState:
+    """单个 API 密钥的配额与运行状态；上限为 0 表示不限制"""
+
+    def __init__(self, key, max_concurrency=0, rpm=0):
+        self.key = key
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.in_flight = 0
+        self.window = deque()
+        self.stats = {"admitted": 0, "rejected": 0}
+
+    def has_capacity(self):
+        return not self.max_concurrency or self.in_flight < self.max_concurrency
+
+
+class Ticket:
+    """一次准入：排队时等待授予，完成后调用 release 归还并发名额
+
+    授予时同时占用首次请求所用的令牌（lease），由请求处理器使用并归还。
+    """
+
+    __slots__ = ("controller", "state", "model", "deadline", "ready_at", "granted", "released", "notify", "lease")
+
+    def __init__(self, controller, state, model, deadline, ready_at, notify=None):
+        self.controller = controller
+        self.state = state
+        self.model = model
+        self.deadline = deadline
+        self.ready_at = ready_at
+        self.granted = False
+        self.released = False
+        self.notify = notify
+        self.lease = None
+
+    def release(self):
+        self.controller.release(self)
+
+
+def parse_api_keys(spec, default_concurrency=0, default_rpm=0):
+    """解析 "密钥[:并发上限[:每分钟请求数]]" 的逗号分隔列表"""
+    keys = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(":")
+        concurrency = int(parts[1]) if len(parts) > 1 and parts[1] else default_concurrency
+        rpm = int(parts[2]) if len(parts) > 2 and parts[2] else default_rpm
+        keys[parts[0]] = ApiKeyState(parts[0], concurrency, rpm)
+    return keys
+
+
+class AdmissionController:
+    """补全请求的准入控制：多 API 密钥配额、有界 FIFO 等待队列与快速 429
+
+    每个密钥有并发上限与每分钟请求数上限（滑动窗口）。超过每分钟请求数立即拒绝；
+    并发已满或模型暂无可用令牌（全部冷却中）的请求进入有界 FIFO 队列，按到达顺序授予，
+    超过截止时间仍未授予则拒绝。授予与占用令牌在同一把锁内完成，令牌达到并发上限时不会多放行。
+    队列已满、没有可恢复的令牌，或最早结束冷却的令牌晚于截止时间时不排队，立即返回 429，
+    Retry-After 取自最早结束冷却的时间（没有可恢复的令牌时取排队时限）。
+    同步（线程）与异步（事件循环）请求共用同一个控制器。
+    """
+
+    def __init__(self, keys, token_manager, queue_size=100, queue_timeout=30.0):
+        self.keys = keys
+        self.token_manager = token_manager
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "dequeued": 0,
+            "timeouts": 0,
+            "rejected_rpm": 0,
+            "rejected_queue_full": 0,
+            "rejected_no_token": 0
+        }
+
+    def authenticate(self, api_key):
+        return self.keys.get(api_key)
+
+    def _reject_locked(self, state, counter, message, retry_after):
+        self.stats[counter] += 1
+        state.stats["rejected"] += 1
+        logger.warning("拒绝请求: %s", message, source="Admission")
+        raise AdmissionRejected(message, 429, max(int(math.ceil(retry_after)), 1))
+
+    def _token_delay(self, model):
+        return self.token_manager.get_available_delay(model)
+
+    def _grant_locked(self, ticket, now):
+        """占用令牌并授予；令牌被取走或都达到并发上限时推迟 ready_at 并返回 False"""
+        lease = self.token_manager.acquire_token_for_model(ticket.model)
+        if lease is None:
+            delay = self._token_delay(ticket.model)
+            ticket.ready_at = now + (delay or CAPACITY_RETRY_INTERVAL) if delay is not None else ticket.deadline
+            return False
+        ticket.lease = lease
+        ticket.granted = True
+        ticket.state.in_flight += 1
+        ticket.state.stats["admitted"] += 1
+        self.stats["admitted"] += 1
+        return True
+
+    def _dispatch_locked(self, now):
+        """按到达顺序授予可以运行的排队请求"""
+        granted = []
+        for ticket in list(self.queue):
+            if ticket.ready_at > now or not ticket.state.has_capacity():
+                continue
+            if not self._grant_locked(ticket, now):
+                continue
+            self.queue.remove(ticket)
+            self.stats["dequeued"] += 1
+            granted.append(ticket)
+        return granted
+
+    def _admit(self, state, model, notify):
+        now = time.time()
+        with self.lock:
+            window = state.window
+            if state.rpm:
+                while window and window[0] <= now - 60:
+                    window.popleft()
+                if len(window) >= state.rpm:
+                    self._reject_locked(state, "rejected_rpm", "超过每分钟请求数限制", window[0] + 60 - now)
+
+            delay = self._token_delay(model)
+            if delay is None:
+                # 令牌池为空或全部失效，只能等新令牌加入，按排队时限建议重试
+                self._reject_locked(state, "rejected_no_token", "没有可用的令牌", self.queue_timeout)
+            if delay > self.queue_timeout:
+                self._reject_locked(state, "rejected_no_token", "所有令牌均在冷却中", delay)
+
+            ticket = Ticket(self, state, model, now + self.queue_timeout, now + delay, notify)
+            if not delay and not self.queue and state.has_capacity() and self._grant_locked(ticket, now):
+                if state.rpm:
+                    window.append(now)
+                return ticket
+            if len(self.queue) >= self.queue_size:
+                self._reject_locked(state, "rejected_queue_full", "等待队列已满", max(delay, 1))
+            if state.rpm:
+                window.append(now)
+            self.queue.append(ticket)
+            self.stats["queued"] += 1
+            for other in self._dispatch_locked(now):
+                if other is not ticket and other.notify is not None:
+                    other.notify()
+            return ticket
+
+    def _check_locked(self, ticket, now):
+        """等待中的请求醒来后检查：已授予返回 True，超时抛出拒绝"""
+        if ticket.granted:
+            return True
+        for other in self._dispatch_locked(now):
+            if other is not ticket and other.notify is not None:
+                other.notify()
+        if ticket.granted:
+            return True
+        if now >= ticket.deadline:
+            self.queue.remove(ticket)
+            delay = self._token_delay(ticket.model)
+            self._reject_locked(ticket.state, "timeouts", "排队等待超时", delay if delay else 1)
+        return False
+
+    @staticmethod
+    def _next_wait(ticket, now):
+        # 等令牌结束冷却时睡到 ready_at，等并发名额时由 release 唤醒
+        target = ticket.ready_at if ticket.ready_at > now else ticket.deadline
+        return max(min(target, ticket.deadline) - now, 0.01)
+
+    def acquire(self, state, model):
+        """同步获取准入，排队时阻塞当前线程"""
+        event = threading.Event()
+        ticket = self._admit(state, model, event.set)
+        while not ticket.granted:
+            with self.lock:
+                wait = self._next_wait(ticket, time.time())
+            event.wait(wait)
+            event.clear()
+            with self.lock:
+                if self._check_locked(ticket, time.time()):
+                    break
+        return ticket
+
+    async def acquire_async(self, state, model):
+        """异步获取准入，排队时只挂起当前协程"""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        ticket = self._admit(state, model, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while not ticket.granted:
+                with self.lock:
+                    wait = self._next_wait(ticket, time.time())
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+                with self.lock:
+                    if self._check_locked(ticket, time.time()):
+                        break
+        except asyncio.CancelledError:
+            self.cancel(ticket)
+            raise
+        return ticket
+
+    def retry_after(self, model):
+        """上游令牌耗尽时建议的重试等待秒数，取最早结束冷却的令牌；没有可恢复的令牌时取排队时限"""
+        delay = self._token_delay(model)
+        if delay is None:
+            delay = self.queue_timeout
+        return max(int(math.ceil(delay)), 1)
+
+    def cancel(self, ticket):
+        """客户端在排队期间断开"""
+        with self.lock:
+            if not ticket.granted and ticket in self.queue:
+                self.queue.remove(ticket)
+                return
+        if ticket.lease is not None:
+            ticket.lease.release()
+        self.release(ticket)
+
+    def release(self, ticket):
+        with self.lock:
+            if not ticket.granted or ticket.released:
+                return
+            ticket.released = True
+            ticket.state.in_flight -= 1
+            granted = self._dispatch_locked(time.time())
+        for other in granted:
+            if other.notify is not None:
+                other.notify()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "queue_length": len(self.queue),
+                "keys": {
+                    f"{key[:6]}...": {
+                        "in_flight": state.in_flight,
+                        "max_concurrency": state.max_concurrency,
+                        "rpm": state.rpm,
+                        **state.stats
+                    }
+                    for key, state in self.keys.items()
+                }
+            }
@@ -2,22 +2,113 @@ import os
 import time
 import json
 import secrets
+import threading
 from functools import wraps
-from flask import Flask, request, Response, jsonify, render_template, redirect, session
+from flask import Flask, request, Response, jsonify, render_template, redirect, session, g
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import config_manager
 from logger import logger
 from token_manager import AuthTokenManager
+from token_storage import SQLiteTokenStorage
+from shared_state import SharedCursor, SharedRotation
 from request_handler import RequestHandler
+from upstream_errors import UpstreamError
+from admission import AdmissionController, AdmissionRejected, ApiKeyState, parse_api_keys
+import message_processor
+import metrics
+from profiler import profiler, ProfilerBusy
+from tracing import RequestTrace, get_phase_stats, is_trace_requested
+from token_prober import TokenProber, ProbeBusy
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(16)
 app.json.sort_keys = False
 
-token_manager = AuthTokenManager()
+def create_token_manager():
+    storage_path = config_manager.get("TOKEN.STORAGE_PATH")
+    if not storage_path:
+        return AuthTokenManager()
+
+    # 多进程模式：令牌列表与冷却状态经 SQLite 变更日志同步，轮询游标放在共享内存文件中
+    shared = config_manager.get("TOKEN.SHARED", False)
+    storage = SQLiteTokenStorage(storage_path, record_events=shared)
+    rotation = SharedRotation(SharedCursor(f"{storage_path}.cursor")) if shared else None
+    return AuthTokenManager(storage, rotation)
+
+
+def create_admission_controller():
+    default_concurrency = config_manager.get("ADMISSION.KEY_CONCURRENCY", 0)
+    default_rpm = config_manager.get("ADMISSION.KEY_RPM", 0)
+    keys = parse_api_keys(config_manager.get("ADMISSION.API_KEYS", ""), default_concurrency, default_rpm)
+    # 兼容单密钥配置：API_KEY 未在列表中单独指定时按默认配额加入
+    api_key = config_manager.get("API.API_KEY")
+    if api_key and api_key not in keys:
+        keys[api_key] = ApiKeyState(api_key, default_concurrency, default_rpm)
+    return AdmissionController(
+        keys,
+        token_manager,
+        queue_size=config_manager.get("ADMISSION.QUEUE_SIZE", 100),
+        queue_timeout=config_manager.get("ADMISSION.QUEUE_TIMEOUT", 30)
+    )
+
+
+token_manager = create_token_manager()
 request_handler = RequestHandler(token_manager)
+# 处理补全请求的处理器；ASGI 入口会追加异步处理器，管理接口合并它们的请求合并统计
+completion_handlers = [request_handler]
+admission_controller = create_admission_controller()
+token_prober = TokenProber(token_manager, request_handler.proxy_pool, request_handler.default_headers)
+
+
+def register_pool_metrics():
+    """令牌、会话池、代理池与准入队列的状态在抓取 /metrics 时现算"""
+    registry = metrics.registry
+    registry.gauge_callback(
+        "grok2api_tokens", "令牌数（按模型与状态 available/cooling/invalid）", ("model", "state"),
+        token_manager.get_state_counts
+    )
+    registry.gauge_callback(
+        "grok2api_token_requests_in_flight", "令牌上进行中的上游请求总数", (),
+        lambda: {(): token_manager.get_in_flight_total()}
+    )
+    registry.gauge_callback(
+        "grok2api_admission_queue_length", "准入等待队列长度", (),
+        lambda: {(): len(admission_controller.queue)}
+    )
+    registry.gauge_callback(
+        "grok2api_proxies", "代理数（按健康状态）", ("state",),
+        lambda: {
+            (state,): sum(1 for proxy in request_handler.proxy_pool.get_stats()["proxies"] if proxy["healthy"] == healthy)
+            for state, healthy in (("healthy", True), ("cooling", False))
+        }
+    )
+    if request_handler.session_pool is not None:
+        def session_counts():
+            stats = request_handler.session_pool.stats()
+            return {("idle",): stats["idle_sessions"], ("in_use",): stats["in_use_sessions"]}
+
+        registry.gauge_callback(
+            "grok2api_upstream_sessions", "上游会话池连接数（按 idle/in_use）", ("state",), session_counts
+        )
+
+
+register_pool_metrics()
+
+
+@app.before_request
+def assign_request_id():
+    """请求 ID 用于日志关联，沿用客户端传入的 X-Request-ID"""
+    g.request_id = logger.set_request_id(request.headers.get('X-Request-ID'))
+
+
+@app.after_request
+def add_request_id_header(response):
+    request_id = g.get('request_id')
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    return response
 
 
 def admin_required(f):
@@ -44,12 +135,20 @@ def admin_required(f):
 
 
 def initialization():
+    token_manager.load_from_storage()
     token_manager.load_from_env()
+    token_manager.start_background_sync()
     
-    if config_manager.get("API.PROXY"):
-        logger.info(f"代理已设置: {config_manager.get('API.PROXY')}", "Server")
+    if len(request_handler.proxy_pool):
+        logger.info("代理已设置: %d 个", len(request_handler.proxy_pool), source="Server")
+
+    if config_manager.get("SESSION_POOL.WARMUP", 0) > 0:
+        threading.Thread(target=request_handler.warmup_sessions, daemon=True).start()
 
-    logger.info("初始化完成", "Server")
+    if config_manager.get("TOKEN_PROBE.INTERVAL", 0) > 0:
+        token_prober.start_periodic(config_manager.get("TOKEN_PROBE.INTERVAL"))
+
+    logger.info("初始化完成", source="Server")
 
 
 @app.route('/manager/login', methods=['GET', 'POST'])
@@ -149,6 +248,116 @@ def delete_manager_token():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/manager/api/session-pool', methods=['GET'])
+@admin_required
+def get_session_pool_stats():
+    """获取上游会话池状态"""
+    if request_handler.session_pool is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **request_handler.session_pool.stats()})
+
+
+@app.route('/manager/api/hedge', methods=['GET'])
+@admin_required
+def get_hedge_stats():
+    """获取对冲请求统计"""
+    if request_handler.hedge_controller is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **request_handler.hedge_controller.get_stats()})
+
+
+@app.route('/manager/api/prompt-cache', methods=['GET'])
+@admin_required
+def get_prompt_cache_stats():
+    """获取提示词扁平化缓存统计"""
+    if message_processor.prompt_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **message_processor.prompt_cache.get_stats()})
+
+
+@app.route('/manager/api/response-cache', methods=['GET'])
+@admin_required
+def get_response_cache_stats():
+    """获取响应缓存统计"""
+    if request_handler.response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **request_handler.response_cache.get_stats()})
+
+
+@app.route('/manager/api/response-cache/clear', methods=['POST'])
+@admin_required
+def clear_response_cache():
+    """清空响应缓存"""
+    if request_handler.response_cache is None:
+        return jsonify({"enabled": False})
+    request_handler.response_cache.clear()
+    return jsonify({"success": True})
+
+
+@app.route('/manager/api/singleflight', methods=['GET'])
+@admin_required
+def get_singleflight_stats():
+    """获取并发请求合并统计"""
+    groups = [handler.singleflight for handler in completion_handlers if handler.singleflight is not None]
+    if not groups:
+        return jsonify({"enabled": False})
+    stats = {}
+    for group in groups:
+        for key, value in group.get_stats().items():
+            stats[key] = stats.get(key, 0) + value
+    return jsonify({"enabled": True, **stats})
+
+
+@app.route('/manager/api/proxies', methods=['GET'])
+@admin_required
+def get_proxy_stats():
+    """获取代理池状态（各代理健康状况、冷却时间与使用统计）"""
+    if not len(request_handler.proxy_pool):
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **request_handler.proxy_pool.get_stats()})
+
+
+@app.route('/manager/api/admission', methods=['GET'])
+@admin_required
+def get_admission_stats():
+    """获取准入控制统计（各密钥并发、配额与等待队列）"""
+    return jsonify(admission_controller.get_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 指标"""
+    if not metrics.registry.enabled:
+        return jsonify({"error": "metrics disabled"}), 404
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/manager/api/trace', methods=['GET'])
+@admin_required
+def get_trace_stats():
+    """获取补全请求各阶段的累计耗时"""
+    return jsonify({"phases": get_phase_stats()})
+
+
+@app.route('/manager/api/profile', methods=['GET', 'POST'])
+@admin_required
+def run_profiler():
+    """对运行中的进程采样 seconds 秒，返回折叠栈格式（可直接生成火焰图）"""
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 0.1), 60)
+        interval = min(max(float(request.args.get('interval_ms', 5)), 1), 1000) / 1000
+    except ValueError:
+        return jsonify({"error": "Invalid seconds or interval_ms"}), 400
+    include_idle = request.args.get('idle', 'false').lower() == 'true'
+    try:
+        stacks, samples = profiler.sample(seconds, interval, include_idle)
+    except ProfilerBusy as e:
+        return jsonify({"error": str(e)}), 409
+    response = Response(profiler.to_folded(stacks), content_type='text/plain; charset=utf-8')
+    response.headers['X-Profile-Samples'] = str(samples)
+    return response
+
+
 @app.route('/manager/api/log-level', methods=['GET'])
 @admin_required
 def get_log_level():
@@ -198,49 +407,39 @@ def set_log_level():
 @app.route('/manager/api/test', methods=['POST'])
 @admin_required
 def test_manager_token():
+    """用额度接口检查单个cookie；cookie在令牌池中时结果写回令牌状态"""
     try:
         cookie = request.json.get('cookie')
         if not cookie:
             return jsonify({"error": "Cookie is required"}), 400
-        
-        # 构造测试请求数据
-        test_data = {
-            "model": "grok-3",
-            "messages": [{"role": "user", "content": "hi"}],
-            "stream": False
-        }
-        
-        # 临时设置token进行测试
-        original_tokens = token_manager.get_all_tokens()
-        token_manager.tokens = [cookie]  # 临时替换为测试cookie
-        token_manager.current_index = 0
-        token_manager.last_round_index = -1
-        
-        try:
-            # 发送测试请求
-            response = request_handler.make_grok_request(test_data, "grok-3", False)
-            
-            # 恢复原始tokens
-            token_manager.tokens = original_tokens
-            token_manager.current_index = 0 
-            token_manager.last_round_index = -1
-            
-            if response and isinstance(response, dict) and 'choices' in response:
-                return jsonify({"success": True, "message": "Cookie测试成功"})
-            else:
-                return jsonify({"success": False, "error": "响应格式异常"})
-                
-        except Exception as test_error:
-            # 恢复原始tokens
-            token_manager.tokens = original_tokens
-            token_manager.current_index = 0
-            token_manager.last_round_index = -1
-            return jsonify({"success": False, "error": str(test_error)})
-            
+
+        health = token_prober.check(cookie)
+        if health["result"] in ("ok", "exhausted"):
+            return jsonify({"success": True, "message": "Cookie测试成功", "health": health})
+        return jsonify({"success": False, "error": health["error"], "health": health})
+
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/manager/api/tokens/probe', methods=['GET'])
+@admin_required
+def get_token_probe_progress():
+    """最近一次令牌健康检查的进度与结果统计"""
+    return jsonify({"progress": token_prober.get_progress()})
+
+
+@app.route('/manager/api/tokens/probe', methods=['POST'])
+@admin_required
+def start_token_probe():
+    """在后台检查全部令牌，立即返回；进度通过 GET 查询"""
+    try:
+        progress = token_prober.start_sweep()
+    except ProbeBusy as e:
+        return jsonify({"error": str(e), "progress": token_prober.get_progress()}), 409
+    return jsonify({"progress": progress}), 202
+
+
 @app.route('/get/tokens', methods=['GET'])
 def get_tokens():
     auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -261,7 +460,7 @@ def add_token():
         token_manager.add_token(token_str)
         return jsonify(token_manager.get_token_status_map().get(sso, {})), 200
     except Exception as error:
-        logger.error(str(error), "Server")
+        logger.error(str(error), source="Server")
         return jsonify({"error": '添加sso令牌失败'}), 500
 
 
@@ -277,7 +476,7 @@ def delete_token():
         token_manager.delete_token(token_str)
         return jsonify({"message": '删除sso令牌成功'}), 200
     except Exception as error:
-        logger.error(str(error), "Server")
+        logger.error(str(error), source="Server")
         return jsonify({"error": '删除sso令牌失败'}), 500
 
 
@@ -300,44 +499,66 @@ def get_models():
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     response_status_code = 500
+    g.request_started = time.perf_counter()
     
     try:
         auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-        if auth_token:
-            if auth_token != config_manager.get("API.API_KEY"):
-                return jsonify({"error": 'Unauthorized'}), 401
-        else:
+        if not auth_token:
             return jsonify({"error": 'API_KEY缺失'}), 401
+        key_state = admission_controller.authenticate(auth_token)
+        if key_state is None:
+            return jsonify({"error": 'Unauthorized'}), 401
 
         data = request.json
         model = data.get("model")
         stream = data.get("stream", False)
+        g.model = model
         
         try:
             request_handler.validate_request(data)
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
+        trace = g.trace = RequestTrace(is_trace_requested(data, request.headers))
+        try:
+            ticket = admission_controller.acquire(key_state, model)
+        except AdmissionRejected as e:
+            return rate_limit_response(str(e), e.status_code, e.retry_after)
+        trace.since("admission", trace.started)
+
         try:
-            response = request_handler.make_grok_request(data, model, stream)
+            response = request_handler.make_grok_request(data, model, stream, request.headers, ticket.lease, trace)
             
             if stream:
+                # 流式响应在客户端读完或断开时归还并发名额
+                response.call_on_close(ticket.release)
                 return response
             else:
+                ticket.release()
                 return jsonify(response)
                 
+        except UpstreamError as e:
+            ticket.release()
+            if e.status_code != 429:
+                raise
+            logger.error(str(e), source="ChatAPI")
+            return rate_limit_response(str(e), 429, admission_controller.retry_after(model))
         except ValueError as e:
+            ticket.release()
             response_status_code = 400
-            logger.error(str(e), "ChatAPI")
+            logger.error(str(e), source="ChatAPI")
             return jsonify({
                 "error": {
                     "message": str(e),
                     "type": "invalid_request_error"
                 }
             }), response_status_code
+        except BaseException:
+            ticket.release()
+            raise
             
     except Exception as error:
-        logger.error(str(error), "ChatAPI")
+        logger.error(str(error), source="ChatAPI")
         return jsonify({
             "error": {
                 "message": str(error),
@@ -346,6 +567,42 @@ def chat_completions():
         }), response_status_code
 
 
+@app.after_request
+def record_request_metrics(response):
+    """补全请求计数、耗时与阶段追踪，流式响应在客户端读完或断开时记录"""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    model, status = g.get('model'), response.status_code
+    trace = g.get('trace')
+    if trace is not None and trace.detailed:
+        response.headers['Server-Timing'] = trace.server_timing()
+
+    def finish():
+        metrics.observe_request(model, status, started)
+        if trace is not None:
+            trace.finish()
+
+    if response.is_streamed:
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+
+def rate_limit_response(message, status_code, retry_after):
+    response = jsonify({
+        "error": {
+            "message": message,
+            "type": "rate_limit_error"
+        }
+    })
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def catch_all(path):
@@ -0,0 +1,192 @@
+import time
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from config import config_manager
+from logger import logger
+from app import app as flask_app, token_manager, initialization, request_handler, admission_controller, completion_handlers
+from async_request_handler import AsyncRequestHandler
+from admission import AdmissionRejected
+from tracing import RequestTrace, is_trace_requested
+import metrics
+from upstream_errors import UpstreamError
+
+# 与 Flask 处理器共用响应缓存与代理池，管理接口的统计、清空与代理健康状态同样作用于异步路径
+async_request_handler = AsyncRequestHandler(
+    token_manager,
+    response_cache=request_handler.response_cache,
+    proxy_pool=request_handler.proxy_pool
+)
+completion_handlers.append(async_request_handler)
+
+
+async def get_models(request: Request):
+    return JSONResponse({
+        "object": "list",
+        "data": [
+            {
+                "id": model,
+                "object": "model",
+                "created": int(time.time()),
+                "owned_by": "grok"
+            }
+            for model in config_manager.get_models().keys()
+        ]
+    })
+
+
+def rate_limit_response(message, status_code, retry_after):
+    headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+    return JSONResponse({
+        "error": {
+            "message": message,
+            "type": "rate_limit_error"
+        }
+    }, status_code=status_code, headers=headers)
+
+
+async def release_on_close(frames, ticket):
+    # 客户端断开时 Starlette 不会执行 background，在生成器结束时归还并发名额
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        ticket.release()
+
+
+def finish_request(model, status, started, trace):
+    metrics.observe_request(model, status, started)
+    if trace is not None:
+        trace.finish()
+
+
+async def observe_on_close(frames, model, status, started, trace):
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        finish_request(model, status, started, trace)
+
+
+async def chat_completions_with_metrics(request: Request):
+    """补全请求计数、耗时与阶段追踪，流式响应计到流结束"""
+    started = time.perf_counter()
+    request_id = logger.set_request_id(request.headers.get('X-Request-ID'))
+    response = await chat_completions(request)
+    response.headers['X-Request-ID'] = request_id
+    model = getattr(request.state, "model", None)
+    trace = getattr(request.state, "trace", None)
+    if trace is not None and trace.detailed:
+        response.headers['Server-Timing'] = trace.server_timing()
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = observe_on_close(response.body_iterator, model, response.status_code, started, trace)
+    else:
+        finish_request(model, response.status_code, started, trace)
+    return response
+
+
+async def chat_completions(request: Request):
+    response_status_code = 500
+
+    try:
+        auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if not auth_token:
+            return JSONResponse({"error": 'API_KEY缺失'}, status_code=401)
+        key_state = admission_controller.authenticate(auth_token)
+        if key_state is None:
+            return JSONResponse({"error": 'Unauthorized'}, status_code=401)
+
+        data = await request.json()
+        model = data.get("model")
+        stream = data.get("stream", False)
+        request.state.model = model
+
+        try:
+            async_request_handler.validate_request(data)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        trace = request.state.trace = RequestTrace(is_trace_requested(data, request.headers))
+        try:
+            ticket = await admission_controller.acquire_async(key_state, model)
+        except AdmissionRejected as e:
+            return rate_limit_response(str(e), e.status_code, e.retry_after)
+        trace.since("admission", trace.started)
+
+        try:
+            response = await async_request_handler.make_grok_request(
+                data, model, stream, request.headers, ticket.lease, trace
+            )
+
+            if stream and response is not None:
+                return StreamingResponse(
+                    release_on_close(response, ticket),
+                    media_type='text/event-stream',
+                    background=BackgroundTask(ticket.release)
+                )
+            else:
+                ticket.release()
+                return JSONResponse(response)
+
+        except UpstreamError as e:
+            ticket.release()
+            if e.status_code != 429:
+                raise
+            logger.error(str(e), source="ChatAPI")
+            return rate_limit_response(str(e), 429, admission_controller.retry_after(model))
+        except ValueError as e:
+            ticket.release()
+            response_status_code = 400
+            logger.error(str(e), source="ChatAPI")
+            return JSONResponse({
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error"
+                }
+            }, status_code=response_status_code)
+        except BaseException:
+            ticket.release()
+            raise
+
+    except Exception as error:
+        logger.error(str(error), source="ChatAPI")
+        return JSONResponse({
+            "error": {
+                "message": str(error),
+                "type": "server_error"
+            }
+        }, status_code=response_status_code)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    initialization()
+    yield
+    await async_request_handler.close()
+
+
+# 补全接口走异步路径，其余路由（管理后台、令牌接口等）交给原 Flask 应用
+app = Starlette(
+    routes=[
+        Route('/v1/models', get_models, methods=['GET']),
+        Route('/v1/chat/completions', chat_completions_with_metrics, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host='0.0.0.0',
+        port=config_manager.get("SERVER.PORT"),
+        log_level="error"
+    )
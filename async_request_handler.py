@@ -0,0 +1,273 @@
+import asyncio
+from curl_cffi.requests import AsyncSession
+import time
+from logger import logger
+from config import config_manager
+import metrics
+import capture
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler, UpstreamAttempts
+from singleflight import AsyncSingleFlight
+from upstream_errors import UpstreamTimeoutError
+
+
+class AsyncRequestHandler(RequestHandler):
+    """基于 curl_cffi AsyncSession 的异步请求处理器，供 ASGI 模式使用"""
+
+    def __init__(self, token_manager: AuthTokenManager, response_cache=None, proxy_pool=None, singleflight=None):
+        super().__init__(token_manager, response_cache, proxy_pool, singleflight)
+        self.session = None
+
+    @staticmethod
+    def create_session_pool():
+        # 上游请求走 AsyncSession，不需要同步会话池（对冲请求随之关闭）
+        return None
+
+    @staticmethod
+    def create_singleflight():
+        return AsyncSingleFlight()
+
+    def get_session(self):
+        # AsyncSession 绑定事件循环，需在循环内惰性创建
+        if self.session is None:
+            self.session = AsyncSession(max_clients=config_manager.get("SERVER.ASYNC_MAX_CLIENTS", 1000))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @staticmethod
+    def abort_response(response):
+        """结束上游流；aclose 会等待传输自然结束，这里直接取消传输任务以释放连接"""
+        capture.finish(response)
+        task = getattr(response, "astream_task", None)
+        if task is not None and not task.done():
+            task.cancel()
+
+    async def iter_upstream_chunks(self, response, model, tick=None):
+        """读取上游字节块：首块受首字节超时约束，之后受空闲超时约束
+
+        指定 tick 时每隔 tick 秒无数据产出一次 None；等待期间不取消读取，避免中断底层迭代器。
+        """
+        _, first_byte_timeout, idle_timeout = config_manager.get_timeouts(model)
+        loop = asyncio.get_running_loop()
+        chunks = response.aiter_content()
+        timeout, phase = first_byte_timeout, "首字节"
+        last_data = loop.time()
+        pending = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(chunks.__anext__())
+                remaining = last_data + timeout - loop.time()
+                wait = max(min(remaining, tick) if tick is not None else remaining, 0)
+                done, _ = await asyncio.wait((pending,), timeout=wait)
+                if not done:
+                    if loop.time() - last_data < timeout:
+                        yield None
+                        continue
+                    raise UpstreamTimeoutError(f"上游{phase}超时（{timeout:.0f}s）")
+                try:
+                    chunk = pending.result()
+                except StopAsyncIteration:
+                    return
+                pending = None
+                last_data = loop.time()
+                timeout, phase = idle_timeout, "空闲"
+                yield chunk
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+
+    async def handle_non_stream_response(self, response, model, trace=None):
+        try:
+            logger.info("开始处理非流式响应（拼接流式内容）", source="Server")
+
+            state = self.new_non_stream_state(trace)
+            async for chunk in self.iter_upstream_chunks(response, model):
+                if self.collect_non_stream_chunk(chunk, model, state):
+                    break
+            else:
+                self.collect_non_stream_chunk(None, model, state, final=True)
+
+            return self.build_non_stream_response(model, state)
+
+        except Exception as error:
+            logger.error("处理非流式响应时出错: %s", error, source="Server")
+            raise
+        finally:
+            self.abort_response(response)
+
+    async def iter_stream_frames(self, response, model, coalesce=None, on_complete=None, on_close=None, sent_at=None, trace=None):
+        state = self.new_stream_state(model, coalesce, on_complete is not None, trace)
+        metrics.streams_in_flight.inc(model)
+        started = time.perf_counter()
+        tick = coalesce[1] if coalesce is not None else None
+        # 上游无数据时按间隔产出 None，到期的合并缓冲随之输出
+        state["ticking"] = tick is not None
+        try:
+            async for chunk in self.iter_upstream_chunks(response, model, tick):
+                for frame in self.convert_stream_chunk(chunk, model, state):
+                    yield frame
+            for frame in self.finish_stream_state(model, state):
+                yield frame
+            if on_complete is not None:
+                # 响应缓存可能把挤出内存的条目写入磁盘
+                await asyncio.to_thread(on_complete, self.stream_final_message(model, state))
+        except Exception:
+            for frame in self.finish_stream_state(model, state):
+                yield frame
+            raise
+        finally:
+            self.abort_response(response)
+            self.record_stream_metrics(model, state, started, sent_at)
+            if trace is not None:
+                trace.since("stream", started)
+            if on_close is not None:
+                on_close()
+
+    async def open_stream(self, response, model, coalesce=None, on_complete=None, on_close=None, sent_at=None, trace=None):
+        """读到首个SSE帧为止，此前的失败直接抛出，由调用方换令牌重试"""
+        started = time.perf_counter()
+        frames = self.iter_stream_frames(response, model, coalesce, on_complete, on_close, sent_at, trace)
+        try:
+            first_frame = await frames.__anext__()
+        except StopAsyncIteration:
+            first_frame = None
+        except BaseException:
+            await frames.aclose()
+            raise
+        if trace is not None:
+            trace.since("first_frame", started)
+        return first_frame, frames
+
+    async def aiter_cached_frames(self, content, model):
+        for frame in self.iter_cached_frames(content, model):
+            yield frame
+
+    async def replay_cached_response(self, content, model, stream):
+        logger.info("命中响应缓存", source="Server")
+        if stream:
+            return self.handle_stream_response(None, self.aiter_cached_frames(content, model))
+        return self.create_completion_response(model, content)
+
+    async def handle_stream_response(self, first_frame, frames, trace=None):
+        logger.info("开始处理流式响应", source="Server")
+
+        try:
+            if first_frame is not None:
+                yield first_frame
+            async for frame in frames:
+                yield frame
+
+            if trace is not None and trace.detailed:
+                yield trace.debug_frame()
+            yield "data: [DONE]\n\n"
+
+        except Exception as e:
+            logger.error("流式响应处理异常: %s", e, source="Server")
+            for frame in self.stream_error_frames(e):
+                yield frame
+        finally:
+            await frames.aclose()
+
+    async def make_grok_request(self, data, model, stream=False, headers=None, lease=None, trace=None):
+        coalesce = self.get_coalesce_options(data, headers) if stream else None
+
+        try:
+            started = time.perf_counter()
+            if self.response_cache is not None and self.response_cache.disk_path:
+                # 内存未命中时要读磁盘上的缓存文件
+                request_payload, cache_key, cached = await asyncio.to_thread(
+                    self.lookup_response_cache, data, model, headers
+                )
+            else:
+                request_payload, cache_key, cached = self.lookup_response_cache(data, model, headers)
+            if trace is not None and request_payload is not None:
+                trace.since("prepare", started)
+            if cached is not None:
+                return await self.replay_cached_response(cached, model, stream)
+
+            def request():
+                # 准入时占用的令牌只交给实际发起上游请求的一方
+                nonlocal lease
+                first_lease, lease = lease, None
+                return self.request_upstream(
+                    data, model, stream, coalesce, request_payload, cache_key, first_lease, trace
+                )
+
+            if self.singleflight is not None:
+                result = await self.singleflight.do(cache_key, stream, request)
+            else:
+                result = await request()
+            if stream:
+                first_frame, frames = result
+                return self.handle_stream_response(first_frame, frames, trace)
+            return self.attach_debug_timing(result, trace)
+
+        except Exception as error:
+            logger.error(str(error), source="ChatAPI")
+            raise
+        finally:
+            # 命中缓存或合并到其他请求时未使用的令牌占用
+            if lease is not None:
+                lease.release()
+                lease = None
+
+    async def request_upstream(self, data, model, stream, coalesce, request_payload=None, cache_key=None, lease=None, trace=None):
+        """重试逻辑与同步路径共用 UpstreamAttempts；失败时的令牌状态写入（SQLite）与响应缓存写入（可能落盘）
+        放到线程池执行，不阻塞事件循环"""
+        attempts = UpstreamAttempts(self, model, lease, trace)
+        while attempts.next():
+            try:
+                request_payload = self.prepare_request_payload(data, model, request_payload, trace)
+                url, request_kwargs = self.build_upstream_request(attempts.token, request_payload, model, attempts.proxy)
+                _, first_byte_timeout, _ = config_manager.get_timeouts(model)
+                sent_at = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(self.get_session().post(url, **request_kwargs), first_byte_timeout)
+                except asyncio.TimeoutError:
+                    # 响应头未到达前无法取消底层传输，由 curl 的读超时兜底结束
+                    raise UpstreamTimeoutError(f"上游超过 {first_byte_timeout:.0f}s 未返回响应")
+
+                ttfb = time.perf_counter() - sent_at
+                if trace is not None:
+                    trace.add("upstream_ttfb", ttfb)
+                    trace.add_connection_timings(response)
+
+                logger.info("请求状态码: %s", response.status_code, source="Server")
+                if response.status_code != 200:
+                    self.abort_response(response)
+                    if await asyncio.to_thread(attempts.fail_status, response.status_code):
+                        continue
+                    break
+
+                attempts.accept(ttfb)
+                response = capture.wrap(response, model, stream, attempts.token)
+                if stream:
+                    # 首帧前失败时帧迭代器已归还占用，下面换令牌重试
+                    result = await self.open_stream(
+                        response, model, coalesce, self.stream_cache_callback(cache_key), attempts.lease.release,
+                        sent_at, trace
+                    )
+                else:
+                    started = time.perf_counter()
+                    result = await self.handle_non_stream_response(response, model, trace)
+                    if trace is not None:
+                        trace.since("response", started)
+                    metrics.upstream_duration.observe(time.perf_counter() - sent_at, model)
+                    await asyncio.to_thread(
+                        self.store_response_cache, cache_key, result["choices"][0]["message"]["content"]
+                    )
+                attempts.succeed(stream)
+                return result
+
+            except Exception as e:
+                if not await asyncio.to_thread(attempts.fail_error, e):
+                    break
+            finally:
+                attempts.end()
+
+        attempts.raise_error()
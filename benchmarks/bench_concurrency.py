@@ -0,0 +1,135 @@
+"""并发流式压测：对比线程模式 (app.py) 与异步模式 (asgi_app.py)
+
+用法: python benchmarks/bench_concurrency.py --concurrency 500 --tokens 100 --interval-ms 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = "sk-bench"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"port {port} not ready")
+
+
+def start(args, env=None):
+    return subprocess.Popen([sys.executable, *args], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def one_stream(port, model, stats):
+    body = json.dumps({"model": model, "stream": True, "messages": [{"role": "user", "content": "hi"}]}).encode()
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(
+            b"POST /v1/chat/completions HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+            b"Content-Type: application/json\r\nAuthorization: Bearer " + API_KEY.encode() +
+            b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+        await writer.drain()
+        ttfb = None
+        data = b""
+        while True:
+            block = await reader.read(65536)
+            if not block:
+                break
+            if ttfb is None and b"data:" in data + block:
+                ttfb = time.perf_counter() - started
+            data += block
+        writer.close()
+        if b"data: [DONE]" in data:
+            stats["ok"] += 1
+            stats["ttfb"].append(ttfb)
+            stats["total"].append(time.perf_counter() - started)
+            stats["frames"] += data.count(b"data:")
+        else:
+            stats["failed"] += 1
+    except Exception:
+        stats["failed"] += 1
+
+
+async def drive(port, concurrency, model):
+    stats = {"ok": 0, "failed": 0, "frames": 0, "ttfb": [], "total": []}
+    started = time.perf_counter()
+    await asyncio.gather(*(one_stream(port, model, stats) for _ in range(concurrency)))
+    stats["wall"] = time.perf_counter() - started
+    return stats
+
+
+def pct(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_mode(mode, upstream_port, args):
+    port = free_port()
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "API_KEY": API_KEY,
+        "BASE_URL": f"http://127.0.0.1:{upstream_port}",
+        "SSO": ",".join(f"bench{i}" for i in range(32)),
+        "LOG_LEVEL": "ERROR",
+        "TOKEN_DB_PATH": "",
+    }
+    server = start(["app.py" if mode == "threaded" else "asgi_app.py"], env)
+    try:
+        wait_port(port)
+        stats = asyncio.run(drive(port, args.concurrency, args.model))
+    finally:
+        server.terminate()
+        server.wait()
+    print(
+        f"{mode:<9} ok={stats['ok']:<5} failed={stats['failed']:<5} wall={stats['wall']:.2f}s "
+        f"ttfb p50={pct(stats['ttfb'], 0.5) * 1000:.0f}ms p99={pct(stats['ttfb'], 0.99) * 1000:.0f}ms "
+        f"total p50={pct(stats['total'], 0.5):.2f}s p99={pct(stats['total'], 0.99):.2f}s "
+        f"frames/s={stats['frames'] / stats['wall']:.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--interval-ms", type=float, default=20.0)
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--modes", default="threaded,async")
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = start(["benchmarks/mock_upstream.py", "--port", str(upstream_port),
+                      "--tokens", str(args.tokens), "--interval-ms", str(args.interval_ms)])
+    try:
+        wait_port(upstream_port)
+        print(f"concurrency={args.concurrency} tokens/stream={args.tokens} interval={args.interval_ms}ms model={args.model}")
+        for mode in args.modes.split(","):
+            run_mode(mode, upstream_port, args)
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""端到端压测：本地模拟上游 + 服务进程，驱动 /v1/chat/completions，报告吞吐、延迟与资源占用
+
+启动 mock_upstream.py（上游参数与其相同：--tokens、--interval-ms、--search、--fail-429 等）和服务进程
+（threaded: app.py，async: asgi_app.py），以 --concurrency 个并发连接循环发送请求 --duration 秒
+（前 --warmup 秒不计入），流式与非流式分别测量。每组报告：
+
+  RPS、首字节时间（流式为首个 SSE 帧，非流式为响应头）与总耗时的 p50/p90/p99、
+  单请求输出速度（token/s，流式不含首字节前的等待）、总 token/s、
+  服务进程 CPU 占用与 RSS（读取 /proc，仅 Linux），以及按结果分类的请求数
+  （ok / http_<状态码> / stream_error / incomplete / truncated / conn_error）。
+
+--target 指向已在运行的服务时不启动任何进程（配合 --pid 采集其 CPU 与 RSS）；--output 把结果写成 JSON，
+便于前后对比。
+
+用法: python benchmarks/bench_load.py --concurrency 64 --duration 20 --tokens 100 --interval-ms 10
+      python benchmarks/bench_load.py --modes async --model grok-4 --search --fail-429 0.05 --drop-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+
+from bench_concurrency import API_KEY, free_port, pct, start, wait_port
+from mock_upstream import add_arguments
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class ProcessSampler:
+    """后台线程定期读取 /proc/<pid>，统计 CPU 时间与 RSS；非 Linux 或 pid 未知时不采集"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.rss = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.cpu_started = None
+        self.wall_started = None
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            # comm 字段可能含空格，从最后一个 ")" 之后按字段切分；utime/stime 为第 14、15 个字段
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def rss_mb(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    def available(self):
+        return self.pid is not None and os.path.exists(f"/proc/{self.pid}/stat")
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.rss.append(self.rss_mb())
+            except OSError:
+                return
+
+    def start(self):
+        if not self.available():
+            return
+        self.cpu_started = self.cpu_seconds()
+        self.wall_started = time.perf_counter()
+        self.rss.append(self.rss_mb())
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """返回 {"cpu_percent", "rss_avg_mb", "rss_peak_mb"}，未采集时返回 None"""
+        if self.thread is None:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        cpu = self.cpu_seconds() - self.cpu_started
+        wall = time.perf_counter() - self.wall_started
+        return {
+            "cpu_percent": round(cpu / wall * 100, 1),
+            "rss_avg_mb": round(sum(self.rss) / len(self.rss), 1),
+            "rss_peak_mb": round(max(self.rss), 1)
+        }
+
+
+def dechunk(body):
+    """解码 HTTP/1.1 分块传输的响应体；不完整时返回已解码的部分"""
+    out = []
+    offset = 0
+    while True:
+        end = body.find(b"\r\n", offset)
+        if end < 0:
+            break
+        try:
+            size = int(body[offset:end].split(b";", 1)[0], 16)
+        except ValueError:
+            break
+        if size == 0:
+            break
+        out.append(body[end + 2:end + 2 + size])
+        offset = end + 2 + size + 2
+    return b"".join(out)
+
+
+def parse_stream(body):
+    """返回 (content, reasoning, has_error, done)"""
+    content, reasoning = [], []
+    has_error = done = False
+    for line in body.split(b"\n"):
+        if not line.startswith(b"data: "):
+            continue
+        data = line[6:].strip()
+        if data == b"[DONE]":
+            done = True
+            continue
+        try:
+            frame = json.loads(data)
+        except ValueError:
+            continue
+        if "error" in frame:
+            has_error = True
+            continue
+        for choice in frame.get("choices", []):
+            delta = choice.get("delta") or {}
+            content.append(delta.get("content") or "")
+            reasoning.append(delta.get("reasoning_content") or "")
+    return "".join(content), "".join(reasoning), has_error, done
+
+
+async def one_request(host, port, body, stream, expected_tokens):
+    """发送一个补全请求，返回 (结果分类, 首字节秒数, 总秒数, 输出 token 数)"""
+    started = time.perf_counter()
+    ttfb = None
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(
+            b"POST /v1/chat/completions HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+            b"Content-Type: application/json\r\nAuthorization: Bearer " + API_KEY.encode() +
+            b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+        await writer.drain()
+        blocks = []
+        seen = b""
+        while True:
+            block = await reader.read(65536)
+            if not block:
+                break
+            if ttfb is None:
+                seen += block
+                if (b"data:" in seen) if stream else (b"\r\n\r\n" in seen):
+                    ttfb = time.perf_counter() - started
+            blocks.append(block)
+        writer.close()
+    except OSError:
+        return "conn_error", None, time.perf_counter() - started, 0
+    total = time.perf_counter() - started
+
+    raw = b"".join(blocks)
+    head, _, payload = raw.partition(b"\r\n\r\n")
+    try:
+        status = int(head.split(b" ", 2)[1])
+    except (IndexError, ValueError):
+        return "conn_error", None, total, 0
+    if status != 200:
+        return f"http_{status}", ttfb, total, 0
+    if b"transfer-encoding: chunked" in head.lower():
+        payload = dechunk(payload)
+
+    if stream:
+        content, reasoning, has_error, done = parse_stream(payload)
+        if has_error:
+            return "stream_error", ttfb, total, 0
+        if not done:
+            return "incomplete", ttfb, total, 0
+    else:
+        try:
+            message = json.loads(payload)["choices"][0]["message"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            return "incomplete", ttfb, total, 0
+        content, reasoning = message.get("content") or "", message.get("reasoning_content") or ""
+    tokens = len(content.split())
+    if expected_tokens and tokens < expected_tokens:
+        # 模拟上游的最终 token 形如 "w0 w1 ..."，少于预期说明输出被截断
+        return "truncated", ttfb, total, tokens + len(reasoning.split())
+    return "ok", ttfb, total, tokens + len(reasoning.split())
+
+
+async def drive(host, port, args, stream, expected_tokens, sampler):
+    records = []
+    outcomes = Counter()
+    sequence = iter(range(1 << 62))
+    loop_started = time.perf_counter()
+    measure_from = loop_started + args.warmup
+    deadline = measure_from + args.duration
+    sampler_started = asyncio.get_running_loop().call_later(args.warmup, sampler.start)
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            # 每个请求的消息不同，避免响应缓存与请求合并
+            body = json.dumps({
+                "model": args.model,
+                "stream": stream,
+                "messages": [{"role": "user", "content": f"{args.prompt} #{next(sequence)}"}]
+            }).encode()
+            request_started = time.perf_counter()
+            outcome, ttfb, total, tokens = await one_request(host, port, body, stream, expected_tokens)
+            if request_started >= measure_from and request_started + total <= deadline:
+                outcomes[outcome] += 1
+                if outcome == "ok":
+                    records.append((ttfb, total, tokens))
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    sampler_started.cancel()
+    return records, outcomes
+
+
+def summarize(records, outcomes, duration, resources, client_cpu, stream):
+    ttfb = [r[0] for r in records if r[0] is not None]
+    total = [r[1] for r in records]
+    # 单请求输出速度：流式按首字节之后的生成时间计，非流式按总耗时计
+    spans = [(r[2], r[1] - (r[0] or 0) if stream else r[1]) for r in records]
+    rates = [tokens / span for tokens, span in spans if span > 0]
+    tokens = sum(r[2] for r in records)
+    ms = lambda values, p: round(pct(values, p) * 1000, 1)  # noqa: E731
+    return {
+        "requests": sum(outcomes.values()),
+        "ok": len(records),
+        "rps": round(len(records) / duration, 2),
+        "ttfb_ms": {"p50": ms(ttfb, 0.5), "p90": ms(ttfb, 0.9), "p99": ms(ttfb, 0.99)},
+        "latency_ms": {"p50": ms(total, 0.5), "p90": ms(total, 0.9), "p99": ms(total, 0.99)},
+        "tokens_per_second": {
+            "p50": round(pct(rates, 0.5), 1), "p10": round(pct(rates, 0.1), 1), "p1": round(pct(rates, 0.01), 1),
+            "aggregate": round(tokens / duration, 1)
+        },
+        "server": resources,
+        "client_cpu_percent": round(client_cpu / duration * 100, 1),
+        "outcomes": dict(outcomes)
+    }
+
+
+def print_summary(label, result):
+    print(
+        f"{label:<22} rps={result['rps']:<8} ok={result['ok']}/{result['requests']} "
+        f"ttfb p50/p90/p99={result['ttfb_ms']['p50']}/{result['ttfb_ms']['p90']}/{result['ttfb_ms']['p99']}ms "
+        f"latency p50/p90/p99={result['latency_ms']['p50']}/{result['latency_ms']['p90']}/{result['latency_ms']['p99']}ms"
+    )
+    rates = result["tokens_per_second"]
+    line = f"{'':<22} tok/s 单请求 p50/p10/p1={rates['p50']}/{rates['p10']}/{rates['p1']} 总计={rates['aggregate']}"
+    if result["server"]:
+        server = result["server"]
+        line += f" 服务CPU={server['cpu_percent']}% RSS 平均/峰值={server['rss_avg_mb']}/{server['rss_peak_mb']}MB"
+    line += f" 压测端CPU={result['client_cpu_percent']}%"
+    print(line)
+    print(f"{'':<22} 结果: {json.dumps(result['outcomes'], ensure_ascii=False)}")
+
+
+def run_load(host, port, pid, args, stream, expected_tokens):
+    sampler = ProcessSampler(pid)
+    client_started = resource.getrusage(resource.RUSAGE_SELF)
+    records, outcomes = asyncio.run(drive(host, port, args, stream, expected_tokens, sampler))
+    client = resource.getrusage(resource.RUSAGE_SELF)
+    client_cpu = client.ru_utime + client.ru_stime - client_started.ru_utime - client_started.ru_stime
+    return summarize(records, outcomes, args.duration, sampler.stop(), client_cpu, stream)
+
+
+def mock_argv(args, mock_parser):
+    """把与默认值不同的上游参数原样转发给 mock_upstream.py"""
+    argv = []
+    for action in mock_parser._actions:
+        value = getattr(args, action.dest, None)
+        if value is None or value == action.default or not action.option_strings:
+            continue
+        argv.append(action.option_strings[0])
+        if not isinstance(action, argparse._StoreTrueAction):
+            argv.append(str(value))
+    return argv
+
+
+def main():
+    mock_parser = argparse.ArgumentParser(add_help=False)
+    add_arguments(mock_parser)
+    parser = argparse.ArgumentParser(parents=[mock_parser])
+    parser.add_argument("--modes", default="threaded,async", help="服务模式：threaded（app.py）、async（asgi_app.py）")
+    parser.add_argument("--stream-modes", default="stream,non-stream")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--prompt", default="hi", help="可带 mock 的单请求参数，如 \"tokens=200 search=1\"")
+    parser.add_argument("--sso-count", type=int, default=32)
+    parser.add_argument("--target", help="已在运行的服务地址，如 http://127.0.0.1:5200（不启动模拟上游与服务进程）")
+    parser.add_argument("--pid", type=int, help="--target 服务的进程号，用于采集 CPU 与 RSS")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+    stream_modes = [mode == "stream" for mode in args.stream_modes.split(",")]
+    results = {}
+
+    if args.target:
+        host, _, port = args.target.split("://", 1)[-1].rstrip("/").partition(":")
+        for stream in stream_modes:
+            label = "stream" if stream else "non-stream"
+            results[label] = run_load(host, int(port or 80), args.pid, args, stream, None)
+            print_summary(label, results[label])
+    else:
+        # 没有 --search 时 <grok:render> 不会出现，最终内容恰好是 tokens 个词；消息中覆盖 tokens= 时不检查截断
+        expected_tokens = None if "tokens=" in args.prompt else args.tokens
+        upstream_port = free_port()
+        upstream = start(["benchmarks/mock_upstream.py", "--port", str(upstream_port), *mock_argv(args, mock_parser)])
+        try:
+            wait_port(upstream_port)
+            print(
+                f"concurrency={args.concurrency} duration={args.duration}s model={args.model} "
+                f"upstream: {' '.join(mock_argv(args, mock_parser)) or '(默认)'}"
+            )
+            for mode in args.modes.split(","):
+                port = free_port()
+                env = {
+                    **os.environ,
+                    "PORT": str(port),
+                    "API_KEY": API_KEY,
+                    "BASE_URL": f"http://127.0.0.1:{upstream_port}",
+                    "SSO": ",".join(f"load{i}" for i in range(args.sso_count)),
+                    "LOG_LEVEL": "ERROR",
+                    "TOKEN_DB_PATH": "",
+                }
+                server = start(["app.py" if mode == "threaded" else "asgi_app.py"], env)
+                try:
+                    wait_port(port)
+                    for stream in stream_modes:
+                        label = f"{mode}/{'stream' if stream else 'non-stream'}"
+                        results[label] = run_load("127.0.0.1", port, server.pid, args, stream, expected_tokens)
+                        print_summary(label, results[label])
+                finally:
+                    server.terminate()
+                    server.wait()
+        finally:
+            upstream.terminate()
+            upstream.wait()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
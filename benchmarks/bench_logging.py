@@ -0,0 +1,163 @@
+"""单个请求的日志开销：原实现（先取调用方栈帧、bind、同步写入）与当前 Logger 对比
+
+模拟 request_upstream 一次成功的流式请求所记录的日志，分别测默认 ERROR 级别（全部被过滤）
+和 INFO 级别（写入 /dev/null）下每个请求的耗时；多线程场景模拟并发请求争用同一个输出。
+后台写入的场景另计排空队列的总耗时；"慢输出"场景给每次写入加固定延迟，模拟 stderr 接到管道
+或容器日志驱动时写入阻塞的情况。
+
+用法: python benchmarks/bench_logging.py --requests 20000 --threads 8 --write-latency-us 100
+"""
+import argparse
+import inspect
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger as loguru_logger  # noqa: E402
+from logger import LEVELS, BackgroundSink, logger  # noqa: E402
+
+OLD_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
+    "<level>{message}</level>"
+)
+
+TOKEN = "sso-rw=" + "x" * 120 + ";sso=" + "x" * 120
+
+
+class SlowStream:
+    """每次写入阻塞固定时间的输出"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def write(self, data):
+        time.sleep(self.latency)
+
+    def flush(self):
+        pass
+
+
+def old_caller_info():
+    frame = inspect.currentframe()
+    try:
+        caller_frame = frame.f_back.f_back
+        return {
+            'filename': os.path.basename(caller_frame.f_code.co_filename),
+            'function': caller_frame.f_code.co_name,
+            'lineno': caller_frame.f_lineno
+        }
+    finally:
+        del frame
+
+
+def old_info(message, source="API"):
+    caller_info = old_caller_info()
+    loguru_logger.bind(**caller_info).info(f"[{source}] {message}")
+
+
+def old_request():
+    # 与改动前 request_upstream 一次成功的流式请求相同的日志调用
+    old_info(f"当前令牌: {TOKEN[:50]}...", "Server")
+    old_info(f"请求状态码: {200}", "Server")
+    old_info("请求成功", "Server")
+    old_info("开始处理流式响应", "Server")
+
+
+def new_request():
+    logger.info("当前令牌: %.50s...", TOKEN, source="Server")
+    logger.info("请求状态码: %s", 200, source="Server")
+    logger.info("请求成功", source="Server")
+    logger.info("开始处理流式响应", source="Server")
+
+
+def configure_old(level, stream):
+    loguru_logger.remove()
+    loguru_logger.add(stream, level=level, format=OLD_FORMAT, colorize=True)
+    logger.level_no = 0
+
+
+def configure_new(level, sink, serialize=False):
+    loguru_logger.remove()
+    logger.sink = sink
+    logger.serialize = serialize
+    logger.handler_id = logger._add_handler(level)
+    logger.level_no = LEVELS[level]
+
+
+def run(fn, requests, threads):
+    per_thread = requests // threads
+
+    def worker():
+        for _ in range(per_thread):
+            fn()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - started, per_thread * threads
+
+
+def drain(sink):
+    while not sink.queue.empty():
+        time.sleep(0.001)
+
+
+def report(label, elapsed, count, drained=None):
+    line = f"{label:<36} {elapsed * 1e6 / count:8.2f} us/请求"
+    if drained is not None:
+        line += f"   含后台写完 {drained * 1e6 / count:8.2f} us/请求"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--write-latency-us", type=float, default=100)
+    args = parser.parse_args()
+    devnull = open(os.devnull, "w")
+    slow = SlowStream(args.write_latency_us / 1e6)
+
+    for threads in (1, args.threads):
+        print(f"-- {threads} 线程")
+        configure_old("ERROR", devnull)
+        report("原实现 ERROR（全部过滤）", *run(old_request, args.requests, threads))
+        configure_new("ERROR", devnull)
+        report("当前 ERROR（全部过滤）", *run(new_request, args.requests, threads))
+
+        configure_old("INFO", devnull)
+        report("原实现 INFO 同步写入", *run(old_request, args.requests, threads))
+        configure_new("INFO", devnull)
+        report("当前 INFO 同步写入", *run(new_request, args.requests, threads))
+
+        for serialize in (False, True):
+            sink = BackgroundSink(devnull, serialize)
+            configure_new("INFO", sink, serialize)
+            started = time.perf_counter()
+            elapsed, count = run(new_request, args.requests, threads)
+            drain(sink)
+            report(f"当前 INFO 后台写入{' JSON' if serialize else ''}", elapsed, count, time.perf_counter() - started)
+            sink.close()
+
+        configure_old("INFO", slow)
+        report("原实现 INFO 同步写入（慢输出）", *run(old_request, args.requests, threads))
+        sink = BackgroundSink(slow)
+        configure_new("INFO", sink)
+        started = time.perf_counter()
+        elapsed, count = run(new_request, args.requests, threads)
+        drain(sink)
+        report("当前 INFO 后台写入（慢输出）", elapsed, count, time.perf_counter() - started)
+        sink.close()
+    loguru_logger.remove()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""多进程令牌分布检查：N 个 uvicorn 工作进程对接本地模拟上游，统计每个令牌被使用的次数
+
+启动后先经不同进程并发添加 --added 个令牌，再按轮发送突发请求（每轮请求数等于令牌数）。共享模式下
+所有进程共用轮询游标，要求：
+  - 每个令牌的使用次数之差（max - min）不超过工作进程数，单轮突发中同一令牌最多被使用 2 次
+  - 并发添加的令牌对所有进程可见
+  - 某个进程因上游 429 冷却的令牌，在所有进程的令牌列表中都显示为冷却，且之后不再被任何进程选中
+不满足时以非零状态退出。非共享模式各进程从同一位置开始轮询，突发请求会集中在少数令牌上，只作对比输出。
+
+用法: python benchmarks/bench_multiprocess.py --workers 4 --tokens 32 --rounds 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_concurrency import free_port, start, wait_port
+
+API_KEY = "sk-bench"
+
+
+def call(url, body=None, method="GET"):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode() if body is not None else None,
+        method=method,
+        headers={"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def post_ignoring_errors(url, body):
+    try:
+        return call(url, body, "POST")
+    except urllib.error.HTTPError:
+        return None
+
+
+def sso_of(cookie):
+    return cookie.rsplit("sso=", 1)[-1]
+
+
+def run(shared, args, upstream_port):
+    """返回未通过的检查项（非共享模式不做检查）"""
+    port = free_port()
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "API_KEY": API_KEY,
+            "BASE_URL": f"http://127.0.0.1:{upstream_port}",
+            "SSO": ",".join(f"mp{i:03d}" for i in range(args.tokens)),
+            "TOKEN_DB_PATH": os.path.join(tmp, "tokens.db"),
+            "TOKEN_SHARED": "true" if shared else "false",
+            "LOG_LEVEL": "ERROR",
+        }
+        server = start(["-m", "uvicorn", "asgi_app:app", "--port", str(port),
+                        "--workers", str(args.workers), "--log-level", "error"], env)
+        try:
+            wait_port(port)
+            time.sleep(2)
+            base = f"http://127.0.0.1:{port}"
+            upstream = f"http://127.0.0.1:{upstream_port}"
+            total = args.tokens + args.added
+
+            # 并发添加的令牌落在不同进程上，各进程应用增删的先后不同
+            added = [f"mp-added-{i:03d}" for i in range(args.added)]
+            with ThreadPoolExecutor(max(args.added, 1)) as pool:
+                list(pool.map(lambda sso: call(f"{base}/add/token", {"sso": sso}, "POST"), added))
+            time.sleep(0.5)
+            checks = args.workers * 4
+            seen = sum(all(sso in tokens for sso in added) for tokens in (call(f"{base}/get/tokens") for _ in range(checks)))
+            call(f"{upstream}/mock/reset", {}, "POST")
+
+            body = {"model": "grok-3", "stream": False, "messages": [{"role": "user", "content": "hi"}]}
+            burst_max = []
+            with ThreadPoolExecutor(total) as pool:
+                for _ in range(args.rounds):
+                    before = call(f"{upstream}/mock/stats")
+                    list(pool.map(lambda _: call(f"{base}/v1/chat/completions", body, "POST"), range(total)))
+                    after = call(f"{upstream}/mock/stats")
+                    # 每轮突发请求数等于令牌数，理想情况下每个令牌恰好一次
+                    burst_max.append(max(after.get(k, 0) - before.get(k, 0) for k in after))
+
+            counts = list(call(f"{upstream}/mock/stats").values())
+            counts += [0] * (total - len(counts))
+
+            # 上游对该请求返回 429：处理它的进程冷却所用令牌（含重试），其他进程应同步看到
+            post_ignoring_errors(f"{base}/v1/chat/completions", {**body, "messages": [{"role": "user", "content": "fail=429"}]})
+            cooled = [sso_of(cookie) for cookie in call(f"{upstream}/mock/rejected")]
+            time.sleep(0.5)
+            cooled_seen = sum(
+                all(tokens[sso]["models"]["grok-3"]["status"] == "cooling" for sso in cooled)
+                for tokens in (call(f"{base}/get/tokens") for _ in range(checks))
+            )
+            before = call(f"{upstream}/mock/stats")
+            with ThreadPoolExecutor(total) as pool:
+                list(pool.map(lambda _: call(f"{base}/v1/chat/completions", body, "POST"), range(total)))
+            after = call(f"{upstream}/mock/stats")
+            cooled_used = sum(after.get(cookie, 0) - before.get(cookie, 0) for cookie in after if sso_of(cookie) in cooled)
+        finally:
+            server.terminate()
+            server.wait()
+
+    spread = max(counts) - min(counts)
+    print(
+        f"{'shared' if shared else 'independent':<12} requests={sum(counts)} tokens_used={sum(1 for c in counts if c)}/{total} "
+        f"min={min(counts)} max={max(counts)} stdev={statistics.pstdev(counts):.2f} "
+        f"burst_max_per_token={max(burst_max)} added_tokens_visible={seen}/{checks} "
+        f"cooled={len(cooled)} cooldown_visible={cooled_seen}/{checks} cooled_tokens_used_after={cooled_used}"
+    )
+    if not shared:
+        return failures
+    if spread > args.workers:
+        failures.append(f"令牌使用次数之差 {spread} 超过工作进程数 {args.workers}")
+    if max(burst_max) > 2:
+        failures.append(f"单轮突发中同一令牌被使用 {max(burst_max)} 次")
+    if seen != checks:
+        failures.append(f"并发添加的令牌只在 {seen}/{checks} 次查询中全部可见")
+    if not cooled:
+        failures.append("上游 429 未使任何令牌进入冷却")
+    if cooled_seen != checks:
+        failures.append(f"冷却只在 {cooled_seen}/{checks} 次查询中可见")
+    if cooled_used:
+        failures.append(f"冷却中的令牌仍被选中 {cooled_used} 次")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--added", type=int, default=16, help="启动后经不同进程并发添加的令牌数")
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = start(["benchmarks/mock_upstream.py", "--port", str(upstream_port), "--tokens", "5", "--interval-ms", "5"])
+    try:
+        wait_port(upstream_port)
+        print(f"workers={args.workers} tokens={args.tokens} rounds={args.rounds}")
+        run(False, args, upstream_port)
+        failures = run(True, args, upstream_port)
+    finally:
+        upstream.terminate()
+        upstream.wait()
+    for failure in failures:
+        print(f"  失败: {failure}")
+    if not failures:
+        print("  核对通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
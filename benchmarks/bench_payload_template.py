@@ -0,0 +1,79 @@
+"""上游请求体构造基准：每次构造完整字典并 json.dumps，与预编译 PayloadTemplate 拼接对比
+
+先校验各模型、各种对话文本（中文、引号、控制字符、emoji）下两种方式的输出逐字节一致，
+以及修改模型映射/临时会话配置后模板会重新编译。
+
+用法: python benchmarks/bench_payload_template.py --requests 50000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config_manager  # noqa: E402
+from message_processor import MessageProcessor  # noqa: E402
+
+SAMPLES = [
+    "USER: hello",
+    "USER: 你好，\"世界\"\nASSISTANT: 好的\t\x01\x1f 😀 \\ / </script>",
+    "USER: " + "长对话内容 long conversation. " * 2000,
+]
+
+
+def legacy(model, conversation):
+    return json.dumps(MessageProcessor.build_payload(model, conversation))
+
+
+def check():
+    for model in config_manager.get_models():
+        for conversation in SAMPLES:
+            assert MessageProcessor.get_payload_template(model).render(conversation) == legacy(model, conversation), model
+
+    template = MessageProcessor.get_payload_template("grok-4-fast")
+    models = config_manager.get_models()
+    original = models["grok-4-fast"]
+    temporary = config_manager.get("API.IS_TEMP_CONVERSATION")
+    try:
+        models["grok-4-fast"] = "grok-4-fast-renamed"
+        config_manager.set("API.IS_TEMP_CONVERSATION", not temporary)
+        rebuilt = MessageProcessor.get_payload_template("grok-4-fast")
+        assert rebuilt is not template
+        assert rebuilt.render(SAMPLES[1]) == legacy("grok-4-fast", SAMPLES[1])
+        assert MessageProcessor.get_payload_template("grok-4-fast") is rebuilt
+    finally:
+        models["grok-4-fast"] = original
+        config_manager.set("API.IS_TEMP_CONVERSATION", temporary)
+
+
+def timed(label, n, fn):
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms  {n / elapsed:12.0f} req/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    check()
+    n = args.requests
+    for label, conversation in (("short", SAMPLES[1]), ("long", SAMPLES[2])):
+        for model in ("grok-3", "grok-4"):
+            count = n if label == "short" else n // 10
+            print(f"-- {model} {label} conversation ({len(conversation)} chars)")
+            baseline = timed("dict + json.dumps", count, lambda: [legacy(model, conversation) for _ in range(count)])
+            template = timed("PayloadTemplate", count, lambda: [
+                MessageProcessor.get_payload_template(model).render(conversation) for _ in range(count)
+            ])
+            print(f"speedup: {baseline / template:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
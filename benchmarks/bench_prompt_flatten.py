@@ -0,0 +1,74 @@
+"""多轮对话提示词扁平化基准：每轮重新规范化全部历史，与 PromptCache 增量扁平化对比
+
+模拟客户端逐轮重发不断增长的历史（含 <think> 标签、内联 base64 图片与多段内容），
+统计整段对话所有轮次的扁平化总耗时与最后一轮的耗时，并校验两种方式的输出完全一致。
+
+用法: python benchmarks/bench_prompt_flatten.py --turns 200
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import MessageProcessor  # noqa: E402
+from prompt_cache import PromptCache  # noqa: E402
+
+IMAGE = "![image](data:image/png;base64," + "iVBORw0KGgo" * 2000 + ")"
+
+
+def make_conversation(turns, seed=1):
+    rng = random.Random(seed)
+    paragraph = "这是一段较长的对话内容，包含 English words 与标点。" * 20
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        if i % 10 == 3:
+            content = [{"type": "text", "text": f"第 {i} 轮：请看这张图 {IMAGE}"}, {"type": "image_url", "image_url": {"url": "x"}}]
+        else:
+            content = f"第 {i} 轮问题：{paragraph[:rng.randint(100, len(paragraph))]}"
+        messages.append({"role": "user", "content": content})
+        messages.append({"role": "assistant", "content": f"<think>{paragraph}</think>第 {i} 轮回答：{paragraph}"})
+    return messages
+
+
+def run(messages, turns, cache):
+    """返回 (所有轮次总耗时, 最后一轮耗时, 最后一轮输出)"""
+    total = last = 0.0
+    conversation = None
+    for i in range(turns):
+        prefix = messages[:2 + 2 * i]
+        started = time.perf_counter()
+        conversation = MessageProcessor.flatten_messages(prefix, cache)
+        last = time.perf_counter() - started
+        total += last
+    return total, last, conversation
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    messages = make_conversation(args.turns)
+    cache = PromptCache()
+    for i in range(args.turns):
+        prefix = messages[:2 + 2 * i]
+        assert MessageProcessor.flatten_messages(prefix) == MessageProcessor.flatten_messages(prefix, cache)
+
+    baseline = run(messages, args.turns, None)
+    cached = run(messages, args.turns, PromptCache())
+    assert baseline[2] == cached[2]
+
+    print(f"turns={args.turns} messages={len(messages)} prompt={len(baseline[2]) / 1024:.0f} KB")
+    print(f"{'':<20} {'all turns':>12} {'last turn':>12}")
+    print(f"{'full re-normalize':<20} {baseline[0] * 1000:9.1f} ms {baseline[1] * 1000:9.2f} ms")
+    print(f"{'PromptCache':<20} {cached[0] * 1000:9.1f} ms {cached[1] * 1000:9.2f} ms")
+    print(f"speedup: {baseline[0] / cached[0]:.1f}x (all turns), {baseline[1] / cached[1]:.1f}x (last turn)")
+    print(f"stats: {cache.get_stats()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
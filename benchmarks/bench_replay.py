@@ -0,0 +1,195 @@
+"""回放录制的上游响应：逐阶段测量解析器吞吐、内存分配与峰值内存，并与 golden 逐字节比对
+
+录制文件由 UPSTREAM_CAPTURE_DIR 录制模式生成（也可以是没有元数据行的 NDJSON，按行切块），默认回放
+benchmarks/traces/ 下的语料。每个文件按录制时的数据块边界依次经过：
+
+  stream   new_stream_state + convert_stream_chunk：NDJSON 解码、工具输出过滤、SSE 编码
+  full     collect_non_stream_chunk + build_non_stream_response：非流式拼接
+  tool     MessageProcessor.process_tool_response：逐条规范化上游响应片段
+  history  MessageProcessor.process_content：回复作为历史消息再次提交时的 remove_think_tags
+
+输出中的补全 id 与时间戳固定，结果与 <名称>.golden 逐字节比对，不一致时以非零状态退出；
+--update-golden 重新生成 golden。--rechunk N 按随机大小（平均 N 字节）重新切块，结果也必须与 golden 一致。
+吞吐取 --repeat 次中最快的一次；内存用 tracemalloc 单独测一次：峰值内存为运行期间同时存活的分配总量，
+残留分配块为运行结束、输出释放后仍存活的块数（解释器内部缓存只占个位数，随输入增大而增长说明解析状态泄漏）。
+
+用法: python benchmarks/bench_replay.py
+      python benchmarks/bench_replay.py /tmp/capture --model grok-4 --repeat 20 --rechunk 512
+      python benchmarks/bench_replay.py --update-golden
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+import capture  # noqa: E402
+from message_processor import MessageProcessor  # noqa: E402
+from request_handler import RequestHandler  # noqa: E402
+from sse_encoder import ChunkEncoder  # noqa: E402
+from token_manager import AuthTokenManager  # noqa: E402
+from upstream_events import loads  # noqa: E402
+
+TRACES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")
+STAGES = ("stream", "full", "tool", "history")
+
+
+def replay_stream(handler, chunks, model):
+    state = handler.new_stream_state(model)
+    state["encoder"] = ChunkEncoder(model, "chatcmpl-replay", 0)
+    frames = []
+    for chunk in chunks:
+        frames.extend(handler.convert_stream_chunk(chunk, model, state))
+    frames.extend(handler.finish_stream_state(model, state))
+    return "".join(frames)
+
+
+def replay_full(handler, chunks, model):
+    state = handler.new_non_stream_state()
+    for chunk in chunks:
+        if handler.collect_non_stream_chunk(chunk, model, state):
+            break
+    else:
+        handler.collect_non_stream_chunk(None, model, state, final=True)
+    result = handler.build_non_stream_response(model, state)
+    result["id"], result["created"] = "chatcmpl-replay", 0
+    return json.dumps(result, ensure_ascii=False)
+
+
+def replay_tool(handler, chunks, model):
+    out = []
+    for line in b"".join(chunks).split(b"\n"):
+        try:
+            response = loads(line)["result"]["response"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        out.append(MessageProcessor.process_tool_response(response))
+    return "".join(out)
+
+
+def replay_history(handler, chunks, model):
+    content = json.loads(replay_full(handler, chunks, model))["choices"][0]["message"]["content"]
+    messages = [{"type": "text", "text": content}, {"type": "text", "text": "继续"}]
+    return MessageProcessor.process_content(messages)
+
+
+REPLAYERS = {"stream": replay_stream, "full": replay_full, "tool": replay_tool, "history": replay_history}
+
+
+def rechunk(chunks, average, seed=1):
+    rng = random.Random(seed)
+    data = b"".join(chunks)
+    out, offset = [], 0
+    while offset < len(data):
+        size = rng.randint(1, average * 2)
+        out.append(data[offset:offset + size])
+        offset += size
+    return out
+
+
+def transcript(outputs):
+    return "".join(f"=== {stage} ===\n{outputs[stage]}\n" for stage in STAGES).encode("utf-8")
+
+
+def first_difference(expected, actual):
+    for offset, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            return offset
+    return min(len(expected), len(actual))
+
+
+def measure(fn, repeat):
+    """返回 (最快一次的秒数, 峰值内存字节, 运行结束后残留的分配块数)"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return best, peak, retained
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", help="录制文件或目录，默认 benchmarks/traces")
+    parser.add_argument("--model", help="没有元数据行的 NDJSON 文件使用的模型", default="grok-4")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--rechunk", type=int, help="按随机大小重新切块（平均字节数）")
+    parser.add_argument("--update-golden", action="store_true")
+    parser.add_argument("--no-golden", action="store_true", help="只测量，不比对 golden")
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths or [TRACES_DIR]:
+        files.extend(sorted(glob.glob(os.path.join(path, "*.ndjson"))) if os.path.isdir(path) else [path])
+    if not files:
+        print("没有找到录制文件")
+        return 1
+
+    handler = RequestHandler(AuthTokenManager())
+    failures = 0
+    for path in files:
+        meta, chunks = capture.load(path)
+        model = meta.get("model", args.model)
+        if args.rechunk:
+            chunks = rechunk(chunks, args.rechunk)
+        size = sum(len(chunk) for chunk in chunks)
+        name = os.path.basename(path)
+        print(f"{name}  model={model} bytes={size} chunks={len(chunks)}")
+
+        outputs = {}
+        for stage in STAGES:
+            replay = REPLAYERS[stage]
+            outputs[stage] = replay(handler, chunks, model)
+            best, peak, retained = measure(lambda: replay(handler, chunks, model), args.repeat)
+            print(
+                f"  {stage:<8} {len(chunks) / best:10.0f} chunks/s {size / best / 1024 / 1024:7.1f} MB/s "
+                f"峰值内存 {peak / 1024:8.1f} KB（输入的 {peak / size:4.1f} 倍） 残留分配块 {retained}"
+            )
+
+        if args.no_golden:
+            continue
+        actual = transcript(outputs)
+        golden_path = os.path.splitext(path)[0] + ".golden"
+        if args.update_golden:
+            with open(golden_path, "wb") as f:
+                f.write(actual)
+            print(f"  golden 已更新: {golden_path}")
+            continue
+        try:
+            with open(golden_path, "rb") as f:
+                expected = f.read()
+        except FileNotFoundError:
+            print(f"  缺少 golden: {golden_path}（用 --update-golden 生成）")
+            failures += 1
+            continue
+        if actual == expected:
+            print("  golden 一致")
+        else:
+            offset = first_difference(expected, actual)
+            stage = expected[:offset].decode("utf-8", "replace").rsplit("=== ", 1)[-1].split(" ===", 1)[0]
+            print(f"  golden 不一致：阶段 {stage}，第 {offset} 字节")
+            print(f"    期望: {expected[offset:offset + 80]!r}")
+            print(f"    实际: {actual[offset:offset + 80]!r}")
+            failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""SSE帧编码微基准：原 create_chat_response + json.dumps 与 ChunkEncoder（标准库/orjson 转义）对比
+
+用法: python benchmarks/bench_sse_encoder.py --chunks 200000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse_encoder  # noqa: E402
+from message_processor import MessageProcessor  # noqa: E402
+from sse_encoder import ChunkEncoder  # noqa: E402
+
+# 典型的上游增量：英文单词、中文、需要转义的引号与换行
+TOKENS = ["Hello", " world", "，你好", "\n\n", ' "quoted"', " 1 + 1 = 2", "！", " </think>"]
+# 长文本（如搜索结果列表）
+LONG_TOKENS = ["\n- [标题 title](https://example.com/path?q=1)" * 20, "段落内容，包含\"引号\"与换行。\n" * 30]
+
+
+def legacy_frame(text, model):
+    return f"data: {json.dumps(MessageProcessor.create_chat_response(text, model, True))}\n\n"
+
+
+def timed(label, n, fn):
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms  {n / elapsed:12.0f} chunks/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=200000)
+    args = parser.parse_args()
+
+    model = "grok-3"
+    # 两种输出解析后除 id 外应完全一致
+    encoder = ChunkEncoder(model)
+    for text in TOKENS + LONG_TOKENS:
+        expected = json.loads(legacy_frame(text, model)[6:])
+        actual = json.loads(encoder.encode(text)[6:])
+        expected["id"] = actual["id"]
+        expected["created"] = actual["created"]
+        assert expected == actual, (expected, actual)
+
+    print(f"chunks={args.chunks} json_backend={sse_encoder.JSON_BACKEND}")
+    for label, samples in (("short", TOKENS), ("long", LONG_TOKENS)):
+        n = args.chunks if label == "short" else args.chunks // 20
+        tokens = [samples[i % len(samples)] for i in range(n)]
+        print(f"-- {label} deltas")
+        baseline = timed("create_chat_response", n, lambda: [legacy_frame(t, model) for t in tokens])
+
+        def run_encoder():
+            encode = ChunkEncoder(model).encode
+            for text in tokens:
+                encode(text)
+
+        encoder_time = timed(f"ChunkEncoder ({sse_encoder.JSON_BACKEND})", n, run_encoder)
+        if sse_encoder.orjson is not None:
+            # 对照：全部使用标准库转义
+            auto_encode = sse_encoder.encode_json_string
+            sse_encoder.encode_json_string = sse_encoder._encode_ascii
+            try:
+                timed("ChunkEncoder (json only)", n, run_encoder)
+            finally:
+                sse_encoder.encode_json_string = auto_encode
+        print(f"speedup: {baseline / encoder_time:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""令牌选取策略模拟：严格轮询与按进行中请求数二选一（可选单令牌并发上限）对比
+
+模拟上游对单个 cookie 限制并发流数（超出返回 429），同一 cookie 的并发流平分输出速度；
+请求按固定速率到达，长短流混合。统计上游 429 次数、失败请求数以及首字节与总耗时分布。
+
+用法: python benchmarks/bench_token_balance.py --rate 8 --duration 15 --sso 8 --upstream-limit 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_concurrency import API_KEY, free_port, pct, start, wait_port  # noqa: E402
+
+SHORT_TOKENS = 20
+LONG_TOKENS = 200
+
+
+async def one_stream(port, model, tokens, stats):
+    body = json.dumps({
+        "model": model,
+        "stream": True,
+        "messages": [{"role": "user", "content": f"tokens={tokens} {random.random()}"}]
+    }).encode()
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(
+            b"POST /v1/chat/completions HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n"
+            b"Content-Type: application/json\r\nAuthorization: Bearer " + API_KEY.encode() +
+            b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+        await writer.drain()
+        ttfb = None
+        data = b""
+        while True:
+            block = await reader.read(65536)
+            if not block:
+                break
+            if ttfb is None and b"data:" in data + block:
+                ttfb = time.perf_counter() - started
+            data += block
+        writer.close()
+        if b"data: [DONE]" in data and b'"error"' not in data:
+            stats["ok"] += 1
+            stats["ttfb"].append(ttfb)
+            stats["long" if tokens == LONG_TOKENS else "short"].append(time.perf_counter() - started)
+        else:
+            stats["failed"] += 1
+    except Exception:
+        stats["failed"] += 1
+
+
+async def drive(port, args):
+    stats = {"ok": 0, "failed": 0, "ttfb": [], "short": [], "long": []}
+    rng = random.Random(args.seed)
+    tasks = []
+    started = time.perf_counter()
+    for i in range(int(args.rate * args.duration)):
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tokens = LONG_TOKENS if rng.random() < args.long_ratio else SHORT_TOKENS
+        tasks.append(asyncio.ensure_future(one_stream(port, args.model, tokens, stats)))
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def call(url, method="GET"):
+    request = urllib.request.Request(url, data=b"{}" if method == "POST" else None, method=method)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def run(label, selection, max_concurrency, upstream_port, args):
+    upstream = f"http://127.0.0.1:{upstream_port}"
+    call(f"{upstream}/mock/reset", "POST")
+    port = free_port()
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "API_KEY": API_KEY,
+        "BASE_URL": upstream,
+        "SSO": ",".join(f"balance{i}" for i in range(args.sso)),
+        "LOG_LEVEL": "ERROR",
+        "TOKEN_DB_PATH": "",
+        "TOKEN_SELECTION": selection,
+        "TOKEN_MAX_CONCURRENCY": str(max_concurrency),
+        "TOKEN_RATE_LIMIT_COOLDOWN": str(args.cooldown),
+    }
+    server = start(["asgi_app.py"], env)
+    try:
+        wait_port(port)
+        stats = asyncio.run(drive(port, args))
+    finally:
+        server.terminate()
+        server.wait()
+    rejected = sum(call(f"{upstream}/mock/rejected").values())
+    spread = statistics.pstdev(stats["short"]) if len(stats["short"]) > 1 else float("nan")
+    print(
+        f"{label:<26} 429={rejected:<5} ok={stats['ok']:<5} failed={stats['failed']:<4} "
+        f"ttfb p50={pct(stats['ttfb'], 0.5) * 1000:.0f}ms p99={pct(stats['ttfb'], 0.99) * 1000:.0f}ms  "
+        f"short p50={pct(stats['short'], 0.5):.2f}s p99={pct(stats['short'], 0.99):.2f}s sd={spread:.2f}s  "
+        f"long p50={pct(stats['long'], 0.5):.2f}s p99={pct(stats['long'], 0.99):.2f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=8, help="每秒到达的请求数")
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--sso", type=int, default=8, help="令牌个数")
+    parser.add_argument("--upstream-limit", type=int, default=2, help="模拟上游单个 cookie 的并发流上限")
+    parser.add_argument("--long-ratio", type=float, default=0.2)
+    parser.add_argument("--interval-ms", type=float, default=10.0)
+    parser.add_argument("--cooldown", type=int, default=1, help="令牌 429 后的冷却秒数")
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = start([
+        "benchmarks/mock_upstream.py", "--port", str(upstream_port), "--interval-ms", str(args.interval_ms),
+        "--max-streams-per-token", str(args.upstream_limit), "--shared-throughput"
+    ])
+    try:
+        wait_port(upstream_port)
+        print(
+            f"rate={args.rate}/s duration={args.duration}s sso={args.sso} upstream limit={args.upstream_limit}/token "
+            f"long={args.long_ratio:.0%} ({LONG_TOKENS} vs {SHORT_TOKENS} tokens, {args.interval_ms}ms)"
+        )
+        run("round_robin", "round_robin", 0, upstream_port, args)
+        run("least_outstanding", "least_outstanding", 0, upstream_port, args)
+        run(f"least_outstanding cap={args.upstream_limit}", "least_outstanding", args.upstream_limit, upstream_port, args)
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""令牌健康检查压测：对本地模拟上游做一次全量检查，统计用时与结果，并检查对线上轮询的影响
+
+启动 mock_upstream.py（/rest/rate-limits 延迟 --probe-latency-ms），在进程内建立 --tokens 个令牌的
+AuthTokenManager，按比例混入失效（401）、额度用尽与检查请求被限流（429）的令牌，然后发起一次全量
+检查。检查期间另有线程不断占用、释放令牌模拟线上请求，统计取令牌耗时。结束后核对：每个令牌恰好
+检查一次、失效令牌已停用、额度用尽的令牌进入冷却、检查被限流的令牌仍可用、进行中请求数归零。
+
+用法: python benchmarks/bench_token_probe.py --tokens 10000 --concurrency 32 --probe-latency-ms 150
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_concurrency import free_port, pct, start, wait_port  # noqa: E402
+
+
+def build_tokens(count, invalid_ratio, exhausted_ratio, limited_ratio):
+    tokens = []
+    invalid_every = int(1 / invalid_ratio) if invalid_ratio else 0
+    exhausted_every = int(1 / exhausted_ratio) if exhausted_ratio else 0
+    limited_every = int(1 / limited_ratio) if limited_ratio else 0
+    for i in range(count):
+        kind = "ok"
+        if invalid_every and i % invalid_every == 0:
+            kind = "invalid"
+        elif exhausted_every and i % exhausted_every == 1:
+            kind = "exhausted"
+        elif limited_every and i % limited_every == 2:
+            kind = "limited"
+        sso = f"{kind}-{i:08d}"
+        tokens.append((f"sso-rw={sso};sso={sso}", kind))
+    return tokens
+
+
+def live_traffic(manager, model, stop, latencies):
+    """模拟线上请求：不断占用并释放令牌"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        lease = manager.acquire_token_for_model(model)
+        latencies.append(time.perf_counter() - started)
+        if lease is not None:
+            lease.release()
+        time.sleep(0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--probe-latency-ms", type=float, default=150.0)
+    parser.add_argument("--invalid-ratio", type=float, default=0.05)
+    parser.add_argument("--exhausted-ratio", type=float, default=0.05)
+    parser.add_argument("--limited-ratio", type=float, default=0.05, help="检查请求返回 429 的令牌比例")
+    args = parser.parse_args()
+
+    port = free_port()
+    mock = start(["benchmarks/mock_upstream.py", "--port", str(port), "--probe-latency-ms", str(args.probe_latency_ms)])
+    try:
+        wait_port(port)
+        os.environ["BASE_URL"] = f"http://127.0.0.1:{port}"
+        os.environ["TOKEN_DB_PATH"] = ""
+        os.environ["TOKEN_PROBE_CONCURRENCY"] = str(args.concurrency)
+
+        from config import config_manager
+        from request_handler import RequestHandler
+        from token_manager import AuthTokenManager, TOKEN_AVAILABLE, TOKEN_COOLING, TOKEN_INVALID
+        from token_prober import TokenProber
+
+        tokens = build_tokens(args.tokens, args.invalid_ratio, args.exhausted_ratio, args.limited_ratio)
+        manager = AuthTokenManager()
+        manager.set_tokens([cookie for cookie, _ in tokens], persist=False)
+        handler = RequestHandler(manager)
+        prober = TokenProber(manager, handler.proxy_pool, handler.default_headers)
+        model = config_manager.get("TOKEN_PROBE.MODEL", "grok-3")
+
+        stop = threading.Event()
+        baseline = []
+        live = threading.Thread(target=live_traffic, args=(manager, model, stop, baseline))
+        live.start()
+        time.sleep(1)
+        stop.set()
+        live.join()
+
+        stop.clear()
+        during = []
+        live = threading.Thread(target=live_traffic, args=(manager, model, stop, during))
+        live.start()
+        prober.start_sweep()
+        while True:
+            time.sleep(1)
+            progress = prober.get_progress()
+            print(f"  {progress['done']}/{progress['total']} {progress['perSecond']}/s {progress['results']}")
+            if not progress["running"]:
+                break
+        stop.set()
+        live.join()
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/mock/probes") as response:
+            probes = json.loads(response.read())
+        expected = {"invalid": 0, "exhausted": 0, "limited": 0, "ok": 0}
+        for _, kind in tokens:
+            expected[kind] += 1
+        invalid = exhausted = limited = 0
+        for cookie, kind in tokens:
+            state, _ = manager.get_token_state(cookie, model)
+            invalid += kind == "invalid" and state == TOKEN_INVALID
+            exhausted += kind == "exhausted" and state == TOKEN_COOLING
+            limited += kind == "limited" and state == TOKEN_AVAILABLE
+        checked = sum(1 for cookie, _ in tokens if manager.health.get(cookie.rsplit("=", 1)[1]))
+
+        print(f"令牌 {args.tokens} 个，并发 {args.concurrency}，上游延迟 {args.probe_latency_ms}ms")
+        print(f"全量检查用时 {progress['elapsedSeconds']}s（{progress['perSecond']}/s），结果 {progress['results']}")
+        print(f"上游收到的检查请求 {probes}")
+        print(f"取令牌耗时 p50/p99（ms）: 检查前 {pct(baseline, 0.5) * 1000:.3f}/{pct(baseline, 0.99) * 1000:.3f}，"
+              f"检查中 {pct(during, 0.5) * 1000:.3f}/{pct(during, 0.99) * 1000:.3f}")
+
+        failures = []
+        if sum(probes.values()) != args.tokens:
+            failures.append(f"检查请求数 {sum(probes.values())} != 令牌数 {args.tokens}")
+        if checked != args.tokens:
+            failures.append(f"有健康记录的令牌 {checked} != {args.tokens}")
+        if invalid != expected["invalid"]:
+            failures.append(f"已停用的失效令牌 {invalid} != {expected['invalid']}")
+        if exhausted != expected["exhausted"]:
+            failures.append(f"进入冷却的额度用尽令牌 {exhausted} != {expected['exhausted']}")
+        if limited != expected["limited"]:
+            failures.append(f"检查被限流后仍可用的令牌 {limited} != {expected['limited']}")
+        if manager.get_in_flight_total():
+            failures.append(f"进行中请求数未归零: {manager.get_in_flight_total()}")
+        for failure in failures:
+            print(f"  失败: {failure}")
+        if not failures:
+            print("  核对通过")
+        return 1 if failures else 0
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
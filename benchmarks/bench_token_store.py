@@ -0,0 +1,84 @@
+"""令牌存储微基准：批量加载、单个添加、轮询、删除，以及多线程轮询的正确性
+
+用法: python benchmarks/bench_token_store.py --tokens 100000 --threads 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_manager import AuthTokenManager  # noqa: E402
+from token_storage import SQLiteTokenStorage  # noqa: E402
+
+
+def timed(label, n, fn):
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms  {n / elapsed:12.0f} ops/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+    n = args.tokens
+    values = [f"bench-sso-{i:08d}" for i in range(n)]
+
+    manager = AuthTokenManager()
+    timed("add_tokens_batch", n, lambda: manager.add_tokens_batch(values))
+
+    single = AuthTokenManager()
+    timed("add_token", n, lambda: [single.add_token(f"sso-rw={v};sso={v}") for v in values])
+
+    timed("get_next_token_for_model", n, lambda: [manager.get_next_token_for_model("grok-3") for _ in range(n)])
+
+    # 多线程并发轮询一整圈，每个令牌应恰好被取到一次
+    picked = []
+    lock = threading.Lock()
+
+    def worker(count):
+        local = [manager.get_next_token_for_model("grok-4") for _ in range(count)]
+        with lock:
+            picked.extend(local)
+
+    def concurrent_round():
+        per_thread = n // args.threads
+        threads = [threading.Thread(target=worker, args=(per_thread + (n % args.threads if i == 0 else 0),))
+                   for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    timed(f"rotation x{args.threads} threads", n, concurrent_round)
+    counts = Counter(picked)
+    print(f"{'rotation correctness':<28} picked={len(picked)} unique={len(counts)} max_per_token={max(counts.values())}")
+
+    timed("get_token_status_map", 1, manager.get_token_status_map)
+    timed("delete_token (by sso)", n, lambda: [manager.delete_token(v) for v in values])
+
+    # 持久化：批量写入与冷启动加载
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "tokens.db")
+        durable = AuthTokenManager(SQLiteTokenStorage(path))
+        timed("add_tokens_batch (sqlite)", n, lambda: durable.add_tokens_batch(values))
+        for v in values[:1000]:
+            durable.mark_rate_limited(v, "grok-4")
+        durable.storage.close()
+
+        restored = AuthTokenManager(SQLiteTokenStorage(path))
+        timed("load_from_storage", n, restored.load_from_storage)
+        cooling = sum(1 for v in values[:1000] if restored.get_token_state(v, "grok-4")[0] == "cooling")
+        print(f"{'restored state':<28} tokens={len(restored.records)} cooling={cooling}")
+        restored.storage.close()
+
+
+if __name__ == "__main__":
+    main()
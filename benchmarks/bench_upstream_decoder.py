@@ -0,0 +1,194 @@
+"""上游 NDJSON 解码基准：原逐行 decode/strip/json.loads + 字符串 += 拼接，与 UpstreamDecoder 事件流对比
+
+默认生成一段数 MB 的推理模型轨迹（思考 token、搜索结果、工具卡片、最终 token、带 thinkingTrace 的
+modelResponse），按随机大小切块模拟网络读取；也可以用 --trace 指定录制的 NDJSON 文件。
+
+用法: python benchmarks/bench_upstream_decoder.py --thinking 60000 --final 20000
+      python benchmarks/bench_upstream_decoder.py --trace benchmarks/traces/grok-4-long.ndjson
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+import capture  # noqa: E402
+import upstream_events  # noqa: E402
+from request_handler import RequestHandler  # noqa: E402
+from token_manager import AuthTokenManager  # noqa: E402
+from upstream_events import UpstreamDecoder  # noqa: E402
+
+
+def line(response):
+    return json.dumps({"result": {"response": response}}, ensure_ascii=False) + "\n"
+
+
+def make_trace(thinking, final, seed=1):
+    rng = random.Random(seed)
+    words = ["the", "问题", "search", "结果", "consider", "因此", "value", "，", "。", "\n"]
+    lines = [line({"token": "Thinking", "isThinking": True, "messageTag": "header"})]
+    thinking_text, final_text = [], []
+    for i in range(thinking):
+        token = rng.choice(words) + " "
+        thinking_text.append(token)
+        lines.append(line({"token": token, "isThinking": True, "messageTag": "thinking"}))
+        if i % 5000 == 2500:
+            lines.append(line({"isThinking": True, "messageTag": "tool_usage_card",
+                               "token": '<xai:tool_usage_card><xai:tool_args><![CDATA[{"query":"q"}]]></xai:tool_args></xai:tool_usage_card>'}))
+            lines.append(line({"isThinking": True, "webSearchResults": {"results": [
+                {"title": f"结果 {j}", "url": f"https://example.com/{i}/{j}", "preview": "x" * 200} for j in range(10)
+            ]}}))
+    for i in range(final):
+        token = rng.choice(words) + " "
+        final_text.append(token)
+        lines.append(line({"token": token, "isThinking": False, "messageTag": "final"}))
+    lines.append(line({"modelResponse": {"message": "".join(final_text), "thinkingTrace": "".join(thinking_text)}}))
+    return "".join(lines).encode("utf-8")
+
+
+def split(data, seed=1):
+    rng = random.Random(seed)
+    chunks, offset = [], 0
+    while offset < len(data):
+        size = rng.randint(1024, 16384)
+        chunks.append(data[offset:offset + size])
+        offset += size
+    return chunks
+
+
+def legacy_lines(chunks):
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def legacy_non_stream(chunks, model):
+    """原非流式路径：逐行解码解析，在状态字典中用 += 拼接"""
+    state = {"full_content": "", "thinking_content": "", "model_response": None}
+    for chunk in legacy_lines(chunks):
+        if not chunk:
+            continue
+        try:
+            line_json = json.loads(chunk.decode("utf-8").strip())
+        except json.JSONDecodeError:
+            continue
+        response_data = line_json.get("result", {}).get("response")
+        if not response_data:
+            continue
+        if model in ["grok-4", "grok-4-fast"]:
+            if response_data.get("isThinking") and response_data.get("token"):
+                state["thinking_content"] += response_data["token"]
+            elif not response_data.get("isThinking") and response_data.get("messageTag") == "final" and response_data.get("token"):
+                state["full_content"] += response_data["token"]
+        else:
+            token = response_data.get("token", "")
+            if token:
+                state["full_content"] += token
+        if response_data.get("modelResponse"):
+            state["model_response"] = response_data["modelResponse"]
+            break
+    return state["full_content"], state["thinking_content"], state["model_response"]
+
+
+def new_non_stream(handler, chunks, model):
+    state = handler.new_non_stream_state()
+    for chunk in chunks:
+        if handler.collect_non_stream_chunk(chunk, model, state):
+            break
+    else:
+        handler.collect_non_stream_chunk(None, model, state, final=True)
+    return "".join(state["full_content"]), "".join(state["thinking_content"]), state["model_response"]
+
+
+def legacy_decode(chunks):
+    count = 0
+    for chunk in legacy_lines(chunks):
+        if not chunk:
+            continue
+        try:
+            response_data = json.loads(chunk.decode("utf-8").strip()).get("result", {}).get("response")
+        except json.JSONDecodeError:
+            continue
+        if response_data:
+            response_data.get("isThinking"), response_data.get("messageTag"), response_data.get("token")
+            count += 1
+    return count
+
+
+def new_decode(chunks):
+    decoder = UpstreamDecoder()
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    return count + len(decoder.flush())
+
+
+def timed(label, size, fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<32} {best * 1000:9.1f} ms  {size / best / 1024 / 1024:8.1f} MB/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thinking", type=int, default=60000)
+    parser.add_argument("--final", type=int, default=20000)
+    parser.add_argument("--trace", help="录制的上游 NDJSON 文件（UPSTREAM_CAPTURE_DIR 录制模式生成）")
+    parser.add_argument("--model", default="grok-4")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model = args.model
+    if args.trace:
+        # 录制文件按录制时的数据块边界回放
+        meta, chunks = capture.load(args.trace)
+        data = b"".join(chunks)
+        model = meta.get("model", model)
+    else:
+        data = make_trace(args.thinking, args.final)
+        chunks = split(data)
+    handler = RequestHandler(AuthTokenManager())
+
+    # 两种实现的非流式结果必须一致
+    assert legacy_non_stream(chunks, model) == new_non_stream(handler, chunks, model)
+
+    print(f"trace={len(data) / 1024 / 1024:.1f} MB chunks={len(chunks)} model={model} "
+          f"json_backend={'orjson' if upstream_events.orjson is not None else 'json'}")
+    print("-- decode only")
+    legacy = timed("legacy lines + json.loads", len(data), lambda: legacy_decode(chunks), args.repeat)
+    new = timed("UpstreamDecoder", len(data), lambda: new_decode(chunks), args.repeat)
+    print(f"speedup: {legacy / new:.1f}x")
+    print("-- non-stream aggregation")
+    legacy = timed("legacy += concat", len(data), lambda: legacy_non_stream(chunks, model), args.repeat)
+    new = timed("events + list join", len(data), lambda: new_non_stream(handler, chunks, model), args.repeat)
+    print(f"speedup: {legacy / new:.1f}x")
+    print("-- stream conversion (decode + filter + SSE encode)")
+
+    def stream():
+        state = handler.new_stream_state(model)
+        frames = 0
+        for chunk in chunks:
+            frames += len(handler.convert_stream_chunk(chunk, model, state))
+        return frames + len(handler.finish_stream_state(model, state))
+
+    timed("convert_stream_chunk", len(data), stream, args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
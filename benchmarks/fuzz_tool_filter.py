@@ -0,0 +1,138 @@
+"""工具输出过滤器的分块模糊检查
+
+生成包含 <grok:render>、<xai:tool_usage_card>（含/不含 query 的 CDATA）与普通文本（含 "<" 字符）的
+上游文本流，在随机位置切分后逐块送入 ToolOutputFilter，结果必须与基于正则的整段参考结果完全一致；
+同时统计原先按块独立做正则替换时泄漏标签的次数，并分别在标签密集的流与正文为主的流上给出两种方式的吞吐
+（交替运行多轮取最快一轮）。
+
+用法: python benchmarks/fuzz_tool_filter.py --streams 2000 --seed 1
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import ToolOutputFilter  # noqa: E402
+
+PLAIN = [
+    "让我搜索一下相关资料。", "The answer is 42. ", "if a < b and b > c: ", "<b>bold</b> ", "x<y ",
+    "1 << 3 ", "换行\n", "Some \"quoted\" text. ", "<", "<grok", "<xai:", "]]>", "![CDATA[not in card]] ",
+]
+
+
+def render_tag(rng):
+    return (f'<grok:render type="render_inline_citation"><argument name="citation_id">{rng.randint(0, 99)}'
+            f'</argument></grok:render>')
+
+
+def tool_card(rng):
+    if rng.random() < 0.7:
+        args = json.dumps({"query": f"搜索词 {rng.randint(0, 999)}", "num_results": 10}, ensure_ascii=False)
+    else:
+        args = json.dumps({"url": f"https://example.com/{rng.randint(0, 999)}"})
+    return (f'<xai:tool_usage_card>\n<xai:tool_usage_card_id>{rng.randint(0, 10 ** 8)}</xai:tool_usage_card_id>\n'
+            f'<xai:tool_name>web_search</xai:tool_name>\n<xai:tool_args><![CDATA[{args}]]></xai:tool_args>\n'
+            f'</xai:tool_usage_card>')
+
+
+def make_stream(rng, tag_ratio=0.3):
+    parts = []
+    for _ in range(rng.randint(5, 40)):
+        roll = rng.random()
+        if roll < tag_ratio / 2:
+            parts.append(render_tag(rng))
+        elif roll < tag_ratio:
+            parts.append(tool_card(rng))
+        else:
+            parts.append(rng.choice(PLAIN))
+    return "".join(parts)
+
+
+def card_replacement(match):
+    queries = [c for c in re.findall(r'<!\[CDATA\[(.*?)\]\]>', match.group(0), re.DOTALL) if '"query"' in c]
+    return "".join('\n' + q + '\n' for q in queries)
+
+
+def reference(text):
+    text = re.sub(r'<grok:render.*?</grok:render>', '', text, flags=re.DOTALL)
+    return re.sub(r'<xai:tool_usage_card.*?</xai:tool_usage_card>', card_replacement, text, flags=re.DOTALL)
+
+
+def legacy_filter(text):
+    """原先逐块独立执行的正则过滤"""
+    text = re.sub(r'<grok:render[^>]*>.*?</grok:render>', '', text, flags=re.DOTALL)
+    matches = [m for m in re.findall(r'!\[CDATA\[(.*?)\]\]', text, re.DOTALL) if '"query"' in m]
+    if matches:
+        return '\n' + '\n'.join(matches) + '\n'
+    if '<xai:tool_usage_card>' in text:
+        return ''
+    return text
+
+
+def split(rng, text):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(1, 60))))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def run_filter(chunks):
+    tool_filter = ToolOutputFilter()
+    return "".join(tool_filter.feed(chunk) for chunk in chunks) + tool_filter.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=2000)
+    parser.add_argument("--splits", type=int, default=20, help="每个流的随机切分次数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=5, help="吞吐测量轮数")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    legacy_leaks = 0
+    streams = []
+    for _ in range(args.streams):
+        text = make_stream(rng)
+        expected = reference(text)
+        for _ in range(args.splits):
+            chunks = split(rng, text)
+            streams.append(chunks)
+            actual = run_filter(chunks)
+            if actual != expected:
+                failures += 1
+                if failures <= 3:
+                    print(f"MISMATCH\n  chunks={chunks!r}\n  expected={expected!r}\n  actual={actual!r}")
+            legacy = "".join(legacy_filter(chunk) for chunk in chunks)
+            if "grok:render" in legacy or "xai:tool_usage_card" in legacy or "argument name" in legacy:
+                legacy_leaks += 1
+
+    total = args.streams * args.splits
+    print(f"split streams={total} mismatches={failures} legacy_streams_leaking_tags={legacy_leaks}")
+
+    def run_legacy(chunks):
+        return "".join(legacy_filter(chunk) for chunk in chunks)
+
+    # 正文为主的流（标签约占 3%），接近上游的实际输出
+    typical = [split(rng, make_stream(rng, 0.03)) for _ in range(args.streams)]
+    for name, sample in (("标签密集", streams), ("正文为主", typical)):
+        chunk_count = sum(len(chunks) for chunks in sample)
+        # 两种方式交替运行 --rounds 轮，各取最快一轮，减少机器抖动的影响
+        best = {run_filter: float("inf"), run_legacy: float("inf")}
+        for _ in range(args.rounds):
+            for fn in best:
+                started = time.perf_counter()
+                for chunks in sample:
+                    fn(chunks)
+                best[fn] = min(best[fn], time.perf_counter() - started)
+        print(f"{name}  ToolOutputFilter {chunk_count / best[run_filter]:10.0f} chunks/s  "
+              f"legacy regex {chunk_count / best[run_legacy]:10.0f} chunks/s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
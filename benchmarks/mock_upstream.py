@@ -0,0 +1,247 @@
+"""本地模拟的 Grok 上游，用于压测，不需要真实 cookie
+
+模拟 /rest/app-chat/conversations/new 的 NDJSON 输出：推理模型（请求带 modelMode）先输出思考
+header 与思考 token，--search 时在思考中插入工具卡片与搜索结果、在最终回答中插入 <grok:render>
+引用，最后是最终 token 与 modelResponse。--first-byte-ms 为首行前的延迟，--interval-ms /
+--jitter-ms 决定 token 速率。
+
+故障注入（按概率）：--fail-429 / --fail-403 直接返回对应状态码，--stall-rate 在流中随机位置停顿
+--stall-ms，--drop-rate 在流中随机位置断开连接。--max-streams-per-token 模拟上游对单个 cookie
+的并发限制，超出时返回 429；--shared-throughput 让同一 cookie 的并发流平分输出速度。
+
+单个请求可以在消息中覆盖：tokens=N（最终 token 数）、thinking=N（思考 token 数）、search=0|1、
+fail=429|403、stall=毫秒（在流中途停顿）、drop=N（输出 N 行后断开）。
+
+/rest/rate-limits 模拟额度查询，供令牌健康检查使用：cookie 中含 invalid 返回 401、含 limited 返回
+429、含 exhausted 时剩余额度为 0，其余返回剩余额度；--probe-latency-ms 为响应延迟。各结果的次数见 /mock/probes。
+
+用法: python benchmarks/mock_upstream.py --port 5300 --tokens 50 --interval-ms 20
+      python benchmarks/mock_upstream.py --search --fail-429 0.05 --stall-rate 0.01 --drop-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def ndjson(response):
+    return (json.dumps({"result": {"response": response}}, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+OPTION_PATTERN = re.compile(r"\b(tokens|thinking|search|fail|stall|drop)=(\d+)")
+
+WORDS = ["the", "问题", "search", "结果", "consider", "因此", "value", "，", "。", "answer", "数据", "\n"]
+
+BLOCKED_PAGE = "<!DOCTYPE html><html><head><title>Just a moment...</title></head><body>blocked</body></html>"
+
+
+class StreamDropped(Exception):
+    """模拟上游在流中途断开"""
+
+
+def tool_card(query):
+    return (
+        '<xai:tool_usage_card><xai:tool_usage_card_id>card</xai:tool_usage_card_id>'
+        '<xai:tool_name>web_search</xai:tool_name><xai:tool_args><![CDATA[{"query":"'
+        + query + '","num_results":10}]]></xai:tool_args></xai:tool_usage_card>'
+    )
+
+
+def web_results(index):
+    return {"results": [
+        {"title": f"结果 {index}-{j}", "url": f"https://example.com/{index}/{j}", "preview": "摘要 " * 40}
+        for j in range(10)
+    ]}
+
+
+def build_lines(rng, final, thinking, search):
+    """生成一次补全的全部 NDJSON 行（不含延迟），返回字节串列表"""
+    lines = []
+    thinking_text, final_text = [], []
+    if thinking:
+        lines.append(ndjson({"token": "Thinking about your request", "isThinking": True, "messageTag": "header"}))
+        for i in range(thinking):
+            token = rng.choice(WORDS) + " "
+            thinking_text.append(token)
+            lines.append(ndjson({"token": token, "isThinking": True, "messageTag": "thinking"}))
+            if search and i == thinking // 2:
+                lines.append(ndjson({"token": tool_card(f"q{i}"), "isThinking": True, "messageTag": "tool_usage_card"}))
+                lines.append(ndjson({"isThinking": True, "webSearchResults": web_results(i), "messageTag": "raw_function_result"}))
+    for i in range(final):
+        token = f"w{i} "
+        final_text.append(token)
+        lines.append(ndjson({"token": token, "isThinking": False, "messageTag": "final"}))
+        if search and i == final // 2:
+            lines.append(ndjson({
+                "token": '<grok:render type="render_inline_citation"><argument name="citation_id">1</argument></grok:render>',
+                "isThinking": False, "messageTag": "final"
+            }))
+    model_response = {"message": "".join(final_text)}
+    if thinking_text:
+        model_response["thinkingTrace"] = "".join(thinking_text)
+    lines.append(ndjson({"modelResponse": model_response}))
+    return lines
+
+
+def create_app(tokens=50, interval_ms=20.0, max_streams_per_token=0, shared_throughput=False, first_byte_ms=0.0,
+               jitter_ms=0.0, thinking=None, search=False, fail_429=0.0, fail_403=0.0, stall_rate=0.0,
+               stall_ms=5000.0, drop_rate=0.0, seed=None, probe_latency_ms=0.0):
+    rng = random.Random(seed)
+    # 按 Cookie 统计请求次数，便于检查令牌分布
+    usage = Counter()
+    rejected = Counter()
+    injected = Counter()
+    open_streams = Counter()
+    probes = Counter()
+
+    async def conversations_new(request: Request):
+        cookie = request.headers.get("cookie", "")
+        usage[cookie] += 1
+        payload = await request.json()
+        is_reasoning = payload.get("modelMode") is not None
+        options = dict(OPTION_PATTERN.findall(payload.get("message", "")))
+
+        fail = int(options["fail"]) if "fail" in options else None
+        if fail is None:
+            roll = rng.random()
+            fail = 429 if roll < fail_429 else 403 if roll < fail_429 + fail_403 else None
+        if fail == 429 or (max_streams_per_token and open_streams[cookie] >= max_streams_per_token):
+            rejected[cookie] += 1
+            if fail == 429:
+                injected["429"] += 1
+            return JSONResponse({"error": {"code": 8, "message": "Too many requests"}}, status_code=429)
+        if fail == 403:
+            injected["403"] += 1
+            return HTMLResponse(BLOCKED_PAGE, status_code=403)
+
+        count = int(options.get("tokens", tokens))
+        thinking_count = int(options.get("thinking", count if thinking is None else thinking)) if is_reasoning else 0
+        with_search = bool(int(options.get("search", search)))
+        lines = build_lines(rng, count, thinking_count, with_search)
+
+        stall_at = drop_at = None
+        if "stall" in options:
+            stall_at, stall_seconds = len(lines) // 2, int(options["stall"]) / 1000
+        elif stall_rate and rng.random() < stall_rate:
+            stall_at, stall_seconds = rng.randrange(len(lines)), stall_ms / 1000
+        if "drop" in options:
+            drop_at = int(options["drop"])
+        elif drop_rate and rng.random() < drop_rate:
+            drop_at = rng.randrange(1, len(lines))
+        open_streams[cookie] += 1
+
+        async def pause():
+            delay = interval_ms + (rng.uniform(-jitter_ms, jitter_ms) if jitter_ms else 0)
+            await asyncio.sleep(max(delay, 0) / 1000 * (open_streams[cookie] if shared_throughput else 1))
+
+        async def generate():
+            try:
+                if first_byte_ms:
+                    await asyncio.sleep(first_byte_ms / 1000)
+                for i, line in enumerate(lines):
+                    if i == stall_at:
+                        injected["stall"] += 1
+                        await asyncio.sleep(stall_seconds)
+                    if i == drop_at:
+                        injected["drop"] += 1
+                        # 生成器抛出异常时 uvicorn 直接关闭连接，客户端收到不完整的分块响应
+                        raise StreamDropped(f"dropped after {i} lines")
+                    yield line
+                    await pause()
+            finally:
+                open_streams[cookie] -= 1
+
+        return StreamingResponse(generate(), media_type="application/json")
+
+    async def rate_limits(request: Request):
+        cookie = request.headers.get("cookie", "")
+        await request.json()
+        if probe_latency_ms:
+            await asyncio.sleep(probe_latency_ms / 1000)
+        if "invalid" in cookie:
+            probes["401"] += 1
+            return JSONResponse({"error": {"code": 16, "message": "Unauthenticated"}}, status_code=401)
+        if "limited" in cookie:
+            probes["429"] += 1
+            return JSONResponse({"error": {"code": 8, "message": "Too many requests"}}, status_code=429)
+        remaining = 0 if "exhausted" in cookie else 20 - usage[cookie] % 20
+        probes["exhausted" if remaining == 0 else "ok"] += 1
+        return JSONResponse({
+            "windowSizeSeconds": 7200,
+            "remainingQueries": remaining,
+            "totalQueries": 20,
+            **({"waitTimeSeconds": 3600} if remaining == 0 else {})
+        })
+
+    async def stats(request: Request):
+        return JSONResponse(dict(usage))
+
+    async def rejected_stats(request: Request):
+        return JSONResponse(dict(rejected))
+
+    async def injected_stats(request: Request):
+        return JSONResponse(dict(injected))
+
+    async def probe_stats(request: Request):
+        return JSONResponse(dict(probes))
+
+    async def reset(request: Request):
+        usage.clear()
+        probes.clear()
+        rejected.clear()
+        injected.clear()
+        return JSONResponse({"success": True})
+
+    return Starlette(routes=[
+        Route("/rest/app-chat/conversations/new", conversations_new, methods=["POST"]),
+        Route("/rest/rate-limits", rate_limits, methods=["POST"]),
+        Route("/mock/stats", stats, methods=["GET"]),
+        Route("/mock/probes", probe_stats, methods=["GET"]),
+        Route("/mock/rejected", rejected_stats, methods=["GET"]),
+        Route("/mock/injected", injected_stats, methods=["GET"]),
+        Route("/mock/reset", reset, methods=["POST"]),
+    ])
+
+
+def add_arguments(parser):
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--interval-ms", type=float, default=20.0)
+    parser.add_argument("--first-byte-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--thinking", type=int, default=None, help="推理模型的思考 token 数，默认与 --tokens 相同")
+    parser.add_argument("--search", action="store_true")
+    parser.add_argument("--fail-429", type=float, default=0.0)
+    parser.add_argument("--fail-403", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-ms", type=float, default=5000.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--max-streams-per-token", type=int, default=0)
+    parser.add_argument("--shared-throughput", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--probe-latency-ms", type=float, default=0.0, help="/rest/rate-limits 的响应延迟")
+
+
+def app_from_args(args):
+    return create_app(
+        args.tokens, args.interval_ms, args.max_streams_per_token, args.shared_throughput, args.first_byte_ms,
+        args.jitter_ms, args.thinking, args.search, args.fail_429, args.fail_403, args.stall_rate, args.stall_ms,
+        args.drop_rate, args.seed, args.probe_latency_ms
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5300)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    uvicorn.run(app_from_args(args), host="127.0.0.1", port=args.port, log_level="critical", backlog=4096)
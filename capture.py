@@ -0,0 +1,169 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from config import config_manager
+from logger import logger, request_id_var
+import metrics
+
+# 上游响应中可能出现的 cookie 值
+COOKIE_PATTERN = re.compile(rb"(sso(?:-rw)?=)([^;\"\s\\]+)")
+
+HEADER_KEY = b'{"capture"'
+
+
+def mask(value):
+    """等长替换，脱敏后各数据块的长度与边界不变"""
+    return b"*" * len(value)
+
+
+def redact(data, token):
+    """去除响应中出现的 cookie：当前令牌的每个 cookie 值，以及任何 sso= / sso-rw= 的值"""
+    for part in token.split(";"):
+        _, _, value = part.strip().partition("=")
+        value = value.encode("utf-8")
+        if len(value) >= 8 and value in data:
+            data = data.replace(value, mask(value))
+    return COOKIE_PATTERN.sub(lambda match: match.group(1) + mask(match.group(2)), data)
+
+
+class CaptureLimit:
+    """进程内已保存的录制文件数，达到 MAX_FILES 后不再录制；首次使用时计入目录中已有的文件"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = None
+
+    def reserve(self, directory, limit):
+        with self.lock:
+            if self.count is None:
+                try:
+                    self.count = sum(1 for name in os.listdir(directory) if name.endswith(".ndjson"))
+                except OSError:
+                    self.count = 0
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+
+limit = CaptureLimit()
+
+
+class TraceRecorder:
+    """记录一次上游响应的原始字节块，结束时写成一个录制文件
+
+    文件第一行是 {"capture": {...}} 元数据（模型、流式与否、令牌哈希、请求 ID、各数据块长度），
+    之后是脱敏后的原始 NDJSON。解码器会忽略元数据行，文件可直接交给 bench_upstream_decoder.py --trace。
+    """
+
+    __slots__ = ("path", "model", "stream", "token", "chunks", "saved")
+
+    def __init__(self, path, model, stream, token):
+        self.path = path
+        self.model = model
+        self.stream = stream
+        self.token = token
+        self.chunks = []
+        self.saved = False
+
+    def add(self, chunk):
+        self.chunks.append(chunk)
+
+    def save(self):
+        """写入录制文件；重复调用无效"""
+        if self.saved:
+            return
+        self.saved = True
+        data = redact(b"".join(self.chunks), self.token)
+        header = {
+            "model": self.model,
+            "stream": self.stream,
+            "token": metrics.token_label(self.token),
+            "request_id": request_id_var.get(),
+            "time": int(time.time()),
+            "chunks": [len(chunk) for chunk in self.chunks]
+        }
+        try:
+            with open(self.path, "wb") as f:
+                f.write(json.dumps({"capture": header}).encode("utf-8") + b"\n")
+                f.write(data)
+        except OSError as e:
+            logger.warning("保存上游录制失败: %s", e, source="Capture")
+
+
+class CapturedResponse:
+    """透传上游响应，读取的每个数据块同时交给 TraceRecorder；关闭时写入录制文件"""
+
+    __slots__ = ("response", "recorder")
+
+    def __init__(self, response, recorder):
+        self.response = response
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_content(self, *args, **kwargs):
+        add = self.recorder.add
+        for chunk in self.response.iter_content(*args, **kwargs):
+            if chunk:
+                add(chunk)
+            yield chunk
+
+    async def aiter_content(self, *args, **kwargs):
+        add = self.recorder.add
+        async for chunk in self.response.aiter_content(*args, **kwargs):
+            if chunk:
+                add(chunk)
+            yield chunk
+
+    def close(self):
+        self.recorder.save()
+        self.response.close()
+
+
+def wrap(response, model, stream, token):
+    """UPSTREAM_CAPTURE_DIR 已设置且未达文件数上限时返回录制中的响应，否则原样返回"""
+    directory = config_manager.get("CAPTURE.DIR", "")
+    if not directory or not limit.reserve(directory, config_manager.get("CAPTURE.MAX_FILES", 1000)):
+        return response
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logger.warning("无法创建录制目录: %s", e, source="Capture")
+        return response
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{model}-{'stream' if stream else 'full'}-{request_id_var.get() or uuid.uuid4().hex[:16]}.ndjson"
+    return CapturedResponse(response, TraceRecorder(os.path.join(directory, name), model, stream, token))
+
+
+def finish(response):
+    """异步路径不调用 close，结束上游流时由此写入录制文件（在单独的线程中写入，不阻塞事件循环）"""
+    if isinstance(response, CapturedResponse):
+        threading.Thread(target=response.recorder.save, name="capture-save").start()
+
+
+def unwrap(response):
+    return response.response if isinstance(response, CapturedResponse) else response
+
+
+def load(path):
+    """读取录制文件，返回 (元数据, 原始数据块列表)；没有元数据行的 NDJSON 文件按行切块"""
+    with open(path, "rb") as f:
+        data = f.read()
+    meta = {}
+    if data.startswith(HEADER_KEY):
+        line, _, data = data.partition(b"\n")
+        meta = json.loads(line)["capture"]
+    sizes = meta.get("chunks")
+    if sizes and sum(sizes) == len(data):
+        chunks, offset = [], 0
+        for size in sizes:
+            chunks.append(data[offset:offset + size])
+            offset += size
+    else:
+        chunks = data.splitlines(keepends=True)
+    return meta, chunks
@@ -15,7 +15,7 @@ class ConfigManager:
             },
             "API": {
                 "IS_TEMP_CONVERSATION": os.environ.get("IS_TEMP_CONVERSATION", "true").lower() == "true",
-                "BASE_URL": "https://grok.com",
+                "BASE_URL": os.environ.get("BASE_URL", "https://grok.com"),
                 "API_KEY": os.environ.get("API_KEY", "sk-123456"),
                 "SIGNATURE_COOKIE": None,
                 "RETRY_TIME": 1000,
@@ -24,14 +24,121 @@ class ConfigManager:
             "ADMIN": {
                 "ADMIN_KEY": os.environ.get("ADMIN_KEY", "admin123")
             },
+            "PROXY_POOL": {
+                # 代理池，逗号或换行分隔的 socks5:// 或 http:// 地址，与 PROXY 合并使用
+                "URLS": os.environ.get("PROXY_POOL", ""),
+                # 返回 403（出口 IP 被封）后的冷却秒数
+                "BAN_COOLDOWN": int(os.environ.get("PROXY_BAN_COOLDOWN", 300)),
+                # 连续连接失败达到该次数后停用 ERROR_COOLDOWN 秒
+                "FAILURE_THRESHOLD": int(os.environ.get("PROXY_FAILURE_THRESHOLD", 3)),
+                "ERROR_COOLDOWN": int(os.environ.get("PROXY_ERROR_COOLDOWN", 30))
+            },
+            "ADMISSION": {
+                # 多个 API 密钥，逗号分隔的 密钥[:并发上限[:每分钟请求数]]；API.API_KEY 始终可用
+                "API_KEYS": os.environ.get("API_KEYS", ""),
+                # 未单独指定时每个密钥的并发上限与每分钟请求数，0 表示不限制
+                "KEY_CONCURRENCY": int(os.environ.get("API_KEY_CONCURRENCY", 0)),
+                "KEY_RPM": int(os.environ.get("API_KEY_RPM", 0)),
+                # 暂时无法处理的请求进入有界 FIFO 队列，最多等待 QUEUE_TIMEOUT 秒
+                "QUEUE_SIZE": int(os.environ.get("ADMISSION_QUEUE_SIZE", 100)),
+                "QUEUE_TIMEOUT": float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 30))
+            },
             "SERVER": {
                 "COOKIE": None,
-                "PORT": int(os.environ.get("PORT", 5200))
+                "PORT": int(os.environ.get("PORT", 5200)),
+                "ASYNC_MAX_CLIENTS": int(os.environ.get("ASYNC_MAX_CLIENTS", 1000))
+            },
+            "SESSION_POOL": {
+                "ENABLED": os.environ.get("SESSION_POOL_ENABLED", "true").lower() == "true",
+                "MAX_SIZE": int(os.environ.get("SESSION_POOL_MAX_SIZE", 256)),
+                "IDLE_TIMEOUT": int(os.environ.get("SESSION_POOL_IDLE_TIMEOUT", 90)),
+                # 执行上游请求的线程数上限，约等于同时进行的上游请求数上限
+                "MAX_WORKERS": int(os.environ.get("SESSION_POOL_MAX_WORKERS", 256)),
+                "WARMUP": int(os.environ.get("SESSION_POOL_WARMUP", 0))
+            },
+            "HEDGE": {
+                "ENABLED": os.environ.get("HEDGE_ENABLED", "false").lower() == "true",
+                # 固定触发延迟（秒），为 0 时按最近首字节耗时的 PERCENTILE 分位数自适应
+                "DELAY": float(os.environ.get("HEDGE_DELAY", 0)),
+                "PERCENTILE": float(os.environ.get("HEDGE_PERCENTILE", 0.9)),
+                "MAX_RATIO": float(os.environ.get("HEDGE_MAX_RATIO", 0.1))
+            },
+            "TOKEN": {
+                "RATE_LIMIT_COOLDOWN": int(os.environ.get("TOKEN_RATE_LIMIT_COOLDOWN", 600)),
+                # 单个令牌同时进行的上游请求数上限，0 表示不限制
+                "MAX_CONCURRENCY": int(os.environ.get("TOKEN_MAX_CONCURRENCY", 0)),
+                # least_outstanding：在最久未使用的两个令牌中取进行中请求较少者；round_robin：严格轮询
+                "SELECTION": os.environ.get("TOKEN_SELECTION", "least_outstanding"),
+                # 令牌持久化存储路径，默认关闭；开启后存储中的令牌与 SSO 环境变量合并，而不是被其替换
+                "STORAGE_PATH": os.environ.get("TOKEN_DB_PATH", ""),
+                "SHARED": os.environ.get("TOKEN_SHARED", "false").lower() == "true",
+                "SHARED_SYNC_INTERVAL": float(os.environ.get("TOKEN_SHARED_SYNC_INTERVAL", 0.2)),
+                "SHARED_EVENT_RETENTION": 100000
+            },
+            "TOKEN_PROBE": {
+                # 后台令牌健康检查：并发数、单次请求超时（秒）、查询额度所用的模型
+                "CONCURRENCY": int(os.environ.get("TOKEN_PROBE_CONCURRENCY", 32)),
+                "TIMEOUT": float(os.environ.get("TOKEN_PROBE_TIMEOUT", 15)),
+                "MODEL": os.environ.get("TOKEN_PROBE_MODEL", "grok-3"),
+                # 定期全量检查的间隔（秒），0 表示只在管理接口触发
+                "INTERVAL": float(os.environ.get("TOKEN_PROBE_INTERVAL", 0))
+            },
+            "SSE": {
+                # 流式帧合并：增量累计达到字节阈值或时间间隔时合并为一帧，可按请求覆盖
+                "COALESCE_ENABLED": os.environ.get("SSE_COALESCE_ENABLED", "false").lower() == "true",
+                "COALESCE_MAX_BYTES": int(os.environ.get("SSE_COALESCE_MAX_BYTES", 512)),
+                "COALESCE_INTERVAL_MS": float(os.environ.get("SSE_COALESCE_INTERVAL_MS", 15))
+            },
+            "PROMPT_CACHE": {
+                # 多轮对话的提示词扁平化缓存：客户端每轮重发的历史前缀只规范化一次
+                "ENABLED": os.environ.get("PROMPT_CACHE_ENABLED", "true").lower() == "true",
+                "MAX_ENTRIES": int(os.environ.get("PROMPT_CACHE_MAX_ENTRIES", 1024)),
+                "MAX_SIZE_MB": float(os.environ.get("PROMPT_CACHE_MAX_SIZE_MB", 64))
+            },
+            "RESPONSE_CACHE": {
+                # 精确匹配的补全结果缓存（默认关闭），相同模型与规范化消息直接返回缓存的回复
+                "ENABLED": os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+                "TTL": int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+                "MAX_ENTRIES": int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000)),
+                "MAX_SIZE_MB": float(os.environ.get("RESPONSE_CACHE_MAX_SIZE_MB", 64)),
+                # 被挤出内存的条目写入该目录，为空时不落盘
+                "DISK_PATH": os.environ.get("RESPONSE_CACHE_DISK_PATH", ""),
+                "DISK_MAX_SIZE_MB": float(os.environ.get("RESPONSE_CACHE_DISK_MAX_SIZE_MB", 512)),
+                # 以流式重放缓存结果时每帧的字符数
+                "REPLAY_CHUNK_SIZE": int(os.environ.get("RESPONSE_CACHE_REPLAY_CHUNK_SIZE", 64))
+            },
+            "SINGLEFLIGHT": {
+                # 相同模型与消息的并发请求合并为一次上游调用（默认关闭）
+                "ENABLED": os.environ.get("SINGLEFLIGHT_ENABLED", "false").lower() == "true"
+            },
+            "TIMEOUTS": {
+                # 分阶段超时（秒）：建连、首字节、流式相邻数据块间的空闲时间
+                "CONNECT": float(os.environ.get("TIMEOUT_CONNECT", 10)),
+                "FIRST_BYTE": float(os.environ.get("TIMEOUT_FIRST_BYTE", 30)),
+                "IDLE": float(os.environ.get("TIMEOUT_IDLE", 30)),
+                # 按模型覆盖，推理模型思考阶段可能长时间无输出
+                "MODELS": {
+                    "grok-4": self._model_timeouts("grok-4", FIRST_BYTE=120, IDLE=90),
+                    "grok-4-fast": self._model_timeouts("grok-4-fast", FIRST_BYTE=60, IDLE=60)
+                }
             },
             "RETRY": {
                 "RETRYSWITCH": False,
                 "MAX_ATTEMPTS": 2
             },
+            "METRICS": {
+                # /metrics 导出 Prometheus 指标，关闭后热路径不再计数
+                "ENABLED": os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+            },
+            "TRACE": {
+                # 所有补全请求默认开启详细追踪（Server-Timing 头与调试字段），否则需按请求开启
+                "ENABLED": os.environ.get("TRACE_ENABLED", "false").lower() == "true"
+            },
+            "CAPTURE": {
+                # 把上游原始 NDJSON 响应（cookie 已脱敏）保存到该目录，供解析器回放基准使用；为空时关闭
+                "DIR": os.environ.get("UPSTREAM_CAPTURE_DIR", ""),
+                "MAX_FILES": int(os.environ.get("UPSTREAM_CAPTURE_MAX_FILES", 1000))
+            },
             "LOGGING": {
                 "LOG_LEVEL": os.environ.get("LOG_LEVEL", "ERROR").upper(),
                 "SUPPORTED_LEVELS": ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
@@ -61,6 +168,28 @@ class ConfigManager:
     def is_valid_model(self, model):
         return model in self.get_models()
 
+    @staticmethod
+    def _model_timeouts(model, **defaults):
+        """模型的超时覆盖：TIMEOUT_<阶段>_<模型>（如 TIMEOUT_IDLE_GROK_4_FAST）优先；
+        设置了全局的 TIMEOUT_<阶段> 时不再使用内置的模型默认值"""
+        overrides = {}
+        for phase, default in defaults.items():
+            value = os.environ.get(f"TIMEOUT_{phase}_{model.upper().replace('-', '_')}")
+            if value is not None:
+                overrides[phase] = float(value)
+            elif os.environ.get(f"TIMEOUT_{phase}") is None:
+                overrides[phase] = default
+        return overrides
+
+    def get_timeouts(self, model):
+        """返回模型的 (连接, 首字节, 空闲) 超时"""
+        timeouts = self.get("TIMEOUTS", {})
+        override = timeouts.get("MODELS", {}).get(model, {})
+        return tuple(
+            override.get(phase, timeouts.get(phase, default))
+            for phase, default in (("CONNECT", 10), ("FIRST_BYTE", 30), ("IDLE", 30))
+        )
+
     def get_log_level(self):
         return self.get("LOGGING.LOG_LEVEL", "INFO")
 
@@ -0,0 +1,72 @@
+import threading
+from collections import defaultdict, deque
+
+
+class HedgeController:
+    """对冲请求控制：触发延迟、频率上限与胜负统计
+
+    延迟为固定值（delay > 0）或按模型最近首字节耗时的分位数自适应；
+    频率上限用令牌桶实现，每个请求积累 max_ratio 个额度，对冲一次消耗 1 个，
+    保证对冲请求数不超过总请求数的 max_ratio。
+    """
+
+    def __init__(self, delay=0, percentile=0.9, max_ratio=0.1, burst=5, window=200, min_samples=20, fallback_delay=2.0):
+        self.delay = delay
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.min_samples = min_samples
+        self.fallback_delay = fallback_delay
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.budget = float(burst)
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "hedge_losses": 0,
+            "skipped_budget": 0,
+            "skipped_no_token": 0
+        }
+
+    def record_ttfb(self, model, seconds):
+        with self.lock:
+            self.samples[model].append(seconds)
+
+    def _delay_locked(self, model):
+        if self.delay > 0:
+            return self.delay
+        samples = sorted(self.samples[model])
+        if len(samples) < self.min_samples:
+            return self.fallback_delay
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile))]
+
+    def get_delay(self, model):
+        with self.lock:
+            return self._delay_locked(model)
+
+    def on_request(self):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.budget = min(self.burst, self.budget + self.max_ratio)
+
+    def try_acquire(self):
+        with self.lock:
+            if self.budget >= 1:
+                self.budget -= 1
+                self.stats["hedged"] += 1
+                return True
+            self.stats["skipped_budget"] += 1
+            return False
+
+    def record(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "budget": round(self.budget, 3),
+                "delays": {model: round(self._delay_locked(model), 4) for model in self.samples}
+            }
@@ -1,9 +1,105 @@
 import os
 import sys
-import inspect
+import json
+import uuid
+import queue
+import atexit
+import threading
+import traceback
+import contextvars
+
+# 日志级别数值，与 loguru 内置级别一致
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{file}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
+    "<level>{message}</level>"
+)
+
+# 当前请求的 ID：线程与 asyncio 任务各自独立，日志记录时读取
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+
+class BackgroundSink:
+    """后台写日志：请求线程只把日志放进队列，由后台线程批量写入 stream
+
+    serialize 为真时输出 JSON 行，序列化同样在后台线程完成。进程退出时写完队列中剩余的日志。
+    """
+
+    def __init__(self, stream, serialize=False):
+        self.stream = stream
+        self.serialize = serialize
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, message):
+        self.queue.put(message)
+
+    @staticmethod
+    def to_json(message):
+        record = message.record
+        extra = record["extra"]
+        entry = {
+            "time": record["time"].isoformat(),
+            "level": record["level"].name,
+            "source": extra.get("source"),
+            "message": extra.get("text", record["message"]),
+            "file": record["file"].name,
+            "function": record["function"],
+            "line": record["line"],
+            "request_id": extra.get("request_id")
+        }
+        exception = record["exception"]
+        if exception is not None:
+            entry["exception"] = "".join(traceback.format_exception(exception.type, exception.value, exception.traceback))
+        return json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+
+    def _render(self, message):
+        return self.to_json(message) if self.serialize else str(message)
+
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            lines = [self._render(message)]
+            # 一次取出已排队的全部日志，合并写入
+            stop = False
+            while True:
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    stop = True
+                    break
+                lines.append(self._render(message))
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except Exception:
+                pass
+            if stop:
+                return
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=2)
 
 
 class Logger:
+    """日志门面：先按级别短路，再交给 loguru
+
+    低于当前级别的调用只做一次整数比较，不取调用方栈帧、不格式化消息；消息可以带 %-格式参数，
+    只在确实输出时格式化，例如 logger.warning("令牌已失效: %.20s...", token, source="Server")。调用方的文件、函数与行号由 loguru 在输出时按 depth 读取。
+    LOG_ASYNC=true（默认）时经 BackgroundSink 在后台线程写入；LOG_FORMAT=json 时输出带请求 ID 的 JSON 行。
+    """
+
     _instance = None
 
     def __new__(cls):
@@ -14,6 +110,7 @@ class Logger:
     def __init__(self):
         if not hasattr(self, 'initialized'):
             self.initialized = True
+            self.level_no = LEVELS.get(self._get_log_level_from_env(), LEVELS["ERROR"])
             self._init_logger()
 
     def _init_logger(self):
@@ -31,22 +128,31 @@ class Logger:
     def _setup_logger(self):
         # 移除默认handler
         self.logger.remove()
+        self.logger.configure(patcher=self._add_request_id)
 
-        # 从环境变量获取日志级别
-        level = self._get_log_level_from_env()
-
-        # 设置格式
-        format = (
-            "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
-            "<level>{level: <8}</level> | "
-            "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
-            "<level>{message}</level>"
-        )
-
-        self.handler_id = self.logger.add(
-            sys.stderr,
+        self.serialize = os.environ.get("LOG_FORMAT", "text").lower() == "json"
+        if os.environ.get("LOG_ASYNC", "true").lower() == "true":
+            self.sink = BackgroundSink(sys.stderr, self.serialize)
+        else:
+            self.sink = sys.stderr
+
+        self.handler_id = self._add_handler(self._get_log_level_from_env())
+
+    @staticmethod
+    def _add_request_id(record):
+        # 只对实际输出的日志调用
+        record["extra"]["request_id"] = request_id_var.get()
+
+    def _add_handler(self, level):
+        if self.serialize and isinstance(self.sink, BackgroundSink):
+            # JSON 在后台线程序列化，这里只需原始记录
+            return self.logger.add(self.sink, level=level, format="{message}", colorize=False)
+        if self.serialize:
+            return self.logger.add(self.sink, level=level, serialize=True)
+        return self.logger.add(
+            self.sink,
             level=level,
-            format=format,
+            format=TEXT_FORMAT,
             colorize=True,
             backtrace=True,
             diagnose=True
@@ -54,82 +160,60 @@ class Logger:
 
     def set_level(self, level):
         """动态设置日志级别"""
+        level = level.upper()
+        if level not in LEVELS:
+            return False
         if self.logger and hasattr(self, 'handler_id'):
             try:
-                # 移除旧的handler
+                # 移除旧的handler，沿用同一个输出
                 self.logger.remove(self.handler_id)
-
-                # 设置格式
-                format = (
-                    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
-                    "<level>{level: <8}</level> | "
-                    "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
-                    "<level>{message}</level>"
-                )
-
-                # 添加新的handler
-                self.handler_id = self.logger.add(
-                    sys.stderr,
-                    level=level,
-                    format=format,
-                    colorize=True,
-                    backtrace=True,
-                    diagnose=True
-                )
+                self.handler_id = self._add_handler(level)
+                self.level_no = LEVELS[level]
                 return True
             except Exception as e:
                 print(f"Failed to set log level: {e}")
                 return False
         return False
 
-    def _get_caller_info(self):
-        frame = inspect.currentframe()
-        try:
-            caller_frame = frame.f_back.f_back
-            full_path = caller_frame.f_code.co_filename
-            function = caller_frame.f_code.co_name
-            lineno = caller_frame.f_lineno
-
-            filename = os.path.basename(full_path)
-
-            return {
-                'filename': filename,
-                'function': function,
-                'lineno': lineno
-            }
-        finally:
-            del frame
-
-    def info(self, message, source="API"):
+    def is_enabled(self, level):
+        return LEVELS.get(level, 0) >= self.level_no
+
+    @staticmethod
+    def set_request_id(request_id=None):
+        """设置当前请求的 ID（沿用客户端传入的 X-Request-ID，否则生成），返回该 ID"""
+        request_id = (request_id or "")[:64] or uuid.uuid4().hex[:16]
+        request_id_var.set(request_id)
+        return request_id
+
+    def _log(self, level, message, source, args, exception=False):
+        if args:
+            message = message % args
         if self.logger:
-            caller_info = self._get_caller_info()
-            self.logger.bind(**caller_info).info(f"[{source}] {message}")
+            # depth=2：跳过 _log 与 info/error 等门面方法，定位到调用方
+            self.logger.opt(depth=2, exception=exception).log(
+                level, "[{source}] {text}", source=source, text=message
+            )
         else:
-            print(f"[INFO] [{source}] {message}")
+            print(f"[{level}] [{source}] {message}")
 
-    def error(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
+    def info(self, message, *args, source="API"):
+        if self.level_no <= 20:
+            self._log("INFO", message, source, args)
+
+    def error(self, message, *args, source="API"):
+        if self.level_no <= 40:
             if isinstance(message, Exception):
-                self.logger.bind(**caller_info).exception(f"[{source}] {str(message)}")
+                self._log("ERROR", str(message), source, (), exception=message)
             else:
-                self.logger.bind(**caller_info).error(f"[{source}] {message}")
-        else:
-            print(f"[ERROR] [{source}] {message}")
+                self._log("ERROR", message, source, args)
 
-    def warning(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
-            self.logger.bind(**caller_info).warning(f"[{source}] {message}")
-        else:
-            print(f"[WARNING] [{source}] {message}")
+    def warning(self, message, *args, source="API"):
+        if self.level_no <= 30:
+            self._log("WARNING", message, source, args)
 
-    def debug(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
-            self.logger.bind(**caller_info).debug(f"[{source}] {message}")
-        else:
-            print(f"[DEBUG] [{source}] {message}")
+    def debug(self, message, *args, source="API"):
+        if self.level_no <= 10:
+            self._log("DEBUG", message, source, args)
 
 
-logger = Logger()
\ No newline at end of file
+logger = Logger()
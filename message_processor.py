@@ -2,8 +2,191 @@ import uuid
 import time
 import json
 import re
+from json.encoder import encode_basestring_ascii
 from logger import logger
 from config import config_manager
+from upstream_events import EVENT_WEB_RESULTS
+from prompt_cache import PromptCache
+
+
+class ToolOutputFilter:
+    """流式工具输出过滤器
+
+    逐块单趟扫描上游文本：删除 <grok:render> 标签及内容；<xai:tool_usage_card> 内只保留
+    含 "query" 的 CDATA 参数；跨块的标签只缓冲未闭合的部分，因此在任意分块边界上结果一致。
+    每个流使用一个实例，流结束时调用 flush 取出剩余文本。
+    """
+
+    RENDER_OPEN = "<grok:render"
+    RENDER_CLOSE = "</grok:render>"
+    CARD_OPEN = "<xai:tool_usage_card"
+    CARD_CLOSE = "</xai:tool_usage_card>"
+    CDATA_OPEN = "<![CDATA["
+    CDATA_CLOSE = "]]>"
+    # 普通文本中一次定位下一个开始标签，不逐个检查 "<"
+    TAG_OPEN = re.compile(r"<(?:grok:render|xai:tool_usage_card)")
+
+    TEXT, RENDER, CARD, CDATA = range(4)
+
+    __slots__ = ("mode", "pending", "cdata")
+
+    def __init__(self):
+        self.mode = self.TEXT
+        self.pending = ""
+        self.cdata = []
+
+    @staticmethod
+    def format_web_results(web_search_results):
+        formatted_results = []
+        for result in web_search_results.get("results", []):
+            if result.get("title") and result.get("url"):
+                title = result["title"].strip()
+                url = result["url"].strip()
+                if title and url:
+                    formatted_results.append(f"[{title}]({url})")
+        if formatted_results:
+            return '\n' + '\n'.join(formatted_results) + '\n'
+        return ''
+
+    def feed(self, response_data):
+        """处理一个上游响应片段（dict 或文本），返回可以输出的内容"""
+        if isinstance(response_data, str):
+            return self.feed_text(response_data)
+        if not isinstance(response_data, dict):
+            return ''
+        if response_data.get("messageTag") == "tool_usage_card":
+            return self.feed_tool_card(response_data.get("token") or '')
+        if response_data.get("webSearchResults"):
+            return self.format_web_results(response_data["webSearchResults"])
+        token = response_data.get("token")
+        return self.feed_text(token) if token else ''
+
+    def feed_event(self, event):
+        """处理一个上游增量事件（UpstreamEvent）"""
+        if event.tag == "tool_usage_card":
+            return self.feed_tool_card(event.text)
+        if event.kind == EVENT_WEB_RESULTS:
+            return self.format_web_results(event.data)
+        return self.feed_text(event.text) if event.text else ''
+
+    def feed_tool_card(self, text):
+        """tool_usage_card 片段：含卡片标签的是重复下发的卡片，整段丢弃（标签仍经过状态机，跨块的卡片才能
+        正确闭合）；不含卡片标签的片段按普通文本过滤"""
+        if "xai:tool_usage_card" in text:
+            self.feed_text(text)
+            return ''
+        return self.feed_text(text) if text else ''
+
+    def feed_text(self, text):
+        if self.mode == self.TEXT and not self.pending:
+            # 普通文本（含比较符号等 "<"）且末尾不是被截断的开始标签时原样返回
+            if "<" not in text:
+                return text
+            if self.TAG_OPEN.search(text) is None:
+                j = text.rfind("<", max(len(text) - len(self.CARD_OPEN) + 1, 0))
+                if j < 0 or not (self.RENDER_OPEN.startswith(text[j:]) or self.CARD_OPEN.startswith(text[j:])):
+                    return text
+        data = self.pending + text if self.pending else text
+        self.pending = ""
+        out = []
+        mode = self.mode
+        i = 0
+        n = len(data)
+        while i < n:
+            if mode == self.TEXT:
+                match = self.TAG_OPEN.search(data, i)
+                if match is None:
+                    # 开始标签只含一个 "<"，只有最后一个 "<" 可能是被分块截断的开始标签，等下一块再判断
+                    j = data.rfind("<", max(i, n - len(self.CARD_OPEN) + 1))
+                    if j >= 0 and (self.RENDER_OPEN.startswith(data[j:]) or self.CARD_OPEN.startswith(data[j:])):
+                        out.append(data[i:j])
+                        self.pending = data[j:]
+                    else:
+                        out.append(data[i:])
+                    break
+                j = match.start()
+                if j > i:
+                    out.append(data[i:j])
+                if match.end() - j == len(self.RENDER_OPEN):
+                    mode = self.RENDER
+                else:
+                    mode = self.CARD
+                i = match.end()
+            elif mode == self.RENDER:
+                j = data.find(self.RENDER_CLOSE, i)
+                if j < 0:
+                    self.pending = data[max(i, n - len(self.RENDER_CLOSE) + 1):]
+                    break
+                mode, i = self.TEXT, j + len(self.RENDER_CLOSE)
+            elif mode == self.CARD:
+                close = data.find(self.CARD_CLOSE, i)
+                start = data.find(self.CDATA_OPEN, i, close if close >= 0 else n)
+                if start >= 0:
+                    mode, i = self.CDATA, start + len(self.CDATA_OPEN)
+                elif close >= 0:
+                    mode, i = self.TEXT, close + len(self.CARD_CLOSE)
+                else:
+                    self.pending = data[max(i, n - len(self.CARD_CLOSE) + 1):]
+                    break
+            else:
+                j = data.find(self.CDATA_CLOSE, i)
+                if j < 0:
+                    # 保留末尾可能是结束标记一部分的字符
+                    keep = max(i, n - len(self.CDATA_CLOSE) + 1)
+                    self.cdata.append(data[i:keep])
+                    self.pending = data[keep:]
+                    break
+                self.cdata.append(data[i:j])
+                content = ''.join(self.cdata)
+                self.cdata = []
+                if '"query"' in content:
+                    out.append('\n' + content + '\n')
+                mode, i = self.CARD, j + len(self.CDATA_CLOSE)
+        self.mode = mode
+        return ''.join(out)
+
+    def flush(self):
+        """流结束：输出被暂存的不完整开始标签，丢弃未闭合的标签内容"""
+        remainder = self.pending if self.mode == self.TEXT else ''
+        self.mode = self.TEXT
+        self.pending = ""
+        self.cdata = []
+        return remainder
+
+
+def create_prompt_cache():
+    if not config_manager.get("PROMPT_CACHE.ENABLED", True):
+        return None
+    return PromptCache(
+        max_entries=config_manager.get("PROMPT_CACHE.MAX_ENTRIES", 1024),
+        max_size=int(config_manager.get("PROMPT_CACHE.MAX_SIZE_MB", 64) * 1024 * 1024)
+    )
+
+
+prompt_cache = create_prompt_cache()
+
+
+class PayloadTemplate:
+    """预编译的上游请求体
+
+    以占位文本构造模型的完整请求体并序列化一次，按占位符切分为前后两段 JSON 片段；
+    每个请求只需转义对话文本并拼接，结果与对完整字典 json.dumps 完全一致。
+    """
+
+    MARKER = "\x00message\x00"
+
+    __slots__ = ("fingerprint", "prefix", "suffix")
+
+    def __init__(self, fingerprint, payload):
+        self.fingerprint = fingerprint
+        self.prefix, self.suffix = json.dumps(payload).split(json.dumps(self.MARKER))
+
+    def render(self, conversation):
+        return self.prefix + encode_basestring_ascii(conversation) + self.suffix
+
+
+# 模型 -> PayloadTemplate
+payload_templates = {}
 
 
 class MessageProcessor:
@@ -58,59 +241,9 @@ class MessageProcessor:
 
     @staticmethod
     def process_tool_response(response_data):
-        """规范化响应内容"""
-        if isinstance(response_data, str):
-            text = response_data
-        elif isinstance(response_data, dict):
-            # 过滤重复的 xai:tool_usage_card
-            if (response_data.get("messageTag") == "tool_usage_card" and
-                "xai:tool_usage_card" in response_data["token"]):
-                return ''
-
-            # 处理web搜索结果
-            if response_data.get("webSearchResults"):
-                web_results = response_data["webSearchResults"].get("results", [])
-                if web_results:
-                    formatted_results = []
-                    for result in web_results:
-                        if result.get("title") and result.get("url"):
-                            title = result["title"].strip()
-                            url = result["url"].strip()
-                            if title and url:
-                                formatted_results.append(f"[{title}]({url})")
-
-                    if formatted_results:
-                        return '\n' + '\n'.join(formatted_results) + '\n'
-                return ''
-
-            # 如果是字典但没有web搜索结果，提取token字段
-            text = response_data.get("token", "")
-            if not text:
-                return ''
-        else:
-            return ''
-
-        # 移除 grok:render 标签及内容
-        text = re.sub(r'<grok:render[^>]*>.*?</grok:render>', '', text, flags=re.DOTALL)
-
-        # 仅保留CDATA参数
-        cdata_pattern = r'!\[CDATA\[(.*?)\]\]'
-        matches = re.findall(cdata_pattern, text, re.DOTALL)
-
-        if matches:
-            # 过滤不含 "query" 的 CDATA
-            filtered_matches = []
-            for match in matches:
-                if '"query"' in match:
-                    filtered_matches.append(match)
-
-            if filtered_matches:
-                return '\n' + '\n'.join(filtered_matches) + '\n'
-
-        if '<xai:tool_usage_card>' in text:
-            return ''
-
-        return text
+        """规范化单个完整的响应片段；流式场景应按流复用 ToolOutputFilter"""
+        tool_filter = ToolOutputFilter()
+        return tool_filter.feed(response_data) + tool_filter.flush()
 
     @staticmethod
     def process_content(content):
@@ -131,12 +264,22 @@ class MessageProcessor:
         return MessageProcessor.remove_think_tags(MessageProcessor.process_message_content(content))
 
     @staticmethod
-    def prepare_chat_messages(messages, model):
+    def flatten_messages(messages, cache=None):
+        """把消息列表扁平化为 "ROLE: 内容" 行；提供缓存时从最长的已缓存前缀继续"""
+        digests = None
+        start = 0
+        state = None
         processed_messages = []
         last_role = None
         last_content = ''
-        
-        for current in messages:
+        if cache is not None and messages:
+            digests = cache.prefix_digests(messages)
+            start, state = cache.lookup(digests, messages)
+            if state is not None:
+                processed_messages = list(state[0])
+                last_role, last_content = state[1], state[2]
+
+        for current in messages[start:]:
             role = 'assistant' if current["role"] == 'assistant' else 'user'
             text_content = MessageProcessor.process_content(current.get("content", ""))
             
@@ -148,12 +291,41 @@ class MessageProcessor:
                     processed_messages.append(f"{role.upper()}: {text_content}")
                     last_content = text_content
                     last_role = role
-        
-        conversation = '\n'.join(processed_messages)
+
+        if digests is not None and start < len(messages):
+            cache.store(digests[-1], (tuple(processed_messages), last_role, last_content), messages, state)
+        return '\n'.join(processed_messages)
+
+    @staticmethod
+    def prepare_conversation(messages):
+        conversation = MessageProcessor.flatten_messages(messages, prompt_cache)
         
         if not conversation.strip():
             raise ValueError('消息内容为空!')
-        
+        return conversation
+
+    @staticmethod
+    def prepare_chat_messages(messages, model):
+        return MessageProcessor.build_payload(model, MessageProcessor.prepare_conversation(messages))
+
+    @staticmethod
+    def prepare_chat_payload(messages, model):
+        """返回序列化好的上游请求体：静态字段来自预编译模板，只转义对话文本"""
+        conversation = MessageProcessor.prepare_conversation(messages)
+        return MessageProcessor.get_payload_template(model).render(conversation)
+
+    @staticmethod
+    def get_payload_template(model):
+        """获取模型的请求体模板，模型映射或临时会话配置变化时重新编译"""
+        fingerprint = (config_manager.get_models().get(model), config_manager.get("API.IS_TEMP_CONVERSATION", False))
+        template = payload_templates.get(model)
+        if template is None or template.fingerprint != fingerprint:
+            template = PayloadTemplate(fingerprint, MessageProcessor.build_payload(model, PayloadTemplate.MARKER))
+            payload_templates[model] = template
+        return template
+
+    @staticmethod
+    def build_payload(model, conversation):
         # 基础请求结构
         base_request = {
             "temporary": config_manager.get("API.IS_TEMP_CONVERSATION", False),
@@ -0,0 +1,265 @@
+import hashlib
+import math
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+
+from config import config_manager
+
+# 请求与上游耗时（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# 流式输出速度（字符/秒）
+RATE_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# 线程数超过该值时在登记新分片时顺带合并已结束线程的分片
+MAX_SHARDS = 256
+
+
+@lru_cache(maxsize=65536)
+def token_label(token):
+    """令牌的哈希标签，不在指标中暴露 cookie"""
+    return hashlib.blake2b(token.encode("utf-8", "surrogatepass"), digest_size=4).hexdigest()
+
+
+def observe_request(model, status, started):
+    """记录一次补全请求；不支持的模型记为 unknown，避免标签无限增长"""
+    if not config_manager.is_valid_model(model):
+        model = "unknown"
+    status = str(status)
+    requests_total.inc(model, status)
+    request_duration.observe(time.perf_counter() - started, model, status)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class MetricFamily:
+    __slots__ = ("registry", "name", "help", "labelnames")
+    kind = "untyped"
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+
+class Counter(MetricFamily):
+    """计数器，标签值按位置传入"""
+    __slots__ = ()
+    kind = "counter"
+
+    def inc(self, *labels, value=1):
+        registry = self.registry
+        if not registry.enabled:
+            return
+        shard = registry.shard()
+        key = (self, labels)
+        shard[key] = shard.get(key, 0) + value
+
+
+class Gauge(Counter):
+    """可增减的计量值；各线程分片之和即当前值，加减可以发生在不同线程"""
+    __slots__ = ()
+    kind = "gauge"
+
+    def dec(self, *labels, value=1):
+        self.inc(*labels, value=-value)
+
+
+class Histogram(MetricFamily):
+    """直方图：分片内按桶计数（非累计），抓取时再累加"""
+    __slots__ = ("buckets",)
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        registry = self.registry
+        if not registry.enabled:
+            return
+        shard = registry.shard()
+        key = (self, labels)
+        counts = shard.get(key)
+        if counts is None:
+            # 各桶计数、+Inf 桶、总和
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+class CallbackGauge(MetricFamily):
+    """抓取时调用 fn 计算的计量值，fn 返回 {标签值元组: 数值}"""
+    __slots__ = ("fn",)
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, labelnames, fn):
+        super().__init__(registry, name, help, labelnames)
+        self.fn = fn
+
+
+class MetricsRegistry:
+    """Prometheus 指标注册表
+
+    热路径上的计数写入当前线程独占的分片（普通字典，无锁），抓取时汇总所有分片；
+    已结束线程的分片在汇总时并入 retired，避免按请求创建线程的 Flask 模式下分片无限增长。
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.families = []
+        self.callbacks = {}
+        self.local = threading.local()
+        self.shards = []
+        self.retired = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def gauge_callback(self, name, help, labelnames, fn):
+        """注册或替换按需计算的计量值"""
+        with self.lock:
+            family = self.callbacks.get(name)
+            if family is None:
+                family = self.callbacks[name] = CallbackGauge(self, name, help, labelnames, fn)
+                self.families.append(family)
+            else:
+                family.fn = fn
+        return family
+
+    def _register(self, family):
+        with self.lock:
+            self.families.append(family)
+        return family
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                if len(self.shards) >= MAX_SHARDS:
+                    self._retire_locked()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    @staticmethod
+    def _merge(target, source):
+        # 分片属于其他线程时可能正被写入，先整体复制（在 GIL 下一次完成）再合并
+        for key, value in list(source.items()):
+            if isinstance(value, list):
+                merged = target.get(key)
+                if merged is None:
+                    target[key] = list(value)
+                else:
+                    for i, count in enumerate(value):
+                        merged[i] += count
+            else:
+                target[key] = target.get(key, 0) + value
+
+    def _retire_locked(self):
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self.retired, shard)
+        self.shards = alive
+
+    def collect(self):
+        """汇总所有分片，返回 {(指标, 标签值): 数值或桶列表}"""
+        with self.lock:
+            self._retire_locked()
+            totals = {}
+            self._merge(totals, self.retired)
+            for _, shard in self.shards:
+                self._merge(totals, shard)
+        return totals
+
+    def render(self):
+        """输出 Prometheus 文本格式"""
+        totals = self.collect()
+        by_family = {}
+        for (family, labels), value in totals.items():
+            by_family.setdefault(family, []).append((labels, value))
+
+        lines = []
+        for family in self.families:
+            if isinstance(family, CallbackGauge):
+                try:
+                    samples = list(family.fn().items())
+                except Exception as error:
+                    lines.append(f"# {family.name} 采集失败: {error}")
+                    continue
+            else:
+                samples = sorted(by_family.get(family, ()), key=lambda sample: sample[0])
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, value in samples:
+                if isinstance(family, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(family.buckets + (math.inf,), value):
+                        cumulative += count
+                        label_text = _format_labels(family.labelnames, labels, ("le", _format_value(float(bound))))
+                        lines.append(f"{family.name}_bucket{label_text} {cumulative}")
+                    label_text = _format_labels(family.labelnames, labels)
+                    lines.append(f"{family.name}_sum{label_text} {_format_value(value[-1])}")
+                    lines.append(f"{family.name}_count{label_text} {cumulative}")
+                else:
+                    label_text = _format_labels(family.labelnames, labels)
+                    lines.append(f"{family.name}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(config_manager.get("METRICS.ENABLED", True))
+
+requests_total = registry.counter(
+    "grok2api_requests_total", "补全请求数（按模型与 HTTP 状态码）", ("model", "status"))
+request_duration = registry.histogram(
+    "grok2api_request_duration_seconds", "补全请求耗时，流式请求计到流结束", ("model", "status"))
+upstream_ttfb = registry.histogram(
+    "grok2api_upstream_ttfb_seconds", "上游首字节耗时", ("model",))
+upstream_duration = registry.histogram(
+    "grok2api_upstream_duration_seconds", "上游请求总耗时（发出到响应读完）", ("model",))
+upstream_responses = registry.counter(
+    "grok2api_upstream_responses_total", "上游响应数（按令牌哈希与状态码，超时与网络错误记为 timeout/error）",
+    ("token", "status"))
+upstream_retries = registry.counter(
+    "grok2api_upstream_retries_total", "失败后换令牌或代理重试的次数（按失败的令牌哈希）", ("token",))
+stream_chunks = registry.counter(
+    "grok2api_stream_chunks_total", "输出的 SSE 数据帧数", ("model",))
+stream_chars = registry.counter(
+    "grok2api_stream_chars_total", "输出的增量文本字符数", ("model",))
+stream_chars_rate = registry.histogram(
+    "grok2api_stream_chars_per_second", "单个流的输出速度（上游响应开始到结束）", ("model",), RATE_BUCKETS)
+streams_in_flight = registry.gauge(
+    "grok2api_streams_in_flight", "正在输出的上游流数", ("model",))
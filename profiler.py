@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# 线程阻塞等待（锁、条件变量、select、套接字读取、线程池取任务、curl 传输）时栈顶所在的函数
+IDLE_FUNCTIONS = frozenset((
+    "wait", "select", "poll", "accept", "readinto", "recv_into", "_wait_for_tstate_lock", "_worker", "perform"
+))
+
+
+class ProfilerBusy(Exception):
+    """已有采样正在进行"""
+
+
+class SamplingProfiler:
+    """运行中进程的采样分析器
+
+    按固定间隔读取所有线程的当前调用栈（sys._current_frames），不需要插桩，对被采样线程几乎没有影响；
+    结果为折叠栈格式（"帧;帧;帧 次数"，根在前），可直接交给 flamegraph.pl、speedscope 等工具生成火焰图。
+    同一时间只允许一次采样。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _frame_label(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _stack(self, frame, labels):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = self._frame_label(frame)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        return ";".join(stack)
+
+    def sample(self, duration, interval=0.005, include_idle=False):
+        """采样 duration 秒，返回 (折叠栈计数, 采样次数)
+
+        include_idle 为假时跳过停在等待函数（锁、事件循环 select 等）上的线程栈。
+        """
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("已有采样正在进行")
+        try:
+            own = threading.get_ident()
+            names = {}
+            labels = {}
+            stacks = Counter()
+            samples = 0
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    if not include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                        continue
+                    thread_label = names.get(ident, f"thread-{ident}")
+                    stacks[f"{thread_label};{self._stack(frame, labels)}"] += 1
+                samples += 1
+                time.sleep(interval)
+            return stacks, samples
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def to_folded(stacks):
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler()
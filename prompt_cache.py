@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+
+
+class PromptCache:
+    """多轮对话的提示词扁平化缓存
+
+    以消息前缀的滚动哈希（逐条对 (前一哈希, 角色, 内容) 取 hash()，字符串哈希按进程随机化）为键，
+    保存扁平化到该前缀为止的状态（已生成的行、最后的角色与内容）以及该前缀的原始消息。客户端每轮
+    重发相同的历史，新请求从最长的已缓存前缀继续，只规范化新增的消息。hash() 只有 64 位，缓存又由
+    所有 API 密钥共用，命中时逐条比对保存的消息，不一致则视为未命中，不会把别人的对话拼进提示词。
+    按条目数与估算大小做 LRU 淘汰；从前缀继续生成的条目与前缀共享行字符串与消息内容，只计入新增部分。
+    """
+
+    def __init__(self, max_entries=1024, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "partial_hits": 0,
+            "misses": 0,
+            "collisions": 0,
+            "evictions": 0,
+            "messages_reused": 0,
+            "messages_processed": 0
+        }
+
+    @staticmethod
+    def freeze(content):
+        """把消息内容（字符串、列表或字典）转换为可哈希的形式"""
+        if isinstance(content, list):
+            return tuple(PromptCache.freeze(item) for item in content)
+        if isinstance(content, dict):
+            return tuple(sorted((key, PromptCache.freeze(value)) for key, value in content.items()))
+        return content
+
+    @staticmethod
+    def prefix_digests(messages):
+        """返回每个消息前缀的哈希，第 i 项对应 messages[:i + 1]"""
+        digest = 0
+        digests = []
+        for current in messages:
+            content = current.get("content", "")
+            if not isinstance(content, str):
+                content = PromptCache.freeze(content)
+            digest = hash((digest, current["role"] == 'assistant', content))
+            digests.append(digest)
+        return digests
+
+    @staticmethod
+    def _same_prefix(prefix, messages):
+        """保存的前缀消息与请求的前几条消息是否完全一致"""
+        for (assistant, content), current in zip(prefix, messages):
+            if assistant != (current["role"] == 'assistant') or content != current.get("content", ""):
+                return False
+        return True
+
+    @staticmethod
+    def _content_size(content):
+        """估算消息内容占用的字符数；多段内容逐项累加，内联的 base64 图片只存在于保存的消息中，同样要计入"""
+        if isinstance(content, str):
+            return len(content)
+        if isinstance(content, (list, tuple)):
+            return sum(PromptCache._content_size(item) for item in content) + 8 * len(content)
+        if isinstance(content, dict):
+            return sum(len(str(key)) + PromptCache._content_size(value) for key, value in content.items()) + 8 * len(content)
+        return 8
+
+    @staticmethod
+    def _entry_size(state, base=None):
+        lines, _, last_content, prefix = state
+        shared = max(len(base[0]) - 1, 0) if base is not None else 0
+        reused = len(base[3]) if base is not None else 0
+        return (sum(len(line) for line in lines[shared:]) + len(last_content) + 8 * (len(lines) + len(prefix))
+                + sum(PromptCache._content_size(content) for _, content in prefix[reused:]))
+
+    def lookup(self, digests, messages):
+        """查找最长的已缓存前缀，返回 (前缀消息数, 状态)，未命中时为 (0, None)"""
+        with self.lock:
+            for index in range(len(digests) - 1, -1, -1):
+                entry = self.entries.get(digests[index])
+                if entry is None:
+                    continue
+                if not self._same_prefix(entry[0][3], messages):
+                    self.stats["collisions"] += 1
+                    continue
+                self.entries.move_to_end(digests[index])
+                matched = index + 1
+                self.stats["hits" if matched == len(digests) else "partial_hits"] += 1
+                self.stats["messages_reused"] += matched
+                self.stats["messages_processed"] += len(digests) - matched
+                return matched, entry[0]
+            self.stats["misses"] += 1
+            self.stats["messages_processed"] += len(digests)
+            return 0, None
+
+    def store(self, digest, state, messages, base=None):
+        """保存前缀状态 (行, 最后的角色, 最后的内容)；base 为继续生成时所用的已缓存状态"""
+        # 已缓存部分沿用 base 保存的消息内容，不再持有本次请求的副本
+        prefix = base[3] if base is not None else ()
+        prefix += tuple(
+            (current["role"] == 'assistant', current.get("content", "")) for current in messages[len(prefix):]
+        )
+        state = (*state, prefix)
+        size = self._entry_size(state, base)
+        if size > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(digest, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[digest] = (state, size)
+            self.size += size
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_size):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["partial_hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "size": self.size,
+                "hit_ratio": round((self.stats["hits"] + self.stats["partial_hits"]) / lookups, 4) if lookups else 0
+            }
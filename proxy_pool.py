@@ -0,0 +1,145 @@
+import hashlib
+import re
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+from logger import logger
+
+
+def parse_proxy_list(spec):
+    """解析以逗号、空白或换行分隔的代理地址列表"""
+    return [url for url in re.split(r"[\s,]+", spec) if url]
+
+
+def parse_proxy_options(url):
+    """把代理地址转换为 curl_cffi 请求参数：socks 代理用 proxy/proxy_auth，http(s) 代理用 proxies"""
+    if not url.startswith("socks"):
+        return {"proxies": {"https": url, "http": url}}
+    options = {"proxy": url}
+    parts = urlsplit(url)
+    if parts.username is not None:
+        options["proxy_auth"] = (unquote(parts.username), unquote(parts.password or ""))
+    return options
+
+
+def mask_proxy(url):
+    """隐藏代理地址中的密码，用于日志与统计"""
+    parts = urlsplit(url)
+    if parts.password is None:
+        return url
+    return url.replace(f":{parts.password}@", ":***@", 1)
+
+
+class Proxy:
+    """代理出口：解析一次的请求参数与健康状态"""
+    __slots__ = ("url", "label", "options", "banned_until", "failures", "stats")
+
+    def __init__(self, url):
+        self.url = url
+        self.label = mask_proxy(url)
+        self.options = parse_proxy_options(url)
+        self.banned_until = 0
+        self.failures = 0
+        self.stats = {"selected": 0, "successes": 0, "errors": 0, "bans": 0}
+
+
+class ProxyPool:
+    """上游代理池
+
+    每个令牌按最高随机权重（rendezvous）哈希固定到一个代理，出口 IP 保持一致，增删代理只影响
+    原本落在该代理上的令牌。代理返回 403（IP 被封）时进入 ban_cooldown 冷却，连续
+    failure_threshold 次连接错误时进入 error_cooldown 冷却；冷却中的代理被跳过，令牌落到
+    其哈希顺序中的下一个健康代理。所有代理都在冷却时使用最早恢复的代理。未配置代理时直连。
+    """
+
+    def __init__(self, urls, ban_cooldown=300, failure_threshold=3, error_cooldown=30):
+        self.proxies = [Proxy(url) for url in dict.fromkeys(urls)]
+        self.ban_cooldown = ban_cooldown
+        self.failure_threshold = failure_threshold
+        self.error_cooldown = error_cooldown
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.proxies)
+
+    @staticmethod
+    def _weight(token, proxy):
+        return hashlib.blake2b(f"{proxy.url}\0{token}".encode("utf-8", "surrogatepass"), digest_size=8).digest()
+
+    def _pick(self, token, now):
+        proxies = self.proxies
+        if len(proxies) == 1:
+            return proxies[0]
+        healthy = [proxy for proxy in proxies if proxy.banned_until <= now]
+        if healthy:
+            return max(healthy, key=lambda candidate: self._weight(token, candidate))
+        return min(proxies, key=lambda candidate: candidate.banned_until)
+
+    def select(self, token):
+        """返回令牌当前应使用的代理，未配置代理时返回 None"""
+        if not self.proxies:
+            return None
+        proxy = self._pick(token, time.time())
+        with self.lock:
+            proxy.stats["selected"] += 1
+        return proxy
+
+    def has_healthy(self, exclude=None):
+        now = time.time()
+        return any(proxy is not exclude and proxy.banned_until <= now for proxy in self.proxies)
+
+    def mark_banned(self, proxy):
+        """代理出口被上游封禁（403）；返回是否还有其他健康代理可以换用"""
+        if proxy is None:
+            return False
+        with self.lock:
+            proxy.banned_until = time.time() + self.ban_cooldown
+            proxy.stats["bans"] += 1
+        logger.warning("代理出口被封禁，冷却 %ss: %s", self.ban_cooldown, proxy.label, source="ProxyPool")
+        return self.has_healthy(proxy)
+
+    def mark_error(self, proxy):
+        """经代理的连接失败，连续失败达到阈值时暂时停用"""
+        if proxy is None:
+            return
+        with self.lock:
+            proxy.failures += 1
+            proxy.stats["errors"] += 1
+            if proxy.failures < self.failure_threshold:
+                return
+            proxy.failures = 0
+            proxy.banned_until = time.time() + self.error_cooldown
+        logger.warning("代理连续连接失败，停用 %ss: %s", self.error_cooldown, proxy.label, source="ProxyPool")
+
+    def mark_success(self, proxy):
+        if proxy is None:
+            return
+        with self.lock:
+            proxy.failures = 0
+            proxy.stats["successes"] += 1
+
+    def group_tokens(self, tokens):
+        """按当前亲和关系把令牌分组，返回 {代理: [令牌]}"""
+        if not self.proxies:
+            return {None: list(tokens)} if tokens else {}
+        now = time.time()
+        groups = {}
+        for token in tokens:
+            groups.setdefault(self._pick(token, now), []).append(token)
+        return groups
+
+    def get_stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                "proxies": [
+                    {
+                        "proxy": proxy.label,
+                        "healthy": proxy.banned_until <= now,
+                        "cooldownUntil": int(proxy.banned_until * 1000) if proxy.banned_until > now else None,
+                        **proxy.stats
+                    }
+                    for proxy in self.proxies
+                ]
+            }
@@ -1,16 +1,171 @@
 import json
 import time
+import threading
 from flask import stream_with_context, Response, jsonify
 from curl_cffi import requests as curl_requests
+from curl_cffi.requests.exceptions import RequestException
 from logger import logger
 from config import config_manager
+import metrics
+import capture
 from token_manager import AuthTokenManager
-from message_processor import MessageProcessor
+from message_processor import MessageProcessor, ToolOutputFilter
+from session_pool import SessionPool, PooledStreamResponse
+from hedging import HedgeController
+from proxy_pool import ProxyPool, parse_proxy_list
+from response_cache import ResponseCache
+from singleflight import SingleFlight
+from sse_encoder import ChunkEncoder, CoalescingChunkEncoder
+from upstream_errors import UpstreamError, UpstreamTimeoutError
+from upstream_events import UpstreamDecoder, EVENT_ERROR, EVENT_MODEL_RESPONSE
+from tracing import TimedStage
+
+
+class UpstreamAttempts:
+    """一次补全请求的上游重试循环，同步与异步路径共用
+
+    依次占用令牌（准入时已占用的令牌用于首次尝试）并选出代理，按上游状态码与异常更新令牌、代理状态
+    并决定是否继续，每次尝试结束归还令牌占用（流式响应交给帧迭代器后在流结束时归还），全部失败时抛出
+    对应的错误。出口 IP 被封且还有健康代理时换代理重试，不计入重试次数。
+    """
+
+    def __init__(self, handler, model, lease=None, trace=None):
+        self.handler = handler
+        self.model = model
+        self.lease = lease
+        self.trace = trace
+        self.token = None
+        self.proxy = None
+        self.count = 0
+        self.status_code = 500
+        # 上一次失败尝试所用令牌的哈希标签，用于统计重试
+        self.failed = None
+        self.handed_off = False
+
+    def next(self):
+        """开始下一次尝试，次数用完时返回 False；没有可用令牌时抛出 UpstreamError"""
+        if self.count >= config_manager.get("RETRY.MAX_ATTEMPTS", 2):
+            return False
+        self.count += 1
+        if self.lease is None:
+            self.lease = self.handler.token_manager.acquire_token_for_model(self.model)
+            if self.lease is None:
+                raise UpstreamError('无可用令牌', 429, 'rate_limit_error')
+        self.token = self.lease.token
+        if self.failed is not None:
+            metrics.upstream_retries.inc(self.failed)
+            self.failed = None
+
+        config_manager.set("API.SIGNATURE_COOKIE", self.token)
+        logger.info("当前令牌: %.50s...", self.token, source="Server")
+
+        started = time.perf_counter()
+        self.proxy = self.handler.proxy_pool.select(self.token)
+        if self.trace is not None:
+            self.trace.since("proxy", started)
+        return True
+
+    def use(self, lease, proxy):
+        """对冲请求胜出时改用胜出一方的令牌与代理"""
+        self.lease, self.token, self.proxy = lease, lease.token, proxy
+
+    def accept(self, ttfb):
+        """上游返回 200"""
+        metrics.upstream_ttfb.observe(ttfb, self.model)
+        self.handler.proxy_pool.mark_success(self.proxy)
+
+    def succeed(self, handed_off):
+        """响应已处理完毕；handed_off 表示流式响应已交给帧迭代器，令牌占用在流结束时归还"""
+        self.handed_off = handed_off
+        self.handler.record_upstream_result(self.token, "200")
+        self.status_code = 200
+        logger.info("请求成功", source="Server")
+
+    def fail_status(self, status_code):
+        """上游返回非 200 状态码，返回是否继续重试"""
+        token = self.token
+        self.failed = self.handler.record_upstream_result(token, str(status_code))
+        if status_code == 403:
+            self.status_code = 403
+            if self.handler.proxy_pool.mark_banned(self.proxy):
+                # 出口 IP 被封与令牌无关，换到健康的代理重试，不计入重试次数
+                logger.warning("IP暂时被封禁，换用其他代理重试", source="Server")
+                self.count -= 1
+                return True
+            logger.error("IP暂时被封禁，请稍后重试或者更换IP", source="Server")
+            return False
+
+        if status_code == 429:
+            self.status_code = 429
+            logger.warning("令牌配额已用完，继续轮询其他令牌: %.20s...", token, source="Server")
+        elif status_code == 401:
+            logger.warning("令牌已失效，继续轮询其他令牌: %.20s...", token, source="Server")
+        else:
+            logger.warning("令牌返回异常状态码 %s，继续轮询: %.20s...", status_code, token, source="Server")
+        self.handler.mark_failed_token(token, self.model, status_code)
+        return True
+
+    def fail_error(self, error):
+        """尝试过程中抛出异常，返回是否继续重试"""
+        if isinstance(error, UpstreamError):
+            # 上游错误、首字节/空闲超时：尚未向客户端输出，换令牌重试
+            logger.warning("上游请求失败，继续轮询其他令牌: %.100s", error, source="Server")
+            self.failed = self.handler.record_upstream_result(
+                self.token, "timeout" if isinstance(error, UpstreamTimeoutError) else str(error.status_code)
+            )
+            self.handler.mark_failed_token(self.token, self.model, error.status_code)
+            return True
+        if isinstance(error, RequestException):
+            logger.warning("网络异常，继续重试: %.100s", error, source="Server")
+            self.failed = self.handler.record_upstream_result(self.token, "error")
+            self.handler.proxy_pool.mark_error(self.proxy)
+            return True
+        # 其他异常直接跳出重试循环
+        logger.error("请求处理异常: %s", error, source="Server")
+        return False
+
+    def end(self):
+        """每次尝试结束时调用，未交给帧迭代器的令牌占用在这里归还"""
+        if not self.handed_off and self.lease is not None:
+            self.lease.release()
+        self.lease = None
+
+    def raise_error(self):
+        """所有尝试均失败"""
+        if self.status_code == 403:
+            raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
+        elif self.status_code == 429:
+            raise UpstreamError('所有令牌均已达到速率限制，请稍后重试', 429, 'rate_limit_error')
+        raise ValueError('请求失败，请检查网络连接或稍后重试')
 
 
 class RequestHandler:
-    def __init__(self, token_manager: AuthTokenManager):
+    def __init__(self, token_manager: AuthTokenManager, response_cache=None, proxy_pool=None, singleflight=None):
+        """response_cache、proxy_pool、singleflight 由调用方传入时与其他处理器共用，未传入时按配置创建"""
         self.token_manager = token_manager
+        self.session_pool = self.create_session_pool()
+        # 对冲请求依赖会话池的非阻塞发送
+        self.hedge_controller = HedgeController(
+            delay=config_manager.get("HEDGE.DELAY", 0),
+            percentile=config_manager.get("HEDGE.PERCENTILE", 0.9),
+            max_ratio=config_manager.get("HEDGE.MAX_RATIO", 0.1)
+        ) if config_manager.get("HEDGE.ENABLED", False) and self.session_pool is not None else None
+        self.response_cache = response_cache if response_cache is not None else ResponseCache(
+            ttl=config_manager.get("RESPONSE_CACHE.TTL", 3600),
+            max_entries=config_manager.get("RESPONSE_CACHE.MAX_ENTRIES", 1000),
+            max_size=int(config_manager.get("RESPONSE_CACHE.MAX_SIZE_MB", 64) * 1024 * 1024),
+            disk_path=config_manager.get("RESPONSE_CACHE.DISK_PATH"),
+            disk_max_size=int(config_manager.get("RESPONSE_CACHE.DISK_MAX_SIZE_MB", 512) * 1024 * 1024)
+        ) if config_manager.get("RESPONSE_CACHE.ENABLED", False) else None
+        if singleflight is None and config_manager.get("SINGLEFLIGHT.ENABLED", False):
+            singleflight = self.create_singleflight()
+        self.singleflight = singleflight
+        self.proxy_pool = proxy_pool if proxy_pool is not None else ProxyPool(
+            parse_proxy_list(config_manager.get("API.PROXY") or "") + parse_proxy_list(config_manager.get("PROXY_POOL.URLS", "")),
+            ban_cooldown=config_manager.get("PROXY_POOL.BAN_COOLDOWN", 300),
+            failure_threshold=config_manager.get("PROXY_POOL.FAILURE_THRESHOLD", 3),
+            error_cooldown=config_manager.get("PROXY_POOL.ERROR_COOLDOWN", 30)
+        )
         
         self.default_headers = {
             'Accept': '*/*',
@@ -21,280 +176,721 @@ class RequestHandler:
             'x-statsig-id': 'ZTpUeXBlRXJyb3I6IENhbm5vdCByZWFkIHByb3BlcnRpZXMgb2YgdW5kZWZpbmVkIChyZWFkaW5nICdjaGlsZE5vZGVzJyk='
         }
     
-    def get_proxy_options(self):
-        proxy = config_manager.get("API.PROXY")
-        proxy_options = {}
+    @staticmethod
+    def create_session_pool():
+        if not config_manager.get("SESSION_POOL.ENABLED", True):
+            return None
+        return SessionPool(
+            max_size=config_manager.get("SESSION_POOL.MAX_SIZE", 256),
+            idle_timeout=config_manager.get("SESSION_POOL.IDLE_TIMEOUT", 90),
+            max_workers=config_manager.get("SESSION_POOL.MAX_WORKERS", 256)
+        )
 
-        if proxy:
-            logger.info(f"使用代理: {proxy}", "Server")
-            
-            if proxy.startswith("socks5://"):
-                proxy_options["proxy"] = proxy
-                
-                if '@' in proxy:
-                    auth_part = proxy.split('@')[0].split('://')[1]
-                    if ':' in auth_part:
-                        username, password = auth_part.split(':')
-                        proxy_options["proxy_auth"] = (username, password)
-            else:
-                proxy_options["proxies"] = {"https": proxy, "http": proxy}     
-        return proxy_options
+    @staticmethod
+    def create_singleflight():
+        return SingleFlight()
 
-    def handle_non_stream_response(self, response, model):
+    @staticmethod
+    def new_stream_state(model, coalesce=None, record=False, trace=None):
+        """流式转换状态（思考标签是否已开始/结束，本次补全的帧编码器与工具输出过滤器）
+
+        record 为真时编码器记录全部增量文本，流正常结束后可取得完整回复。
+        trace 开启详细追踪时，解码、过滤与编码的耗时分别计入 parse、filter、encode 阶段。
+        """
+        if coalesce is None:
+            encoder = ChunkEncoder(model)
+        else:
+            encoder = CoalescingChunkEncoder(model, *coalesce)
+        if record:
+            encoder.recorded = []
+        tool_filter = ToolOutputFilter()
+        decoder = UpstreamDecoder()
+        if trace is not None and trace.detailed:
+            encoder = TimedStage(encoder, trace, "encode", ("push", "poll", "flush"))
+            tool_filter = TimedStage(tool_filter, trace, "filter", ("feed_event", "flush"))
+            decoder = TimedStage(decoder, trace, "parse", ("feed", "flush"))
+        return {
+            "thinking_started": False,
+            "thinking_ended": False,
+            # 读取上游时是否会按合并间隔唤醒；不会唤醒时缓冲内容不能留到下一个数据块
+            "ticking": False,
+            # 流末尾的 modelResponse，流正常结束时据此生成写入响应缓存的最终回复
+            "model_response": None,
+            "encoder": encoder,
+            "tool_filter": tool_filter,
+            "decoder": decoder
+        }
+
+    @staticmethod
+    def get_coalesce_options(data, headers=None):
+        """解析帧合并参数，返回 (字节阈值, 间隔秒数)，不合并时返回 None
+
+        优先级：请求体 coalesce 字段 > 请求头 X-Stream-Coalesce > 全局配置。
+        取值可为 true/false、合并间隔毫秒数（0 表示关闭），
+        请求体中还可以是 {"interval_ms": 15, "max_bytes": 512}。
+        """
+        enabled = config_manager.get("SSE.COALESCE_ENABLED", False)
+        max_bytes = config_manager.get("SSE.COALESCE_MAX_BYTES", 512)
+        interval_ms = config_manager.get("SSE.COALESCE_INTERVAL_MS", 15)
+
+        option = data.get("coalesce")
+        if option is None and headers is not None:
+            option = headers.get("X-Stream-Coalesce")
         try:
-            logger.info("开始处理非流式响应（拼接流式内容）", "Server")
-            
-            # 解析流式响应的所有行，拼接完整内容和思考内容
-            stream = response.iter_lines()
-            full_content = ""
-            thinking_content = ""
-            model_response = None
-            
-            for chunk in stream:
-                if not chunk:
-                    continue
-                try:
-                    line_json = json.loads(chunk.decode("utf-8").strip())
-                    
-                    if line_json.get("error"):
-                        logger.error(json.dumps(line_json, indent=2), "Server")
-                        raise ValueError("RateLimitError")
-                        
-                    response_data = line_json.get("result", {}).get("response")
-                    if not response_data:
-                        continue
-                    
-                    # 处理 grok-4 和 grok-4-fast 的思考内容
-                    if model in ["grok-4", "grok-4-fast"]:
-                        # 收集思考内容 (isThinking: true)
-                        if response_data.get("isThinking") and response_data.get("token"):
-                            thinking_content += response_data["token"]
-
-                        # 收集最终内容 (isThinking: false, messageTag: "final")
-                        elif not response_data.get("isThinking") and response_data.get("messageTag") == "final" and response_data.get("token"):
-                            full_content += response_data["token"]
-
-                    # 处理 grok-3 和其他非推理模型
-                    else:
-                        # 获取token并拼接内容
-                        token = response_data.get("token", "")
-                        if token:
-                            full_content += token
-                    
-                    # 检查是否有最终响应（modelResponse）
-                    if response_data.get("modelResponse"):
-                        model_response = response_data["modelResponse"]
-                        break
-                        
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    logger.error(f"处理非流式响应行时出错: {str(e)}", "Server")
-                    continue
-            
-            # 如果有 modelResponse，优先使用它的内容
-            if model_response:
-                if model in ["grok-4", "grok-4-fast"] and model_response.get("thinkingTrace"):
-                    # 对于推理模型，将思考内容包装在 think 标签中
-                    thinking_trace = model_response["thinkingTrace"]
-                    final_message = f"<think>{thinking_trace}</think>{model_response.get('message', '')}"
+            if isinstance(option, bool):
+                enabled = option
+            elif isinstance(option, (int, float)):
+                enabled, interval_ms = option > 0, option
+            elif isinstance(option, dict):
+                enabled = bool(option.get("enabled", True))
+                interval_ms = float(option.get("interval_ms", interval_ms))
+                max_bytes = int(option.get("max_bytes", max_bytes))
+            elif isinstance(option, str):
+                value = option.strip().lower()
+                if value in ("true", "on", "yes"):
+                    enabled = True
+                elif value in ("false", "off", "no"):
+                    enabled = False
                 else:
-                    final_message = model_response.get('message', '')
+                    interval_ms = float(value)
+                    enabled = interval_ms > 0
+        except (TypeError, ValueError):
+            logger.warning("无效的帧合并参数: %s", option, source="Server")
+
+        if not enabled:
+            return None
+        return max_bytes, interval_ms / 1000
+
+    @staticmethod
+    def new_non_stream_state(trace=None):
+        """非流式拼接状态（增量先收集到列表，最后一次性拼接）"""
+        decoder = UpstreamDecoder()
+        if trace is not None and trace.detailed:
+            decoder = TimedStage(decoder, trace, "parse", ("feed", "flush"))
+        return {"decoder": decoder, "full_content": [], "thinking_content": [], "model_response": None}
+
+    @staticmethod
+    def raise_upstream_error(event):
+        logger.error(json.dumps(event.data, indent=2), source="Server")
+        raise UpstreamError("RateLimitError", 429, "rate_limit_error")
+
+    def convert_stream_chunk(self, chunk, model, state):
+        """将上游原始字节块转换为SSE帧列表，上游返回错误时抛出 UpstreamError"""
+        frames = []
+        if not chunk:
+            # 读取间隙：输出到期的合并缓冲
+            state["encoder"].poll(frames)
+            return frames
+        for event in state["decoder"].feed(chunk):
+            self.convert_stream_event(event, model, state, frames)
+        if state["ticking"]:
+            # 数据块可能不含文本（搜索结果、元数据等），同样检查合并缓冲是否到期
+            state["encoder"].poll(frames)
+        else:
+            # 下一个数据块可能很久才到，合并只在同一数据块内进行
+            state["encoder"].flush(frames)
+        return frames
+
+    def convert_stream_event(self, event, model, state, frames):
+        """将一个上游事件转换为SSE帧，追加到 frames"""
+        kind = event.kind
+        if kind == EVENT_ERROR:
+            self.raise_upstream_error(event)
+        if kind == EVENT_MODEL_RESPONSE:
+            state["model_response"] = event.data
+            return
+        push = state["encoder"].push
+        try:
+            # 处理 grok-4 和 grok-4-fast 的特殊流式响应
+            if model in ["grok-4", "grok-4-fast"]:
+                tool_filter = state["tool_filter"]
+                # 处理思考内容的开始
+                if event.thinking and not state["thinking_started"]:
+                    state["thinking_started"] = True
+                    # 发送开始思考标签
+                    push('<think>', frames, True)
+
+                # 处理思考过程中的内容（显示给用户，仅在思考阶段，过滤header内容和工具使用标签）
+                if event.thinking and not state["thinking_ended"] and event.tag != "header":
+                    # 处理工具响应内容，包括web搜索结果
+                    filtered_content = tool_filter.feed_event(event)
+                    if filtered_content:  # 只输出非空内容
+                        push(filtered_content, frames)
+
+                # 处理思考结束，准备最终内容（只有当有实际的最终内容时才结束思考）
+                elif not event.thinking and state["thinking_started"] and not state["thinking_ended"] and event.tag == "final" and event.text:
+                    state["thinking_ended"] = True
+                    # 思考阶段暂存的不完整标签随结束标签一起输出
+                    remainder = tool_filter.flush()
+                    if remainder:
+                        push(remainder, frames)
+                    # 发送结束思考标签
+                    push('</think>', frames, True)
+                    # 处理工具响应内容，发送最终内容
+                    filtered_content = tool_filter.feed_event(event)
+                    if filtered_content:
+                        push(filtered_content, frames)
+
+                # 处理最终内容的后续部分（思考结束后的纯回复）
+                elif not event.thinking and state["thinking_ended"] and event.tag == "final":
+                    filtered_content = tool_filter.feed_event(event)
+                    if filtered_content:
+                        push(filtered_content, frames)
+
+            # 处理 grok-3 和其他非推理模型
+            elif event.text:
+                push(event.text, frames)
+
+        except Exception as e:
+            logger.error("处理流式响应行时出错: %s", e, source="Server")
+
+    def finish_stream_state(self, model, state):
+        """流结束：处理最后一行、输出过滤器暂存的文本与合并缓冲，返回SSE帧列表"""
+        frames = []
+        for event in state["decoder"].flush():
+            self.convert_stream_event(event, model, state, frames)
+        remainder = state["tool_filter"].flush()
+        if remainder:
+            state["encoder"].push(remainder, frames)
+        state["encoder"].flush(frames)
+        return frames
+
+    def collect_non_stream_chunk(self, chunk, model, state, final=False):
+        """拼接一个上游字节块，收到 modelResponse 时返回 True；final=True 时处理剩余的最后一行"""
+        decoder = state["decoder"]
+        events = decoder.flush() if final else decoder.feed(chunk)
+        reasoning = model in ["grok-4", "grok-4-fast"]
+        for event in events:
+            kind = event.kind
+            if kind == EVENT_ERROR:
+                self.raise_upstream_error(event)
+            # 检查是否有最终响应（modelResponse）
+            if kind == EVENT_MODEL_RESPONSE:
+                state["model_response"] = event.data
+                return True
+            if not event.text:
+                continue
+            # 处理 grok-4 和 grok-4-fast 的思考内容
+            if reasoning:
+                # 收集思考内容 (isThinking: true)
+                if event.thinking:
+                    state["thinking_content"].append(event.text)
+                # 收集最终内容 (isThinking: false, messageTag: "final")
+                elif event.tag == "final":
+                    state["full_content"].append(event.text)
+            # 处理 grok-3 和其他非推理模型
             else:
-                # 如果没有 modelResponse，手动拼接内容
-                if model in ["grok-4", "grok-4-fast"] and thinking_content:
-                    final_message = f"<think>{thinking_content}</think>{full_content}"
-                else:
-                    final_message = full_content
-            
-            if not final_message:
-                logger.warning("未找到响应内容", "Server")
-                final_message = ""
-            
-            # 构建标准OpenAI兼容格式响应
-            openai_response = {
-                "id": f"chatcmpl-{int(time.time())}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": final_message
-                        },
-                        "finish_reason": "stop"
-                    }
-                ],
-                "usage": {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
+                state["full_content"].append(event.text)
+        return False
+
+    @staticmethod
+    def compose_final_message(model, model_response, thinking_content="", full_content=""):
+        """拼出最终回复，推理模型的思考内容包在 think 标签中；有 modelResponse 时优先使用它的内容
+
+        流式与非流式路径共用，响应缓存保存的就是这一形式，命中时再按请求方式输出。
+        """
+        reasoning = model in ["grok-4", "grok-4-fast"]
+        if model_response:
+            thinking = model_response.get("thinkingTrace") if reasoning else None
+            message = model_response.get('message', '')
+        else:
+            # 如果没有 modelResponse，手动拼接内容
+            thinking = thinking_content if reasoning else None
+            message = full_content
+        if thinking:
+            return f"<think>{thinking}</think>{message}"
+        return message
+
+    def build_non_stream_response(self, model, state):
+        """根据拼接状态构建OpenAI兼容的非流式响应"""
+        final_message = self.compose_final_message(
+            model, state["model_response"], "".join(state["thinking_content"]), "".join(state["full_content"])
+        )
+        if not final_message:
+            logger.warning("未找到响应内容", source="Server")
+            final_message = ""
+
+        return self.create_completion_response(model, final_message)
+
+    def stream_final_message(self, model, state):
+        """流正常结束后的最终回复：上游给出 modelResponse 时与非流式路径相同，否则为输出的增量文本"""
+        if state["model_response"]:
+            return self.compose_final_message(model, state["model_response"])
+        return "".join(state["encoder"].recorded)
+
+    @staticmethod
+    def create_completion_response(model, final_message):
+        # 构建标准OpenAI兼容格式响应
+        openai_response = {
+            "id": f"chatcmpl-{int(time.time())}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": final_message
+                    },
+                    "finish_reason": "stop"
                 }
+            ],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
             }
-            
-            logger.info(f"成功构建OpenAI响应，内容长度: {len(final_message)}", "Server")
-            return openai_response
-            
+        }
+
+        logger.info("成功构建OpenAI响应，内容长度: %d", len(final_message), source="Server")
+        return openai_response
+
+    def handle_non_stream_response(self, response, model, trace=None):
+        try:
+            logger.info("开始处理非流式响应（拼接流式内容）", source="Server")
+
+            # 解析流式响应的所有行，拼接完整内容和思考内容
+            state = self.new_non_stream_state(trace)
+            for chunk in response.iter_content():
+                if self.collect_non_stream_chunk(chunk, model, state):
+                    break
+            else:
+                self.collect_non_stream_chunk(None, model, state, final=True)
+
+            return self.build_non_stream_response(model, state)
+
         except Exception as error:
-            logger.error(f"处理非流式响应时出错: {str(error)}", "Server")
+            logger.error("处理非流式响应时出错: %s", error, source="Server")
             raise
+        finally:
+            response.close()
 
-    def handle_stream_response(self, response, model):
-        def generate():
-            logger.info("开始处理流式响应", "Server")
+    @staticmethod
+    def record_upstream_result(token, status):
+        """记录一次上游尝试的结果，返回令牌的哈希标签"""
+        label = metrics.token_label(token)
+        metrics.upstream_responses.inc(label, status)
+        return label
 
-            try:
-                stream = response.iter_lines()
-                thinking_started = False
-                thinking_ended = False
+    @staticmethod
+    def record_stream_metrics(model, state, started, sent_at=None):
+        """流结束时一次性上报帧数、字符数、输出速度与上游总耗时"""
+        now = time.perf_counter()
+        encoder = state["encoder"]
+        metrics.streams_in_flight.dec(model)
+        metrics.stream_chunks.inc(model, value=encoder.frames)
+        metrics.stream_chars.inc(model, value=encoder.chars)
+        if encoder.chars and now > started:
+            metrics.stream_chars_rate.observe(encoder.chars / (now - started), model)
+        if sent_at is not None:
+            metrics.upstream_duration.observe(now - sent_at, model)
 
-                for chunk in stream:
-                    if not chunk:
-                        continue
-                    try:
-                        line_json = json.loads(chunk.decode("utf-8").strip())
-
-                        if line_json.get("error"):
-                            logger.error(json.dumps(line_json, indent=2), "Server")
-                            yield f"data: {json.dumps({'error': {'message': 'RateLimitError', 'type': 'rate_limit_error'}})}\n\n"
-                            return
-
-                        response_data = line_json.get("result", {}).get("response")
-                        if not response_data:
-                            continue
-
-                        # 处理 grok-4 和 grok-4-fast 的特殊流式响应
-                        if model in ["grok-4", "grok-4-fast"]:
-                            # 处理思考内容的开始
-                            if response_data.get("isThinking") and not thinking_started:
-                                thinking_started = True
-                                # 发送开始思考标签
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response('<think>', model, True))}\n\n"
-
-                            # 处理思考过程中的内容（显示给用户，仅在思考阶段，过滤header内容和工具使用标签）
-                            if response_data.get("isThinking") and not thinking_ended and response_data.get("messageTag") != "header":
-                                # 处理工具响应内容，包括web搜索结果
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:  # 只输出非空内容
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                            # 处理思考结束，准备最终内容（只有当有实际的最终内容时才结束思考）
-                            elif not response_data.get("isThinking") and thinking_started and not thinking_ended and response_data.get("messageTag") == "final" and response_data.get("token"):
-                                thinking_ended = True
-                                # 发送结束思考标签
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response('</think>', model, True))}\n\n"
-                                # 处理工具响应内容，发送最终内容
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                            # 处理最终内容的后续部分（思考结束后的纯回复）
-                            elif not response_data.get("isThinking") and thinking_ended and response_data.get("messageTag") == "final":
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                        # 处理 grok-3 和其他非推理模型
-                        else:
-                            result = MessageProcessor.process_model_response(response_data, model)
-                            if result["token"]:
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response(result['token'], model, True))}\n\n"
-
-                    except json.JSONDecodeError:
-                        continue
-                    except Exception as e:
-                        logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
-                        continue
+    def iter_stream_frames(self, response, model, coalesce=None, on_complete=None, on_close=None, sent_at=None, trace=None):
+        """逐帧产出SSE，结束或中断时关闭上游响应并调用 on_close；流正常结束时以完整回复文本调用 on_complete
 
+        sent_at 为发出上游请求时的 perf_counter 读数，用于统计上游总耗时；trace 记录流输出总耗时。
+        """
+        state = self.new_stream_state(model, coalesce, on_complete is not None, trace)
+        metrics.streams_in_flight.inc(model)
+        started = time.perf_counter()
+        if coalesce is not None and isinstance(capture.unwrap(response), PooledStreamResponse):
+            # 上游无数据时也按间隔唤醒，及时输出到期的合并缓冲
+            chunks = response.iter_content(tick=coalesce[1])
+            state["ticking"] = True
+        else:
+            chunks = response.iter_content()
+        try:
+            for chunk in chunks:
+                yield from self.convert_stream_chunk(chunk, model, state)
+            yield from self.finish_stream_state(model, state)
+            if on_complete is not None:
+                on_complete(self.stream_final_message(model, state))
+        except Exception:
+            # 已缓冲的内容先发出，再由上层输出错误事件
+            yield from self.finish_stream_state(model, state)
+            raise
+        finally:
+            response.close()
+            self.record_stream_metrics(model, state, started, sent_at)
+            if trace is not None:
+                trace.since("stream", started)
+            if on_close is not None:
+                on_close()
+
+    def open_stream(self, response, model, coalesce=None, on_complete=None, on_close=None, sent_at=None, trace=None):
+        """读到首个SSE帧为止，返回 (首帧, 后续帧迭代器)
+
+        首帧发出前的任何失败（错误行、超时、断连）直接抛出，由调用方换令牌重试，客户端无感知。
+        """
+        started = time.perf_counter()
+        frames = self.iter_stream_frames(response, model, coalesce, on_complete, on_close, sent_at, trace)
+        try:
+            first_frame = next(frames, None)
+        except BaseException:
+            frames.close()
+            raise
+        if trace is not None:
+            trace.since("first_frame", started)
+        return first_frame, frames
+
+    @staticmethod
+    def stream_error_frames(error):
+        """首帧已发出后上游失败，以错误事件结束流"""
+        if isinstance(error, UpstreamError):
+            message, error_type = str(error), error.error_type
+        else:
+            message, error_type = f'Stream processing error: {str(error)}', 'stream_error'
+        yield f"data: {json.dumps({'error': {'message': message, 'type': error_type}})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    def handle_stream_response(self, first_frame, frames, trace=None):
+        def generate():
+            logger.info("开始处理流式响应", source="Server")
+
+            try:
+                if first_frame is not None:
+                    yield first_frame
+                yield from frames
+                if trace is not None and trace.detailed:
+                    yield trace.debug_frame()
                 yield "data: [DONE]\n\n"
 
             except Exception as e:
-                logger.error(f"流式响应处理异常: {str(e)}", "Server")
-                # 发送错误响应
-                yield f"data: {json.dumps({'error': {'message': f'Stream processing error: {str(e)}', 'type': 'stream_error'}})}\n\n"
-                yield "data: [DONE]\n\n"
+                logger.error("流式响应处理异常: %s", e, source="Server")
+                yield from self.stream_error_frames(e)
+            finally:
+                frames.close()
 
         return generate()
 
-    def make_grok_request(self, data, model, stream=False):
-        response_status_code = 500
+    @staticmethod
+    def should_bypass_cache(data, headers=None):
+        """请求体 "cache": false 或请求头 X-Response-Cache: bypass 时跳过缓存读取（结果仍会写入）"""
+        if data.get("cache") is False:
+            return True
+        value = headers.get("X-Response-Cache", "") if headers is not None else ""
+        return value.strip().lower() in ("bypass", "no-cache", "off", "false")
+
+    def lookup_response_cache(self, data, model, headers=None):
+        """返回 (请求体, 请求键, 缓存的回复文本)；未启用响应缓存与请求合并时均为 None"""
+        if self.response_cache is None and self.singleflight is None:
+            return None, None, None
+        request_payload = MessageProcessor.prepare_chat_payload(data.get("messages", []), model)
+        cache_key = ResponseCache.make_key(model, request_payload)
+        if self.response_cache is None:
+            return request_payload, cache_key, None
+        if self.should_bypass_cache(data, headers):
+            self.response_cache.record_bypass()
+            return request_payload, cache_key, None
+        return request_payload, cache_key, self.response_cache.get(cache_key)
+
+    def store_response_cache(self, cache_key, content):
+        if self.response_cache is not None and cache_key is not None and content:
+            self.response_cache.set(cache_key, content)
+
+    def stream_cache_callback(self, cache_key):
+        if self.response_cache is None or cache_key is None:
+            return None
+        return lambda content: self.store_response_cache(cache_key, content)
+
+    def iter_cached_frames(self, content, model):
+        """把缓存的最终回复切分为 SSE 帧重放；思考标签单独成帧，与实时的流式输出一致"""
+        encoder = ChunkEncoder(model)
+        size = max(config_manager.get("RESPONSE_CACHE.REPLAY_CHUNK_SIZE", 64), 1)
+        segments = [content]
+        if model in ["grok-4", "grok-4-fast"] and content.startswith("<think>") and "</think>" in content:
+            thinking, _, message = content[len("<think>"):].partition("</think>")
+            segments = ["<think>", thinking, "</think>", message]
+        for segment in segments:
+            for offset in range(0, len(segment), size):
+                yield encoder.encode(segment[offset:offset + size])
+
+    def replay_cached_response(self, content, model, stream):
+        logger.info("命中响应缓存", source="Server")
+        if stream:
+            return Response(
+                stream_with_context(self.handle_stream_response(None, self.iter_cached_frames(content, model))),
+                content_type='text/event-stream'
+            )
+        return self.create_completion_response(model, content)
+
+    def build_upstream_request(self, token, request_payload, model, proxy=None):
+        """构造上游请求的URL和参数，同步与异步路径共用；request_payload 为已序列化的请求体，proxy 为代理池选出的出口"""
+        connect_timeout, first_byte_timeout, idle_timeout = config_manager.get_timeouts(model)
+        proxy_options = proxy.options if proxy is not None else {}
+        url = f"{config_manager.get('API.BASE_URL')}/rest/app-chat/conversations/new"
+        request_kwargs = {
+            "headers": {
+                **self.default_headers,
+                "Cookie": token
+            },
+            "data": request_payload,
+            "impersonate": "chrome133a",
+            "stream": True,
+            # 读超时作为底层兜底，首字节与空闲超时由调用方分别控制
+            "timeout": (connect_timeout, max(first_byte_timeout, idle_timeout)),
+            **proxy_options
+        }
+        return url, request_kwargs
+
+    def send_upstream_request(self, token, model, url, request_kwargs, proxy=None):
+        """发送上游请求，启用会话池时复用 (token, proxy) 对应的长连接"""
+        if self.session_pool is None:
+            return curl_requests.post(url, **request_kwargs)
+        _, first_byte_timeout, idle_timeout = config_manager.get_timeouts(model)
+        response = self.session_pool.post(
+            token, proxy.url if proxy is not None else None, url, wait=False, idle_timeout=idle_timeout, **request_kwargs
+        )
+        return self.wait_first_byte(response, first_byte_timeout)
+
+    @staticmethod
+    def wait_first_byte(response, timeout):
+        """等待池化响应的首字节，超时则取消该请求"""
+        if not response.wait_ready(max(timeout, 0)):
+            response.close()
+            raise UpstreamTimeoutError(f"上游超过 {timeout:.0f}s 未返回首字节")
+        return response
+
+    def mark_failed_token(self, token, model, status_code):
+        """根据上游状态码更新令牌状态"""
+        if status_code == 429:
+            self.token_manager.mark_rate_limited(token, model)
+        elif status_code == 401:
+            self.token_manager.mark_invalid(token)
+
+    def dispatch_upstream_request(self, lease, model, request_payload, proxy=None):
+        """发送上游请求，开启对冲时首字节超时后换令牌再发一份，先出数据者胜出
+
+        返回 (response, 实际使用令牌的 TokenLease, 所用代理)；落选令牌的占用在这里归还。
+        """
+        token = lease.token
+        url, request_kwargs = self.build_upstream_request(token, request_payload, model, proxy)
+        hedge = self.hedge_controller
+        if hedge is None:
+            return self.send_upstream_request(token, model, url, request_kwargs, proxy), lease, proxy
+
+        hedge.on_request()
+        _, first_byte_timeout, idle_timeout = config_manager.get_timeouts(model)
+        deadline = time.time() + first_byte_timeout
+        notify = threading.Event()
+        primary = self.session_pool.post(
+            token, proxy.url if proxy is not None else None, url,
+            wait=False, notify=notify, idle_timeout=idle_timeout, **request_kwargs
+        )
+        if primary.wait_ready(min(hedge.get_delay(model), first_byte_timeout)):
+            if primary.status_code == 200:
+                hedge.record_ttfb(model, primary.ttfb)
+            return primary, lease, proxy
+
+        if not hedge.try_acquire():
+            return self.wait_first_byte(primary, deadline - time.time()), lease, proxy
+        hedge_lease = self.token_manager.acquire_token_for_model(model)
+        if hedge_lease is None or hedge_lease.token == token:
+            if hedge_lease is not None:
+                hedge_lease.release()
+            hedge.record("skipped_no_token")
+            return self.wait_first_byte(primary, deadline - time.time()), lease, proxy
+
+        try:
+            response, winner, winner_proxy = self.race_hedged_request(
+                primary, lease, proxy, hedge_lease, model, request_payload, notify, deadline
+            )
+        except BaseException:
+            hedge_lease.release()
+            raise
+        (hedge_lease if winner is lease else lease).release()
+        return response, winner, winner_proxy
+
+    def race_hedged_request(self, primary, lease, proxy, hedge_lease, model, request_payload, notify, deadline):
+        """发出对冲请求并等待两路中先返回数据的一路，返回 (response, 胜出的 TokenLease, 所用代理)"""
+        hedge = self.hedge_controller
+        _, first_byte_timeout, idle_timeout = config_manager.get_timeouts(model)
+        hedge_token = hedge_lease.token
+        hedge_proxy = self.proxy_pool.select(hedge_token)
+        logger.info("首字节超时，发起对冲请求: %.20s...", hedge_token, source="Server")
+        hedge_url, hedge_kwargs = self.build_upstream_request(hedge_token, request_payload, model, hedge_proxy)
+        try:
+            secondary = self.session_pool.post(
+                hedge_token, hedge_proxy.url if hedge_proxy is not None else None, hedge_url,
+                wait=False, notify=notify, idle_timeout=idle_timeout, **hedge_kwargs
+            )
+        except Exception as e:
+            logger.warning("对冲请求发送失败: %.100s", e, source="Server")
+            return self.wait_first_byte(primary, deadline - time.time()), lease, proxy
+
+        pending = [(primary, lease, proxy), (secondary, hedge_lease, hedge_proxy)]
+        failed = []
+        while pending:
+            if not notify.wait(max(deadline - time.time(), 0)):
+                # 两路都未在首字节超时内返回
+                for response, _, _ in pending:
+                    response.close()
+                hedge.record("hedge_losses")
+                raise UpstreamTimeoutError(f"上游超过 {first_byte_timeout:.0f}s 未返回首字节")
+            notify.clear()
+            for candidate in list(pending):
+                response, candidate_lease, candidate_proxy = candidate
+                if not response.ready:
+                    continue
+                pending.remove(candidate)
+                if response.error is None and response.status_code == 200:
+                    # 胜出者之外的请求全部取消，已返回失败的一路在这里记账
+                    for other in pending:
+                        other[0].close()
+                        if other[0].ready:
+                            failed.append(other)
+                    for other, other_lease, other_proxy in failed:
+                        if other.error is not None or other.status_code != 200:
+                            self.record_hedge_failure(other, other_lease.token, other_proxy, model)
+                    hedge.record("hedge_wins" if response is secondary else "hedge_losses")
+                    hedge.record_ttfb(model, response.ttfb)
+                    return response, candidate_lease, candidate_proxy
+                failed.append(candidate)
+
+        # 两路都失败：返回主请求交给重试逻辑，对冲请求的失败在这里记账
+        self.record_hedge_failure(secondary, hedge_token, hedge_proxy, model)
+        hedge.record("hedge_losses")
+        primary.wait_ready()
+        return primary, lease, proxy
+
+    def record_hedge_failure(self, response, token, proxy, model):
+        """记录对冲中落选且失败的一路：更新令牌冷却/失效状态与代理健康状态"""
+        if response.error is None:
+            self.record_upstream_result(token, str(response.status_code))
+            self.mark_failed_token(token, model, response.status_code)
+            if response.status_code == 403:
+                self.proxy_pool.mark_banned(proxy)
+        else:
+            self.record_upstream_result(token, "error")
+            self.proxy_pool.mark_error(proxy)
+
+    def warmup_sessions(self):
+        """按配置为前 N 个令牌预建上游连接"""
+        count = config_manager.get("SESSION_POOL.WARMUP", 0)
+        if self.session_pool is None or count <= 0:
+            return 0
+        tokens = self.token_manager.get_all_tokens()[:count]
+        warmed = 0
+        # 按令牌的代理亲和分组，预建的正是之后请求会复用的 (token, proxy) 连接
+        for proxy, group in self.proxy_pool.group_tokens(tokens).items():
+            warmed += self.session_pool.warmup(
+                group,
+                proxy.url if proxy is not None else None,
+                config_manager.get("API.BASE_URL"),
+                **(proxy.options if proxy is not None else {})
+            )
+        return warmed
+
+    @staticmethod
+    def attach_debug_timing(result, trace):
+        """非流式响应附加调试字段；合并请求的结果是共享的，复制后再修改"""
+        if trace is None or not trace.detailed:
+            return result
+        return {**result, "debug": {"timing": trace.to_dict()}}
+
+    def make_grok_request(self, data, model, stream=False, headers=None, lease=None, trace=None):
+        coalesce = self.get_coalesce_options(data, headers) if stream else None
         
         try:
-            retry_count = 0
-            
-            while retry_count < config_manager.get("RETRY.MAX_ATTEMPTS", 2):
-                retry_count += 1
-                
-                token = self.token_manager.get_next_token_for_model(model)
-                if not token:
-                    raise ValueError('无可用令牌')
-                
-                config_manager.set("API.SIGNATURE_COOKIE", token)
-                logger.info(f"当前令牌: {token[:50]}...", "Server")
-                
-                try:
-                    request_payload = MessageProcessor.prepare_chat_messages(data.get("messages", []), model)
-                    
-                    proxy_options = self.get_proxy_options()
-                    response = curl_requests.post(
-                        f"{config_manager.get('API.BASE_URL')}/rest/app-chat/conversations/new",
-                        headers={
-                            **self.default_headers,
-                            "Cookie": token
-                        },
-                        data=json.dumps(request_payload),
-                        impersonate="chrome133a",
-                        stream=True,
-                        timeout=10,
-                        **proxy_options
-                    )
-                    
-                    logger.info(f"请求状态码: {response.status_code}", "Server")
-                    
-                    if response.status_code == 200:
-                        response_status_code = 200
-                        logger.info("请求成功", "Server")
-                        
-                        if stream:
-                            return Response(
-                                stream_with_context(self.handle_stream_response(response, model)),
-                                content_type='text/event-stream'
-                            )
-                        else:
-                                return self.handle_non_stream_response(response, model)
-                            
-                    elif response.status_code == 403:
-                        response_status_code = 403
-                        logger.error("IP暂时被封禁，请稍后重试或者更换IP", "Server")
-                        raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
-                        
-                    elif response.status_code == 429:
-                        response_status_code = 429
-                        logger.warning(f"令牌配额已用完，继续轮询其他令牌: {token[:20]}...", "Server")
-                    else:
-                        logger.warning(f"令牌返回异常状态码 {response.status_code}，继续轮询: {token[:20]}...", "Server")
-                        
-                except Exception as e:
-                    logger.error(f"请求处理异常: {str(e)}", "Server")
-                    # 检查是否是超时或网络异常，这些通常可以重试
-                    if "timeout" in str(e).lower() or "connection" in str(e).lower():
-                        logger.warning(f"网络异常，继续重试: {str(e)[:100]}", "Server")
-                        continue
-                    else:
-                        # 其他异常直接跳出重试循环
-                        break
-            
-            if response_status_code == 403:
-                raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
-            elif response_status_code == 500:
-                raise ValueError('请求失败，请检查网络连接或稍后重试')    
+            started = time.perf_counter()
+            request_payload, cache_key, cached = self.lookup_response_cache(data, model, headers)
+            if trace is not None and request_payload is not None:
+                trace.since("prepare", started)
+            if cached is not None:
+                return self.replay_cached_response(cached, model, stream)
+
+            def request():
+                # 准入时占用的令牌只交给实际发起上游请求的一方
+                nonlocal lease
+                first_lease, lease = lease, None
+                return self.request_upstream(
+                    data, model, stream, coalesce, request_payload, cache_key, first_lease, trace
+                )
+
+            if self.singleflight is not None:
+                # 相同的并发请求共用一次上游调用
+                result = self.singleflight.do(cache_key, stream, request)
+            else:
+                result = request()
+            if stream:
+                first_frame, frames = result
+                return Response(
+                    stream_with_context(self.handle_stream_response(first_frame, frames, trace)),
+                    content_type='text/event-stream'
+                )
+            return self.attach_debug_timing(result, trace)
                 
         except Exception as error:
-            logger.error(str(error), "ChatAPI")
+            logger.error(str(error), source="ChatAPI")
             raise
-            
+        finally:
+            # 命中缓存或合并到其他请求时未使用的令牌占用
+            if lease is not None:
+                lease.release()
+                lease = None
+
+    @staticmethod
+    def prepare_request_payload(data, model, request_payload=None, trace=None):
+        """请求体每个请求只构造一次，重试时复用"""
+        if request_payload is None:
+            started = time.perf_counter()
+            request_payload = MessageProcessor.prepare_chat_payload(data.get("messages", []), model)
+            if trace is not None:
+                trace.since("prepare", started)
+        return request_payload
+
+    def request_upstream(self, data, model, stream, coalesce, request_payload=None, cache_key=None, lease=None, trace=None):
+        """轮换令牌请求上游直到成功：流式返回 (首帧, 后续帧迭代器)，非流式返回响应字典
+
+        lease 为准入时已占用的令牌，首次尝试使用；之后每次重试重新占用，流式响应的占用在流结束时归还。
+        trace 记录构造请求体、选代理、建连与上游首字节等阶段的耗时（每次尝试各计一次）。
+        """
+        attempts = UpstreamAttempts(self, model, lease, trace)
+        while attempts.next():
+            try:
+                request_payload = self.prepare_request_payload(data, model, request_payload, trace)
+                sent_at = time.perf_counter()
+                response, lease, proxy = self.dispatch_upstream_request(attempts.lease, model, request_payload, attempts.proxy)
+                attempts.use(lease, proxy)
+                ttfb = time.perf_counter() - sent_at
+                if trace is not None:
+                    trace.add("upstream_ttfb", ttfb)
+                    trace.add_connection_timings(response)
+
+                logger.info("请求状态码: %s", response.status_code, source="Server")
+                if response.status_code != 200:
+                    response.close()
+                    if attempts.fail_status(response.status_code):
+                        continue
+                    break
+
+                attempts.accept(ttfb)
+                response = capture.wrap(response, model, stream, attempts.token)
+                if stream:
+                    # 先取到首帧再提交响应，此前失败可换令牌重试（帧迭代器已归还占用，release 可重复调用）
+                    result = self.open_stream(
+                        response, model, coalesce, self.stream_cache_callback(cache_key), attempts.lease.release,
+                        sent_at, trace
+                    )
+                else:
+                    started = time.perf_counter()
+                    result = self.handle_non_stream_response(response, model, trace)
+                    if trace is not None:
+                        trace.since("response", started)
+                    metrics.upstream_duration.observe(time.perf_counter() - sent_at, model)
+                    self.store_response_cache(cache_key, result["choices"][0]["message"]["content"])
+                attempts.succeed(stream)
+                return result
+
+            except Exception as e:
+                if not attempts.fail_error(e):
+                    break
+            finally:
+                attempts.end()
+
+        attempts.raise_error()
+
     def validate_request(self, request_data):
         model = request_data.get("model")
         if not model:
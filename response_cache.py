@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from logger import logger
+
+
+class ResponseCache:
+    """精确匹配的补全结果缓存
+
+    键为模型与规范化后的上游请求体的 SHA-256，值为最终回复（推理模型含 think 标签包裹的思考内容），
+    流式与非流式请求共用，命中时按请求方式输出为非流式响应或重放为 SSE 流。
+    内存中按 LRU 与 TTL 淘汰，并受条目数与字节数限制；配置 disk_path 时，被挤出内存但未过期的条目
+    写入磁盘（每条一个 JSON 文件，同样受字节上限约束，超出时删除最早写入的文件），未命中内存时再查磁盘。
+    """
+
+    def __init__(self, ttl=3600, max_entries=1000, max_size=64 * 1024 * 1024, disk_path=None, disk_max_size=512 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.disk_path = disk_path or None
+        self.disk_max_size = disk_max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.disk_entries = OrderedDict()
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stores": 0,
+            "expired": 0,
+            "evictions": 0,
+            "spills": 0
+        }
+        if self.disk_path:
+            os.makedirs(self.disk_path, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(model, payload):
+        return hashlib.sha256(f"{model}\0{payload}".encode("utf-8", "surrogatepass")).hexdigest()
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, f"{key}.json")
+
+    def _load_disk_index(self):
+        files = []
+        for name in os.listdir(self.disk_path):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.disk_path, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk_entries[key] = size
+            self.disk_size += size
+
+    def get(self, key):
+        """返回缓存的回复文本，未命中或已过期时返回 None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                content, expires_at, size = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return content
+                del self.entries[key]
+                self.size -= size
+                self.stats["expired"] += 1
+            on_disk = key in self.disk_entries
+        if on_disk:
+            content, expires_at = self._read_disk(key)
+            if content is not None:
+                if expires_at > now:
+                    with self.lock:
+                        self.stats["hits"] += 1
+                        self.stats["disk_hits"] += 1
+                    self._put(key, content, expires_at)
+                    return content
+                with self.lock:
+                    self.stats["expired"] += 1
+            self._remove_disk(key)
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def set(self, key, content):
+        with self.lock:
+            self.stats["stores"] += 1
+        self._put(key, content, time.time() + self.ttl)
+
+    def record_bypass(self):
+        with self.lock:
+            self.stats["bypassed"] += 1
+
+    def _put(self, key, content, expires_at):
+        size = len(content.encode("utf-8", "surrogatepass"))
+        if size > self.max_size:
+            return
+        spilled = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (content, expires_at, size)
+            self.size += size
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_size):
+                evicted_key, (evicted, evicted_expires, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.stats["evictions"] += 1
+                spilled.append((evicted_key, evicted, evicted_expires))
+        if self.disk_path:
+            now = time.time()
+            for evicted_key, evicted, evicted_expires in spilled:
+                if evicted_expires > now:
+                    self._write_disk(evicted_key, evicted, evicted_expires)
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_file(key), "r", encoding="utf-8") as f:
+                record = json.load(f)
+            return record["content"], record["expires_at"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("读取响应缓存文件失败: %s", e, source="ResponseCache")
+            return None, 0
+
+    def _write_disk(self, key, content, expires_at):
+        path = self._disk_file(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"content": content, "expires_at": expires_at}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("写入响应缓存文件失败: %s", e, source="ResponseCache")
+            return
+        removed = []
+        with self.lock:
+            self.disk_size -= self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = size
+            self.disk_size += size
+            self.stats["spills"] += 1
+            while self.disk_entries and self.disk_size > self.disk_max_size:
+                old_key, old_size = self.disk_entries.popitem(last=False)
+                self.disk_size -= old_size
+                removed.append(old_key)
+        for old_key in removed:
+            self._unlink(old_key)
+
+    def _remove_disk(self, key):
+        with self.lock:
+            self.disk_size -= self.disk_entries.pop(key, 0)
+        self._unlink(key)
+
+    def _unlink(self, key):
+        try:
+            os.remove(self._disk_file(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            keys = list(self.disk_entries)
+            self.disk_entries.clear()
+            self.disk_size = 0
+        for key in keys:
+            self._unlink(key)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "size": self.size,
+                "disk_entries": len(self.disk_entries),
+                "disk_size": self.disk_size,
+                "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0
+            }
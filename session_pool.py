@@ -0,0 +1,256 @@
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from curl_cffi import requests as curl_requests
+from curl_cffi.const import CurlInfo, CurlOpt
+from curl_cffi.curl import CURL_WRITEFUNC_ERROR
+from logger import logger
+from tracing import curl_timings
+from upstream_errors import UpstreamTimeoutError
+
+_STREAM_END = object()
+
+
+class PooledStreamResponse:
+    """在池化会话上以回调方式读取的流式响应，接口与 curl_cffi 流式响应一致"""
+
+    def __init__(self, pool, key, session, notify=None, idle_timeout=None):
+        self.pool = pool
+        self.key = key
+        self.session = session
+        self.status_code = None
+        self.queue = queue.Queue()
+        self.headers_ready = threading.Event()
+        self.notify = notify
+        self.idle_timeout = idle_timeout
+        self.aborted = False
+        self.error = None
+        self.started_at = time.time()
+        self.ready_at = None
+        # 本次请求的 DNS、建连与 TLS 握手耗时，复用连接时为 0
+        self.timings = None
+
+    def _set_ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.time()
+        self.headers_ready.set()
+        if self.notify is not None:
+            self.notify.set()
+
+    def _on_content(self, chunk):
+        if self.aborted:
+            return CURL_WRITEFUNC_ERROR
+        if self.status_code is None:
+            self.status_code = self.session.curl.getinfo(CurlInfo.RESPONSE_CODE)
+            self.timings = curl_timings(self.session.curl)
+            self._set_ready()
+        self.queue.put(chunk)
+        return len(chunk)
+
+    def _perform(self, url, kwargs):
+        reusable = True
+        try:
+            # 在执行器中排队期间已被调用方放弃（首字节超时或对冲落选）时不再发送
+            if not self.aborted:
+                response = self.session.request("POST", url, content_callback=self._on_content, **kwargs)
+                if self.status_code is None:
+                    self.status_code = response.status_code
+        except Exception as e:
+            # 主动中止不影响会话复用，其余异常丢弃该会话
+            if not self.aborted:
+                self.error = e
+                reusable = False
+        finally:
+            self._set_ready()
+            self.queue.put(_STREAM_END)
+            self.pool.release(self.key, self.session, reusable)
+
+    def start(self, url, kwargs, wait=True):
+        self.pool.executor.submit(self._perform, url, kwargs)
+        if wait:
+            self.wait_ready()
+        return self
+
+    def wait_ready(self, timeout=None):
+        """等待首个响应字节（或请求结束）；请求失败时抛出异常"""
+        if not self.headers_ready.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    @property
+    def ready(self):
+        return self.headers_ready.is_set()
+
+    @property
+    def ttfb(self):
+        return self.ready_at - self.started_at if self.ready_at is not None else None
+
+    def iter_content(self, tick=None):
+        """逐块读取；指定 tick 时每隔 tick 秒无数据产出一次 None，供调用方处理定时任务"""
+        last_data = time.monotonic()
+        while True:
+            timeout = self.idle_timeout
+            if tick is not None:
+                timeout = tick if timeout is None else max(min(tick, last_data + timeout - time.monotonic()), 0)
+            try:
+                chunk = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if tick is not None and (self.idle_timeout is None or time.monotonic() - last_data < self.idle_timeout):
+                    yield None
+                    continue
+                self.close()
+                raise UpstreamTimeoutError(f"上游超过 {self.idle_timeout}s 无数据")
+            last_data = time.monotonic()
+            if chunk is _STREAM_END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield chunk
+
+    def iter_lines(self, tick=None):
+        pending = b""
+        for chunk in self.iter_content(tick):
+            if chunk is None:
+                yield None
+                continue
+            pending += chunk
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def close(self):
+        self.aborted = True
+
+
+class SessionPool:
+    """按 (token, proxy) 复用的长连接会话池
+
+    每个会话持有独立的 curl 句柄，连接与 TLS 会话在同一 key 的请求与重试之间复用；
+    空闲会话数量受 max_size 限制，超过 idle_timeout 的空闲会话会被关闭。
+    请求在有界线程池（max_workers）中执行，线程在请求之间复用；线程都在读取上游时新请求排队等待。
+    """
+
+    def __init__(self, max_size=256, idle_timeout=90, impersonate="chrome133a", max_workers=256):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.impersonate = impersonate
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="upstream")
+        self._idle = OrderedDict()
+        self._idle_count = 0
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _new_session(self):
+        return curl_requests.Session(impersonate=self.impersonate, use_thread_local_curl=False)
+
+    def _close(self, session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def _evict_idle_locked(self, now):
+        expired = []
+        while self._idle:
+            key, sessions = next(iter(self._idle.items()))
+            while sessions and (now - sessions[0][1] > self.idle_timeout or self._idle_count > self.max_size):
+                expired.append(sessions.popleft()[0])
+                self._idle_count -= 1
+            if sessions:
+                break
+            del self._idle[key]
+        self.evictions += len(expired)
+        return expired
+
+    def acquire(self, token, proxy=None):
+        key = (token, proxy)
+        now = time.time()
+        with self._lock:
+            expired = self._evict_idle_locked(now)
+            sessions = self._idle.get(key)
+            session = None
+            if sessions:
+                session = sessions.pop()[0]
+                self._idle_count -= 1
+                if not sessions:
+                    del self._idle[key]
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._in_use += 1
+        for stale in expired:
+            self._close(stale)
+        return key, session or self._new_session()
+
+    def release(self, key, session, reusable=True):
+        expired = []
+        with self._lock:
+            self._in_use -= 1
+            if reusable:
+                self._idle.setdefault(key, deque()).append((session, time.time()))
+                self._idle.move_to_end(key)
+                self._idle_count += 1
+                expired = self._evict_idle_locked(time.time())
+        if not reusable:
+            self._close(session)
+        for stale in expired:
+            self._close(stale)
+
+    def post(self, token, proxy, url, timeout=10, wait=True, notify=None, idle_timeout=None, **kwargs):
+        """在池化会话上发起流式POST，返回 PooledStreamResponse
+
+        timeout 为秒数或 (连接超时, 读超时)；wait=False 时立即返回，
+        调用方通过 wait_ready 或 notify 事件得知首字节到达。
+        idle_timeout 限制读取时相邻数据块的间隔，超时抛出 UpstreamTimeoutError。
+        """
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        key, session = self.acquire(token, proxy)
+        # 回调模式下 timeout 是整体超时，这里改为连接超时 + 低速（读）超时，与原流式语义一致
+        session.curl_options = {
+            CurlOpt.CONNECTTIMEOUT_MS: int(connect_timeout * 1000),
+            CurlOpt.LOW_SPEED_LIMIT: 1,
+            CurlOpt.LOW_SPEED_TIME: math.ceil(read_timeout),
+        }
+        kwargs.pop("stream", None)
+        response = PooledStreamResponse(self, key, session, notify, idle_timeout)
+        return response.start(url, {**kwargs, "timeout": None}, wait)
+
+    def warmup(self, tokens, proxy, url, **kwargs):
+        """预先为给定令牌建立连接"""
+        warmed = 0
+        for token in tokens:
+            key, session = self.acquire(token, proxy)
+            try:
+                session.head(url, timeout=10, **kwargs)
+                self.release(key, session, True)
+                warmed += 1
+            except Exception as e:
+                self.release(key, session, False)
+                logger.warning("会话预热失败: %.100s", e, source="SessionPool")
+        logger.info("会话预热完成: %d/%d", warmed, len(tokens), source="SessionPool")
+        return warmed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle_sessions": self._idle_count,
+                "in_use_sessions": self._in_use,
+                "open_connections": self._idle_count + self._in_use,
+                "keys": len(self._idle),
+                "max_size": self.max_size,
+                "max_workers": self.max_workers
+            }
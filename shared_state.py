@@ -0,0 +1,109 @@
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import zlib
+
+
+class SharedCursor:
+    """多进程共享的轮询游标
+
+    基于 mmap 文件的 64 位计数器，每个模型占一个槽位，读改写由 flock 保护；
+    同一进程内的线程由调用方（令牌管理器的锁）保证互斥。
+    """
+
+    SLOTS = 64
+    SLOT_SIZE = 8
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = self.SLOTS * self.SLOT_SIZE
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.offsets = {}
+
+    def _offset(self, model):
+        offset = self.offsets.get(model)
+        if offset is None:
+            offset = (zlib.crc32(model.encode("utf-8")) % self.SLOTS) * self.SLOT_SIZE
+            self.offsets[model] = offset
+        return offset
+
+    def fetch_add(self, model, delta=1):
+        offset = self._offset(model)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            value = struct.unpack_from("<Q", self.map, offset)[0]
+            struct.pack_into("<Q", self.map, offset, value + delta)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return value
+
+    def advance_to(self, model, value):
+        """把游标推进到至少 value"""
+        offset = self._offset(model)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if struct.unpack_from("<Q", self.map, offset)[0] < value:
+                struct.pack_into("<Q", self.map, offset, value)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class SharedRotation:
+    """多进程模式下的令牌轮询
+
+    令牌按 sso 排序：只要令牌集合相同，各进程的顺序就一致，与增删在各进程中应用的先后无关
+    （并发在不同进程添加令牌时，按插入顺序会得到不同的列表，同一游标位置对应不同令牌）。
+    从共享游标处取一小段连续位置，由本进程的调度器按自己看到的冷却、失效与负载状态选取。
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.order = []
+        self.members = set()
+
+    def add(self, keys):
+        keys = [key for key in dict.fromkeys(keys) if key not in self.members]
+        if not keys:
+            return
+        self.members.update(keys)
+        if len(keys) == 1:
+            bisect.insort(self.order, keys[0])
+        else:
+            self.order.extend(keys)
+            self.order.sort()
+
+    def remove(self, key):
+        if key not in self.members:
+            return
+        self.members.discard(key)
+        del self.order[bisect.bisect_left(self.order, key)]
+
+    def clear(self):
+        self.order = []
+        self.members = set()
+
+    def next(self, model, choose, window):
+        """从共享游标处取至多 window 个连续位置交给 choose，choose 返回选中位置的下标或 None"""
+        size = len(self.order)
+        if not size:
+            return None
+        start = self.cursor.fetch_add(model)
+        keys = [self.order[(start + step) % size] for step in range(min(window, size))]
+        index = choose(keys)
+        if index is None:
+            # 窗口内没有可选令牌，跳过这些位置，下次从窗口之后开始
+            self.cursor.advance_to(model, start + len(keys))
+            return None
+        if index:
+            # 跳过的位置不再分配给其他进程
+            self.cursor.advance_to(model, start + index + 1)
+        return keys[index]
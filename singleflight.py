@@ -0,0 +1,251 @@
+import asyncio
+import threading
+
+from logger import logger
+
+
+class Flight:
+    """一次进行中的上游请求及其订阅者
+
+    流式请求的帧按顺序追加到 frames，由独立的泵（线程或任务）读取上游写入；每个订阅者持有自己的读取位置，
+    按各自的速度消费（慢的订阅者不拖慢上游与其他订阅者），后加入的订阅者先收到已缓冲的前缀。
+    """
+
+    def __init__(self, cond):
+        # 唤醒本次请求的订阅者；同步版与分组共用锁
+        self.cond = cond
+        self.ready = False
+        self.done = False
+        self.error = None
+        self.result = None
+        self.frames = []
+        self.subscribers = 0
+
+
+class SingleFlight:
+    """相同键的并发请求合并为一次上游调用（线程版，供同步处理器使用）
+
+    键为 (请求键, 是否流式)。领头请求执行 fn：非流式时跟随者直接得到同一结果；流式时 fn 返回
+    (首帧, 帧迭代器)，由后台线程把帧写入共享缓冲，领头者与跟随者各自得到一个订阅迭代器。
+    所有订阅者都断开后泵在下一帧到达时停止并关闭上游；只要还有订阅者在读，上游就不会被取消。
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            "leaders": 0,
+            "followers": 0,
+            "abandoned": 0
+        }
+
+    def do(self, key, stream, fn):
+        key = (key, stream)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight(threading.Condition(self.lock))
+                self.stats["leaders"] += 1
+            else:
+                self.stats["followers"] += 1
+            flight.subscribers += 1
+
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._resolve(key, flight, error=e)
+                raise
+            if not stream:
+                self._resolve(key, flight, result=result)
+                return result
+            first_frame, frames = result
+            with self.lock:
+                if first_frame is not None:
+                    flight.frames.append(first_frame)
+                flight.ready = True
+                flight.cond.notify_all()
+            threading.Thread(target=self._pump, args=(key, flight, frames), daemon=True).start()
+        else:
+            logger.info("合并到进行中的相同请求", source="SingleFlight")
+            with self.lock:
+                while not flight.ready:
+                    flight.cond.wait()
+                if flight.error is not None and not stream:
+                    raise flight.error
+                if not stream:
+                    return flight.result
+                if flight.error is not None and not flight.frames:
+                    # 领头请求在首帧前失败
+                    flight.subscribers -= 1
+                    raise flight.error
+        return None, self._subscribe(flight)
+
+    def _resolve(self, key, flight, result=None, error=None):
+        with self.lock:
+            flight.result = result
+            flight.error = error
+            flight.ready = True
+            flight.done = True
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.cond.notify_all()
+
+    def _pump(self, key, flight, frames):
+        try:
+            for frame in frames:
+                with self.lock:
+                    if flight.subscribers == 0:
+                        self.stats["abandoned"] += 1
+                        break
+                    flight.frames.append(frame)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            frames.close()
+            with self.lock:
+                flight.done = True
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.cond.notify_all()
+
+    def _subscribe(self, flight):
+        index = 0
+        try:
+            while True:
+                with self.lock:
+                    while index >= len(flight.frames) and not flight.done:
+                        flight.cond.wait()
+                    batch = flight.frames[index:]
+                    index += len(batch)
+                    finished = flight.done and index >= len(flight.frames)
+                yield from batch
+                if finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            with self.lock:
+                flight.subscribers -= 1
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "in_flight": len(self.flights)}
+
+
+class AsyncSingleFlight:
+    """SingleFlight 的 asyncio 版本
+
+    上游请求与泵在独立任务中执行，领头请求只是第一个订阅者：它的客户端断开（任务被取消）
+    不会影响仍在等待或读取的跟随者。
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.tasks = set()
+        self.stats = {
+            "leaders": 0,
+            "followers": 0,
+            "abandoned": 0
+        }
+
+    async def do(self, key, stream, fn):
+        key = (key, stream)
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(asyncio.Condition())
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(self._run(key, flight, stream, fn))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            self.stats["followers"] += 1
+            logger.info("合并到进行中的相同请求", source="SingleFlight")
+        flight.subscribers += 1
+
+        try:
+            async with flight.cond:
+                await flight.cond.wait_for(lambda: flight.ready)
+        except BaseException:
+            flight.subscribers -= 1
+            raise
+        if not stream or (flight.error is not None and not flight.frames):
+            flight.subscribers -= 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        return None, self._subscribe(flight)
+
+    async def _run(self, key, flight, stream, fn):
+        try:
+            result = await fn()
+        except Exception as e:
+            await self._resolve(key, flight, error=e)
+            return
+        except BaseException as e:
+            await self._resolve(key, flight, error=e)
+            raise
+        if not stream:
+            await self._resolve(key, flight, result=result)
+            return
+        first_frame, frames = result
+        async with flight.cond:
+            if first_frame is not None:
+                flight.frames.append(first_frame)
+            flight.ready = True
+            flight.cond.notify_all()
+        await self._pump(key, flight, frames)
+
+    async def _resolve(self, key, flight, result=None, error=None):
+        async with flight.cond:
+            flight.result = result
+            flight.error = error
+            flight.ready = True
+            flight.done = True
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.cond.notify_all()
+
+    async def _pump(self, key, flight, frames):
+        cond = flight.cond
+        try:
+            async for frame in frames:
+                if flight.subscribers == 0:
+                    self.stats["abandoned"] += 1
+                    break
+                async with cond:
+                    flight.frames.append(frame)
+                    cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            await frames.aclose()
+            async with cond:
+                flight.done = True
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                cond.notify_all()
+
+    async def _subscribe(self, flight):
+        cond = flight.cond
+        index = 0
+        try:
+            while True:
+                async with cond:
+                    await cond.wait_for(lambda: index < len(flight.frames) or flight.done)
+                    batch = flight.frames[index:]
+                    index += len(batch)
+                    finished = flight.done and index >= len(flight.frames)
+                for frame in batch:
+                    yield frame
+                if finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.subscribers -= 1
+
+    def get_stats(self):
+        return {**self.stats, "in_flight": len(self.flights)}
@@ -0,0 +1,121 @@
+import json
+import time
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# C 实现的字符串转义，与 json.dumps 默认输出一致
+_encode_ascii = json.encoder.encode_basestring_ascii
+
+# 短文本上标准库转义更快（orjson 需额外解码），只有较长文本才交给 orjson
+ORJSON_MIN_LENGTH = 128
+
+if orjson is not None:
+    def encode_json_string(text):
+        if len(text) < ORJSON_MIN_LENGTH:
+            return _encode_ascii(text)
+        try:
+            return orjson.dumps(text).decode("utf-8")
+        except orjson.JSONEncodeError:
+            # 上游分片可能切开代理对，orjson 拒绝孤立代理字符
+            return _encode_ascii(text)
+else:
+    encode_json_string = _encode_ascii
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+_CHUNK_SUFFIX = "}}]}\n\n"
+
+
+class ChunkEncoder:
+    """单次补全的SSE帧编码器
+
+    同一补全的所有帧共用 id、created、model，JSON 前缀只构造一次，
+    每帧只转义并拼接增量文本；输出结构与 create_chat_response 的流式格式一致。
+    """
+
+    __slots__ = ("completion_id", "created", "model", "prefix", "recorded", "chars", "frames")
+
+    def __init__(self, model, completion_id=None, created=None):
+        self.completion_id = completion_id or f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time()) if created is None else created
+        self.model = model
+        head = json.dumps({
+            "id": self.completion_id,
+            "created": self.created,
+            "model": model,
+            "object": "chat.completion.chunk"
+        })
+        self.prefix = f'data: {head[:-1]}, "choices": [{{"index": 0, "delta": {{"content": '
+        # 设为列表时记录所有推送的增量文本（用于缓存完整回复）
+        self.recorded = None
+        # 已推送的增量字符数与输出的帧数（指标统计，流结束时一次性上报）
+        self.chars = 0
+        self.frames = 0
+
+    def encode(self, text):
+        return self.prefix + encode_json_string(text) + _CHUNK_SUFFIX
+
+    def push(self, text, frames, flush=False):
+        """追加一个增量，编码出的帧写入 frames"""
+        if self.recorded is not None:
+            self.recorded.append(text)
+        self.chars += len(text)
+        self.frames += 1
+        frames.append(self.prefix + encode_json_string(text) + _CHUNK_SUFFIX)
+
+    def poll(self, frames):
+        """读取间隙调用，输出到期的缓冲内容"""
+
+    def flush(self, frames):
+        """流结束时输出剩余缓冲内容"""
+
+
+class CoalescingChunkEncoder(ChunkEncoder):
+    """合并连续增量的帧编码器
+
+    缓冲文本达到 max_bytes 字节，或距首个缓冲增量超过 interval 秒时合并为一帧输出；
+    首个增量和 flush=True 的增量（思考标签）立即输出，保证首字时间与思考边界不被延后。
+    """
+
+    __slots__ = ("max_bytes", "interval", "buffer", "buffered_bytes", "buffered_at", "started")
+
+    def __init__(self, model, max_bytes=512, interval=0.015, completion_id=None, created=None):
+        super().__init__(model, completion_id, created)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_at = 0.0
+        self.started = False
+
+    def _drain(self, frames):
+        self.frames += 1
+        frames.append(self.prefix + encode_json_string("".join(self.buffer)) + _CHUNK_SUFFIX)
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def push(self, text, frames, flush=False):
+        if self.recorded is not None:
+            self.recorded.append(text)
+        self.chars += len(text)
+        now = time.monotonic()
+        if not self.buffer:
+            self.buffered_at = now
+        self.buffer.append(text)
+        self.buffered_bytes += len(text.encode("utf-8"))
+        if (flush or not self.started or self.buffered_bytes >= self.max_bytes
+                or now - self.buffered_at >= self.interval):
+            self.started = True
+            self._drain(frames)
+
+    def poll(self, frames):
+        if self.buffer and time.monotonic() - self.buffered_at >= self.interval:
+            self._drain(frames)
+
+    def flush(self, frames):
+        if self.buffer:
+            self._drain(frames)
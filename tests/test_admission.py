@@ -0,0 +1,54 @@
+"""准入控制：令牌池为空或全部失效时返回 429 与 Retry-After
+
+用法: python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+from admission import AdmissionController, AdmissionRejected, ApiKeyState  # noqa: E402
+from token_manager import AuthTokenManager  # noqa: E402
+
+TOKENS = ["sso-rw=aaa;sso=aaa", "sso-rw=bbb;sso=bbb"]
+
+
+def new_controller(manager):
+    return AdmissionController({"k": ApiKeyState("k")}, manager, queue_size=10, queue_timeout=30)
+
+
+class AdmissionTest(unittest.TestCase):
+    def check_rejected(self, manager):
+        controller = new_controller(manager)
+        with self.assertRaises(AdmissionRejected) as caught:
+            controller.acquire(controller.authenticate("k"), "grok-3")
+        self.assertEqual(caught.exception.status_code, 429)
+        self.assertEqual(caught.exception.retry_after, 30)
+        self.assertEqual(controller.retry_after("grok-3"), 30)
+        self.assertEqual(controller.get_stats()["rejected_no_token"], 1)
+
+    def test_empty_pool_is_rejected_with_retry_after(self):
+        self.check_rejected(AuthTokenManager())
+
+    def test_all_invalid_tokens_are_rejected_with_retry_after(self):
+        manager = AuthTokenManager()
+        manager.set_tokens(TOKENS, persist=False)
+        for token in TOKENS:
+            manager.mark_invalid(token)
+        self.check_rejected(manager)
+
+    def test_available_token_is_admitted(self):
+        manager = AuthTokenManager()
+        manager.set_tokens(TOKENS, persist=False)
+        controller = new_controller(manager)
+        ticket = controller.acquire(controller.authenticate("k"), "grok-3")
+        self.assertTrue(ticket.granted)
+        ticket.lease.release()
+        ticket.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
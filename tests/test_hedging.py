@@ -0,0 +1,86 @@
+"""对冲请求：落选一路的失败状态同样记到其令牌上
+
+用法: python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+from hedging import HedgeController  # noqa: E402
+from request_handler import RequestHandler  # noqa: E402
+from token_manager import AuthTokenManager, TOKEN_AVAILABLE, TOKEN_COOLING  # noqa: E402
+
+TOKENS = ["sso-rw=aaa;sso=aaa", "sso-rw=bbb;sso=bbb"]
+MODEL = "grok-3"
+
+
+class FakePooledResponse:
+    """已就绪的会话池响应"""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.error = None
+        self.ready = True
+        self.ttfb = 0.01
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def wait_ready(self):
+        pass
+
+
+class FakeSessionPool:
+    def __init__(self, response):
+        self.response = response
+
+    def post(self, token, proxy, url, notify=None, **kwargs):
+        notify.set()
+        return self.response
+
+
+class HedgeRaceTest(unittest.TestCase):
+    def race(self, primary_status, secondary_status):
+        manager = AuthTokenManager()
+        manager.set_tokens(TOKENS, persist=False)
+        handler = RequestHandler(manager)
+        handler.hedge_controller = HedgeController(delay=1)
+        handler.session_pool = FakeSessionPool(FakePooledResponse(secondary_status))
+        lease = manager.acquire_token_for_model(MODEL)
+        hedge_lease = manager.acquire_token_for_model(MODEL)
+        notify = threading.Event()
+        response, winner, _ = handler.race_hedged_request(
+            FakePooledResponse(primary_status), lease, None, hedge_lease, MODEL, {}, notify, time.time() + 5
+        )
+        return manager, lease, hedge_lease, response, winner
+
+    def test_losing_primary_429_cools_its_token(self):
+        manager, lease, hedge_lease, response, winner = self.race(429, 200)
+        self.assertIs(winner, hedge_lease)
+        self.assertEqual(manager.get_token_state(lease.token, MODEL)[0], TOKEN_COOLING)
+        self.assertEqual(manager.get_token_state(hedge_lease.token, MODEL)[0], TOKEN_AVAILABLE)
+
+    def test_losing_hedge_429_cools_its_token(self):
+        manager, lease, hedge_lease, response, winner = self.race(200, 429)
+        self.assertIs(winner, lease)
+        self.assertEqual(manager.get_token_state(hedge_lease.token, MODEL)[0], TOKEN_COOLING)
+        self.assertEqual(manager.get_token_state(lease.token, MODEL)[0], TOKEN_AVAILABLE)
+
+    def test_both_failed_leaves_primary_to_retry_logic(self):
+        manager, lease, hedge_lease, response, winner = self.race(429, 429)
+        self.assertIs(winner, lease)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(manager.get_token_state(hedge_lease.token, MODEL)[0], TOKEN_COOLING)
+        # 主请求的失败由重试逻辑记账
+        self.assertEqual(manager.get_token_state(lease.token, MODEL)[0], TOKEN_AVAILABLE)
+
+
+if __name__ == "__main__":
+    unittest.main()
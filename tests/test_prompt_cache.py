@@ -0,0 +1,54 @@
+"""提示词扁平化缓存：键相同但消息不同的请求不能复用缓存
+
+用法: python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import MessageProcessor  # noqa: E402
+from prompt_cache import PromptCache  # noqa: E402
+
+
+class CollidingCache(PromptCache):
+    """所有前缀都映射到同一组键，模拟 64 位哈希碰撞"""
+
+    @staticmethod
+    def prefix_digests(messages):
+        return list(range(len(messages)))
+
+
+class PromptCacheTest(unittest.TestCase):
+    def test_colliding_prefix_is_not_reused(self):
+        cache = CollidingCache()
+        first = [{"role": "user", "content": "A 的问题"}, {"role": "assistant", "content": "A 的回答"}]
+        second = [{"role": "user", "content": "B 的问题"}, {"role": "assistant", "content": "B 的回答"}]
+        MessageProcessor.flatten_messages(first, cache)
+        self.assertEqual(MessageProcessor.flatten_messages(second, cache), MessageProcessor.flatten_messages(second))
+        self.assertEqual(cache.get_stats()["collisions"], 1)
+
+    def test_longer_conversation_continues_from_prefix(self):
+        cache = PromptCache()
+        messages = [{"role": "user", "content": "问题"}, {"role": "assistant", "content": [{"type": "text", "text": "回答"}]}]
+        MessageProcessor.flatten_messages(messages, cache)
+        longer = [dict(message) for message in messages] + [{"role": "user", "content": "追问"}]
+        self.assertEqual(MessageProcessor.flatten_messages(longer, cache), MessageProcessor.flatten_messages(longer))
+        self.assertEqual(cache.get_stats()["partial_hits"], 1)
+
+    def test_multimodal_contents_count_toward_size_cap(self):
+        cache = PromptCache(max_size=300 * 1024)
+        image = "data:image/png;base64," + "A" * 100 * 1024
+        for i in range(20):
+            content = [{"type": "text", "text": f"第 {i} 张图"}, {"type": "image_url", "image_url": {"url": image + str(i)}}]
+            MessageProcessor.flatten_messages([{"role": "user", "content": content}], cache)
+        self.assertLessEqual(cache.size, cache.max_size)
+        # 扁平化结果只有 "[图片]" 占位，图片数据只在保存的消息里，淘汰必须按它计算
+        retained = sum(len(entry[0][3][0][1][1]["image_url"]["url"]) for entry in cache.entries.values())
+        self.assertLessEqual(retained, cache.max_size)
+        self.assertGreater(cache.get_stats()["evictions"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""响应缓存：流式与非流式请求共用缓存，任一方式写入的结果都能按另一方式返回
+
+用法: python -m pytest tests
+"""
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+from async_request_handler import AsyncRequestHandler  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+from token_manager import AuthTokenManager  # noqa: E402
+
+MODEL = "grok-4"
+DATA = {"messages": [{"role": "user", "content": "hi"}]}
+EXPECTED = "<think>let me think</think>hello world"
+
+
+def ndjson(response):
+    return json.dumps({"result": {"response": response}}).encode() + b"\n"
+
+
+LINES = [
+    ndjson({"token": "Thinking about your request", "isThinking": True, "messageTag": "header"}),
+    ndjson({"token": "let me ", "isThinking": True, "messageTag": "thinking"}),
+    ndjson({"token": "think", "isThinking": True, "messageTag": "thinking"}),
+    ndjson({"token": "hello ", "isThinking": False, "messageTag": "final"}),
+    ndjson({"token": "world", "isThinking": False, "messageTag": "final"}),
+    ndjson({"modelResponse": {"message": "hello world", "thinkingTrace": "let me think"}}),
+]
+
+
+class FakeResponse:
+    status_code = 200
+
+    async def aiter_content(self):
+        for line in LINES:
+            yield line
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        manager = AuthTokenManager()
+        manager.set_tokens(["sso-rw=aaa;sso=aaa"], persist=False)
+        self.handler = AsyncRequestHandler(manager)
+        self.handler.response_cache = ResponseCache()
+        self.upstream_calls = 0
+        test = self
+
+        class Session:
+            async def post(self, url, **kwargs):
+                test.upstream_calls += 1
+                return FakeResponse()
+
+        self.handler.get_session = Session
+
+    def request(self, stream):
+        async def run():
+            result = await self.handler.make_grok_request(dict(DATA), MODEL, stream)
+            if not stream:
+                return result["choices"][0]["message"]["content"]
+            deltas = []
+            async for frame in result:
+                payload = frame[len("data: "):].strip()
+                if payload != "[DONE]":
+                    deltas.append(json.loads(payload)["choices"][0]["delta"]["content"])
+            return deltas
+
+        return asyncio.run(run())
+
+    def test_non_stream_result_replayed_as_stream(self):
+        self.assertEqual(self.request(False), EXPECTED)
+        deltas = self.request(True)
+        self.assertEqual(self.upstream_calls, 1)
+        self.assertEqual("".join(deltas), EXPECTED)
+        # 思考标签单独成帧
+        self.assertEqual(deltas[0], "<think>")
+        self.assertIn("</think>", deltas)
+
+    def test_stream_result_served_as_non_stream(self):
+        self.assertEqual("".join(self.request(True)), EXPECTED)
+        self.assertEqual(self.request(False), EXPECTED)
+        self.assertEqual(self.upstream_calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""帧合并：读取上游时不会按间隔唤醒（未启用会话池）时，缓冲内容不等到下一个数据块
+
+用法: python -m pytest tests
+"""
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+from request_handler import RequestHandler  # noqa: E402
+from token_manager import AuthTokenManager  # noqa: E402
+
+
+def line(text):
+    return json.dumps({"result": {"response": {"token": text, "isThinking": False, "messageTag": "final"}}}).encode() + b"\n"
+
+
+class SlowResponse:
+    """逐块返回上游数据，记录每次读取下一块时已输出的帧"""
+    status_code = 200
+
+    def __init__(self, chunks, emitted):
+        self.chunks = chunks
+        self.emitted = emitted
+        self.seen = []
+
+    def iter_content(self):
+        for chunk in self.chunks:
+            self.seen.append("".join(self.emitted))
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_buffer_flushed_before_next_chunk(self):
+        handler = RequestHandler(AuthTokenManager())
+        emitted = []
+        response = SlowResponse([line("a") + line("b") + line("c"), line("d")], emitted)
+        # 合并间隔足够长，只有按数据块输出才能在读取下一块之前发出 b、c
+        for frame in handler.iter_stream_frames(response, "grok-3", coalesce=(512, 60.0)):
+            emitted.append(json.loads(frame[6:])["choices"][0]["delta"]["content"])
+        self.assertEqual(response.seen[1], "abc")
+        self.assertEqual("".join(emitted), "abcd")
+        self.assertLess(len(emitted), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""流式请求首帧前失败时换令牌重试（同步与异步路径）
+
+用法: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+from async_request_handler import AsyncRequestHandler  # noqa: E402
+from request_handler import RequestHandler  # noqa: E402
+from token_manager import AuthTokenManager, TOKEN_AVAILABLE, TOKEN_COOLING  # noqa: E402
+
+TOKENS = ["sso-rw=aaa;sso=aaa", "sso-rw=bbb;sso=bbb"]
+ERROR_LINES = [b'{"error": {"code": 8, "message": "Too many requests"}}\n']
+OK_LINES = [b'{"result": {"response": {"token": "hi", "isThinking": false, "messageTag": "final"}}}\n']
+DATA = {"messages": [{"role": "user", "content": "hi"}]}
+
+
+class FakeResponse:
+    """上游返回 200，响应体为给定的 NDJSON 行"""
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def iter_content(self):
+        yield from self.lines
+
+    async def aiter_content(self):
+        for line in self.lines:
+            yield line
+
+    def close(self):
+        pass
+
+
+def new_manager():
+    manager = AuthTokenManager()
+    manager.set_tokens(TOKENS, persist=False)
+    return manager
+
+
+class StreamRetryTest(unittest.TestCase):
+    def check(self, manager, sent):
+        self.assertEqual(len(sent), 2)
+        self.assertNotEqual(sent[0], sent[1])
+        self.assertEqual(manager.get_token_state(sent[0], "grok-3")[0], TOKEN_COOLING)
+        self.assertEqual(manager.get_token_state(sent[1], "grok-3")[0], TOKEN_AVAILABLE)
+
+    def test_sync_retry_uses_another_token(self):
+        manager = new_manager()
+        handler = RequestHandler(manager)
+        sent = []
+
+        def dispatch(lease, model, request_payload, proxy=None):
+            sent.append(lease.token)
+            return FakeResponse(ERROR_LINES if len(sent) == 1 else OK_LINES), lease, proxy
+
+        handler.dispatch_upstream_request = dispatch
+        first_frame, frames = handler.request_upstream(DATA, "grok-3", True, None)
+        self.assertIn("hi", first_frame)
+        # 流未结束时只有重试所用令牌的占用
+        self.assertEqual(manager.get_in_flight_total(), 1)
+        list(frames)
+        self.assertEqual(manager.get_in_flight_total(), 0)
+        self.check(manager, sent)
+
+    def test_async_retry_uses_another_token(self):
+        manager = new_manager()
+        handler = AsyncRequestHandler(manager)
+        sent = []
+
+        class Session:
+            async def post(self, url, **kwargs):
+                sent.append(kwargs["headers"]["Cookie"])
+                return FakeResponse(ERROR_LINES if len(sent) == 1 else OK_LINES)
+
+        handler.get_session = Session
+
+        async def run():
+            first_frame, frames = await handler.request_upstream(DATA, "grok-3", True, None)
+            self.assertIn("hi", first_frame)
+            self.assertEqual(manager.get_in_flight_total(), 1)
+            async for _ in frames:
+                pass
+
+        asyncio.run(run())
+        self.assertEqual(manager.get_in_flight_total(), 0)
+        self.check(manager, sent)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""多进程模式的令牌选取：N 个令牌管理器共用轮询游标时突发请求均匀分布，且与单进程一样优先进行中请求较少的令牌
+
+每个 AuthTokenManager 代表一个工作进程（各自的调度器与进行中计数），共用同一个游标文件。
+
+用法: python -m pytest tests
+"""
+import os
+import random
+import sys
+import tempfile
+import unittest
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN_DB_PATH", "")
+
+from shared_state import SharedCursor, SharedRotation  # noqa: E402
+from token_manager import AuthTokenManager, SHARED_SCAN_WINDOW  # noqa: E402
+
+MODEL = "grok-3"
+
+
+def token(i):
+    return f"sso-rw=mp{i:03d};sso=mp{i:03d}"
+
+
+class SharedSpreadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cursors = []
+
+    def tearDown(self):
+        for cursor in self.cursors:
+            cursor.close()
+        self.tmp.cleanup()
+
+    def new_workers(self, count, tokens):
+        workers = []
+        for _ in range(count):
+            cursor = SharedCursor(os.path.join(self.tmp.name, "tokens.db.cursor"))
+            self.cursors.append(cursor)
+            manager = AuthTokenManager(shared=SharedRotation(cursor))
+            manager.set_tokens(tokens, persist=False)
+            workers.append(manager)
+        return workers
+
+    def test_bursts_spread_evenly_across_workers(self):
+        worker_count, token_count, rounds = 4, 32, 5
+        workers = self.new_workers(worker_count, [token(i) for i in range(token_count)])
+        rng = random.Random(1)
+        totals = Counter()
+        for _ in range(rounds):
+            # 一轮突发的请求数等于令牌数，请求随机落在各进程上，整轮结束前都不归还
+            leases = [rng.choice(workers).acquire_token_for_model(MODEL) for _ in range(token_count)]
+            burst = Counter(lease.token for lease in leases)
+            self.assertLessEqual(max(burst.values()), 2)
+            totals.update(burst)
+            for lease in leases:
+                lease.release()
+        counts = [totals.get(token(i), 0) for i in range(token_count)]
+        self.assertLessEqual(max(counts) - min(counts), worker_count)
+
+    def test_shared_mode_prefers_least_outstanding(self):
+        manager, = self.new_workers(1, [token(0), token(1)])
+        busy = manager.acquire_token_for_model(MODEL)
+        other = manager.acquire_token_for_model(MODEL)
+        self.assertNotEqual(busy.token, other.token)
+        other.release()
+        # 游标回到 busy 令牌，但它还有进行中的请求
+        lease = manager.acquire_token_for_model(MODEL)
+        self.assertEqual(lease.token, other.token)
+        lease.release()
+        busy.release()
+
+    def test_cooling_window_falls_back_to_local_scheduler(self):
+        tokens = [token(i) for i in range(SHARED_SCAN_WINDOW * 3)]
+        manager, = self.new_workers(1, tokens)
+        for cookie in tokens[:-1]:
+            manager.mark_rate_limited(cookie, MODEL, 600)
+        lease = manager.acquire_token_for_model(MODEL)
+        self.assertEqual(lease.token, tokens[-1])
+        lease.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
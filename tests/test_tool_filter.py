@@ -0,0 +1,58 @@
+"""工具输出过滤器：任意分块边界上的结果与整段参考结果一致（固定种子的模糊检查），以及工具卡片片段的处理
+
+用法: python -m pytest tests
+"""
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fuzz_tool_filter import make_stream, reference, run_filter, split  # noqa: E402
+from message_processor import ToolOutputFilter  # noqa: E402
+from upstream_events import UpstreamEvent, EVENT_THINKING  # noqa: E402
+
+CARD = ('<xai:tool_usage_card>\n<xai:tool_name>web_search</xai:tool_name>\n'
+        '<xai:tool_args><![CDATA[{"query": "天气"}]]></xai:tool_args>\n</xai:tool_usage_card>')
+
+
+def thinking(text, tag="thinking"):
+    return UpstreamEvent(EVENT_THINKING, text, tag, True)
+
+
+class ToolFilterTest(unittest.TestCase):
+    def test_random_splits_match_reference(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            text = make_stream(rng)
+            expected = reference(text)
+            for _ in range(10):
+                chunks = split(rng, text)
+                self.assertEqual(run_filter(chunks), expected, chunks)
+
+    def test_card_in_thinking_text_keeps_query(self):
+        tool_filter = ToolOutputFilter()
+        self.assertEqual(tool_filter.feed_event(thinking("搜索" + CARD + "完成")), '搜索\n{"query": "天气"}\n完成')
+
+    def test_duplicate_card_event_is_dropped(self):
+        tool_filter = ToolOutputFilter()
+        self.assertEqual(tool_filter.feed_event(thinking(CARD, "tool_usage_card")), '')
+        self.assertEqual(tool_filter.feed_event(thinking("之后的文本")), "之后的文本")
+
+    def test_card_event_split_across_events(self):
+        tool_filter = ToolOutputFilter()
+        half = len(CARD) // 2
+        self.assertEqual(tool_filter.feed_event(thinking(CARD[:half], "tool_usage_card")), '')
+        self.assertEqual(tool_filter.feed_event(thinking(CARD[half:], "tool_usage_card")), '')
+        self.assertEqual(tool_filter.feed_event(thinking("之后的文本")), "之后的文本")
+
+    def test_card_tagged_event_without_markup_passes_through(self):
+        tool_filter = ToolOutputFilter()
+        self.assertEqual(tool_filter.feed_event(thinking("正在搜索", "tool_usage_card")), "正在搜索")
+
+
+if __name__ == "__main__":
+    unittest.main()
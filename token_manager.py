@@ -1,164 +1,732 @@
 import os
+import gc
+import time
+import heapq
+import threading
 from logger import logger
+from config import config_manager
 
+TOKEN_AVAILABLE = "available"
+TOKEN_COOLING = "cooling"
+TOKEN_INVALID = "invalid"
+# 可用令牌都达到并发上限时，准入控制按该间隔（秒）重新检查
+CAPACITY_RETRY_INTERVAL = 0.1
+# 多进程模式下从共享游标处最多查看的连续位置数，其中没有可选令牌时改用本进程的调度顺序
+SHARED_SCAN_WINDOW = 8
+
+
+class ModelTokenScheduler:
+    """单个模型的令牌调度器
+
+    可用令牌按最近一次使用的序号放入小顶堆，每次取最久未使用的令牌（等价于轮询）；
+    冷却中的令牌放入按到期时间排序的堆，到期后自动回到可用堆。堆中过期条目惰性丢弃。
+    有令牌正在处理请求时改为二选一：在最久未使用的两个未达并发上限的令牌中取进行中请求较少者。
+    """
 
-class AuthTokenManager:
     def __init__(self):
-        self.tokens = []
-        self.current_index = 0
-        self.last_round_index = -1
-        
+        self.ready = []
+        self.cooling = []
+        self.states = {}
+        self.seq = 0
+
+    def _push_ready(self, token, state):
+        self.seq += 1
+        state[2] = self.seq
+        heapq.heappush(self.ready, (self.seq, token))
+        # 过期条目过多时按当前状态重建堆
+        if len(self.ready) > 2 * len(self.states) + 64:
+            self.ready = [(st[2], t) for t, st in self.states.items() if st[0] == TOKEN_AVAILABLE]
+            heapq.heapify(self.ready)
+
+    def add_many(self, tokens, invalid_tokens=()):
+        """批量加入令牌，按给定顺序排在轮询末尾"""
+        states = self.states
+        ready = self.ready
+        seq = self.seq
+        for token in tokens:
+            if token in states:
+                continue
+            if token in invalid_tokens:
+                states[token] = [TOKEN_INVALID, 0, 0]
+                continue
+            seq += 1
+            states[token] = [TOKEN_AVAILABLE, 0, seq]
+            # 新序号均大于堆中已有序号，直接追加仍满足堆性质
+            ready.append((seq, token))
+        self.seq = seq
+
+    def remove(self, token):
+        self.states.pop(token, None)
+
+    def promote(self, now):
+        while self.cooling and self.cooling[0][0] <= now:
+            until, token = heapq.heappop(self.cooling)
+            state = self.states.get(token)
+            if state and state[0] == TOKEN_COOLING and state[1] == until:
+                state[0] = TOKEN_AVAILABLE
+                state[1] = 0
+                self._push_ready(token, state)
+
+    def next(self, now, load=None, max_load=0, choices=2):
+        """取下一个令牌；load 为各令牌进行中的请求数，max_load 为单令牌并发上限（0 不限制），
+        choices 为参与比较的最久未使用令牌个数（1 即跳过达到上限令牌的轮询）"""
+        self.promote(now)
+        if not load:
+            while self.ready:
+                seq, token = self.ready[0]
+                state = self.states.get(token)
+                if state is None or state[0] != TOKEN_AVAILABLE or state[2] != seq:
+                    heapq.heappop(self.ready)
+                    continue
+                self.seq += 1
+                state[2] = self.seq
+                heapq.heapreplace(self.ready, (self.seq, token))
+                return token
+            return None
+
+        ready = self.ready
+        skipped = []
+        best = None
+        best_load = 0
+        candidates = 0
+        while ready and candidates < choices:
+            entry = heapq.heappop(ready)
+            seq, token = entry
+            state = self.states.get(token)
+            if state is None or state[0] != TOKEN_AVAILABLE or state[2] != seq:
+                continue
+            outstanding = load.get(token, 0)
+            if max_load and outstanding >= max_load:
+                skipped.append(entry)
+                continue
+            candidates += 1
+            if best is None or outstanding < best_load:
+                if best is not None:
+                    skipped.append(best)
+                best, best_load = entry, outstanding
+            else:
+                skipped.append(entry)
+        # 未选中的令牌保持原序号放回，不改变轮询顺序
+        for entry in skipped:
+            heapq.heappush(ready, entry)
+        if best is None:
+            return None
+        token = best[1]
+        self._push_ready(token, self.states[token])
+        return token
+
+    def choose(self, tokens, load=None, max_load=0, choices=2):
+        """按给定的轮询顺序（多进程模式下的共享游标顺序）选取令牌，返回选中令牌的下标，没有可选令牌时返回 None
+
+        与 next 的选取规则相同：没有进行中的请求时取第一个可用令牌，否则在前 choices 个未达并发上限的
+        可用令牌中取进行中请求较少者。选中的令牌同时移到本进程轮询顺序的末尾。
+        """
+        states = self.states
+        best = None
+        best_load = 0
+        candidates = 0
+        for index, token in enumerate(tokens):
+            state = states.get(token)
+            if state is None or state[0] != TOKEN_AVAILABLE:
+                continue
+            outstanding = load.get(token, 0) if load else 0
+            if max_load and outstanding >= max_load:
+                continue
+            candidates += 1
+            if best is None or outstanding < best_load:
+                best, best_load = index, outstanding
+            if not load or candidates >= choices:
+                break
+        if best is not None:
+            self._push_ready(tokens[best], states[tokens[best]])
+        return best
+
+    def has_available(self, now, load=None, max_load=0):
+        """是否有未达并发上限的可用令牌，不改变轮询顺序"""
+        self.promote(now)
+        while self.ready:
+            seq, token = self.ready[0]
+            state = self.states.get(token)
+            if state is not None and state[0] == TOKEN_AVAILABLE and state[2] == seq:
+                break
+            heapq.heappop(self.ready)
+        else:
+            return False
+        if not load or not max_load or load.get(self.ready[0][1], 0) < max_load:
+            return True
+        states = self.states
+        for seq, token in self.ready:
+            state = states.get(token)
+            if state is not None and state[0] == TOKEN_AVAILABLE and state[2] == seq and load.get(token, 0) < max_load:
+                return True
+        return False
+
+    def cool(self, token, until):
+        state = self.states.get(token)
+        if state is None or state[0] == TOKEN_INVALID:
+            return
+        state[0] = TOKEN_COOLING
+        state[1] = until
+        heapq.heappush(self.cooling, (until, token))
+
+    def invalidate(self, token):
+        state = self.states.get(token)
+        if state is not None:
+            state[0] = TOKEN_INVALID
+            state[1] = 0
+
+    def restore(self, token):
+        state = self.states.get(token)
+        if state is not None and state[0] != TOKEN_AVAILABLE:
+            state[0] = TOKEN_AVAILABLE
+            state[1] = 0
+            self._push_ready(token, state)
+
+    def is_available(self, token):
+        state = self.states.get(token)
+        return state is not None and state[0] == TOKEN_AVAILABLE
+
+    def get_state(self, token, now):
+        self.promote(now)
+        state = self.states.get(token)
+        if state is None:
+            return TOKEN_AVAILABLE, 0
+        return state[0], state[1]
+
+    def soonest_available(self, now):
+        """最早结束冷却的时间，没有冷却中的令牌时返回 None"""
+        self.promote(now)
+        while self.cooling:
+            until, token = self.cooling[0]
+            state = self.states.get(token)
+            if state and state[0] == TOKEN_COOLING and state[1] == until:
+                return until
+            heapq.heappop(self.cooling)
+        return None
+
+
+def parse_sso(cookie):
+    """从cookie字符串中提取sso值，没有sso字段时返回整个字符串"""
+    start = cookie.find("sso=")
+    # 跳过 "sso-rw=" 中不属于 sso 字段的匹配
+    while start > 0 and cookie[start - 1] not in "; ":
+        start = cookie.find("sso=", start + 4)
+    if start < 0:
+        return cookie
+    start += 4
+    end = cookie.find(";", start)
+    return cookie[start:end if end >= 0 else len(cookie)].strip()
+
+
+class TokenRecord:
+    """令牌记录：完整cookie与解析一次后的sso值"""
+    __slots__ = ("cookie", "sso")
+
+    def __init__(self, cookie, sso=None):
+        self.cookie = cookie
+        self.sso = sso if sso is not None else parse_sso(cookie)
+
+
+class TokenLease:
+    """一次令牌占用，release 可重复调用"""
+    __slots__ = ("manager", "sso", "token", "released")
+
+    def __init__(self, manager, sso, token):
+        self.manager = manager
+        self.sso = sso
+        self.token = token
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.manager.release_lease(self.sso)
+
+
+class AuthTokenManager:
+    """令牌存储
+
+    records 以 sso 为键（插入顺序即令牌序号），cookie_index 以完整 cookie 为键，
+    增删查均为 O(1)；所有状态变更与轮询在同一把锁内完成。
+    配置了 storage 时令牌列表与冷却/失效状态会持久化，写入在锁外进行。
+    配置了 shared（多进程模式）时，候选令牌的顺序取自跨进程共享游标，选取规则与单进程相同，
+    其他进程的增删与冷却通过存储的变更日志按 SHARED_SYNC_INTERVAL 增量同步。
+    in_flight 记录各令牌进行中的上游请求数（按进程统计），由 acquire_token_for_model 占用、
+    TokenLease.release 归还，选取令牌时用于负载均衡与 TOKEN.MAX_CONCURRENCY 限制。
+    health 保存 TokenProber 最近一次检查的结果（检查时间、耗时、剩余额度）。
+    """
+
+    def __init__(self, storage=None, shared=None):
+        self.records = {}
+        self.cookie_index = {}
+        self.schedulers = {}
+        self.invalid_tokens = set()
+        self.in_flight = {}
+        # 后台健康检查的最近结果，以 sso 为键（按进程保存，不持久化）
+        self.health = {}
+        self.lock = threading.Lock()
+        self.storage = storage
+        self.shared = shared
+        self.sync_lock = threading.Lock()
+        self.last_event_id = 0
+        self.last_sync = 0
+        self.sync_thread = None
+
+    def _persist(self, method, *args):
+        if self.storage is None:
+            return
+        try:
+            getattr(self.storage, method)(*args)
+        except Exception as error:
+            logger.error("令牌持久化失败: %s", error, source="TokenManager")
+
+    def load_from_storage(self):
+        """从持久化存储恢复令牌及其冷却/失效状态"""
+        if self.storage is None:
+            return 0
+        rows, states, last_event_id = self.storage.load()
+        now = time.time()
+        # 大批量创建小对象时暂停分代GC，避免反复扫描整个令牌池
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._restore_records(rows, states, now)
+            self.last_event_id = last_event_id
+        finally:
+            if gc_enabled:
+                gc.enable()
+        logger.info("从存储恢复令牌: %d个，状态: %d条", len(rows), len(states), source="TokenManager")
+        return len(rows)
+
+    def _restore_records(self, rows, states, now, reset=False):
+        with self.lock:
+            if reset:
+                self.records = {}
+                self.cookie_index = {}
+                self.schedulers = {}
+                self.invalid_tokens = set()
+                if self.shared is not None:
+                    self.shared.clear()
+            self._insert_locked([TokenRecord(cookie, sso) for sso, cookie in rows])
+            for sso, model, status, until in states:
+                if sso not in self.records:
+                    continue
+                if status == TOKEN_INVALID and model == self.storage.ALL_MODELS:
+                    self.invalid_tokens.add(sso)
+                    for scheduler in self.schedulers.values():
+                        scheduler.invalidate(sso)
+                elif status == TOKEN_INVALID:
+                    self._get_scheduler(model).invalidate(sso)
+                elif status == TOKEN_COOLING and until > now:
+                    self._get_scheduler(model).cool(sso, until)
+
+    @staticmethod
+    def format_token(token_str):
+        if isinstance(token_str, dict):
+            token_str = token_str.get("token", "")
+        if not token_str:
+            return ""
+        # 如果输入的是完整的cookie字符串，直接使用
+        if 'sso=' in token_str and 'sso-rw=' in token_str:
+            return token_str
+        # 如果只是cookie值，构造完整的cookie字符串
+        return f"sso-rw={token_str};sso={token_str}"
+
+    def _find_record(self, token):
+        record = self.cookie_index.get(token)
+        if record is None:
+            record = self.records.get(token) or self.records.get(parse_sso(token))
+        return record
+
+    def _get_scheduler(self, model_id):
+        scheduler = self.schedulers.get(model_id)
+        if scheduler is None:
+            scheduler = ModelTokenScheduler()
+            scheduler.add_many(self.records.keys(), self.invalid_tokens)
+            self.schedulers[model_id] = scheduler
+        return scheduler
+
+    def _insert_locked(self, records):
+        for record in records:
+            self.records[record.sso] = record
+            self.cookie_index[record.cookie] = record
+        keys = [record.sso for record in records]
+        for scheduler in self.schedulers.values():
+            scheduler.add_many(keys)
+        if self.shared is not None:
+            self.shared.add(keys)
+
+    def _remove_locked(self, record):
+        del self.records[record.sso]
+        self.cookie_index.pop(record.cookie, None)
+        self.invalid_tokens.discard(record.sso)
+        self.health.pop(record.sso, None)
+        for scheduler in self.schedulers.values():
+            scheduler.remove(record.sso)
+        if self.shared is not None:
+            self.shared.remove(record.sso)
+
+    @property
+    def tokens(self):
+        return self.get_all_tokens()
+
     def add_token(self, token_str):
         if isinstance(token_str, dict):
             token_str = token_str.get("token", "")
-        
-        if token_str and token_str not in self.tokens:
-            self.tokens.append(token_str)
-            self.current_index = 0
-            self.last_round_index = -1
-            logger.info(f"令牌添加成功: {token_str[:20]}...", "TokenManager")
-            return True
-        return False
-    
+        if not token_str:
+            return False
+
+        record = TokenRecord(token_str)
+        with self.lock:
+            if record.sso in self.records:
+                return False
+            self._insert_locked([record])
+        self._persist("add_tokens", [record])
+        logger.info("令牌添加成功: %.20s...", token_str, source="TokenManager")
+        return True
+
     def add_tokens_batch(self, token_strs):
         """批量添加tokens，优化性能"""
         if not token_strs:
             return {"success": 0, "failed": 0, "duplicates": 0}
-        
+
         # 转换为列表如果是其他类型
         if isinstance(token_strs, str):
             token_strs = [token_strs]
-        
-        # 使用set进行快速去重检查
-        existing_tokens_set = set(self.tokens)
-        new_tokens = []
-        duplicates = 0
+
+        parsed = []
         failed = 0
-        
         for token_str in token_strs:
-            if isinstance(token_str, dict):
-                token_str = token_str.get("token", "")
-            
-            if not token_str:
+            formatted_token = self.format_token(token_str)
+            if not formatted_token:
                 failed += 1
                 continue
-                
-            # 如果输入的是完整的cookie字符串，直接使用
-            if 'sso=' in token_str and 'sso-rw=' in token_str:
-                formatted_token = token_str
-            else:
-                # 如果只是cookie值，构造完整的cookie字符串
-                formatted_token = f"sso-rw={token_str};sso={token_str}"
-            
-            if formatted_token in existing_tokens_set:
-                duplicates += 1
-            else:
-                new_tokens.append(formatted_token)
-                existing_tokens_set.add(formatted_token)
-        
-        # 批量添加新tokens
-        if new_tokens:
-            self.tokens.extend(new_tokens)
-            # 只在最后重置索引一次
-            self.current_index = 0
-            self.last_round_index = -1
-            logger.info(f"批量添加令牌完成: 成功 {len(new_tokens)} 个，重复 {duplicates} 个，失败 {failed} 个", "TokenManager")
-        
+            parsed.append(TokenRecord(formatted_token))
+
+        new_records = []
+        with self.lock:
+            seen = set()
+            for record in parsed:
+                if record.sso in self.records or record.sso in seen:
+                    continue
+                seen.add(record.sso)
+                new_records.append(record)
+            if new_records:
+                self._insert_locked(new_records)
+        if new_records:
+            self._persist("add_tokens", new_records)
+        duplicates = len(parsed) - len(new_records)
+
+        if new_records:
+            logger.info("批量添加令牌完成: 成功 %d 个，重复 %d 个，失败 %d 个", len(new_records), duplicates, failed, source="TokenManager")
+
         return {
-            "success": len(new_tokens), 
-            "failed": failed, 
+            "success": len(new_records),
+            "failed": failed,
             "duplicates": duplicates
         }
-        
+
     def set_token(self, token_str):
         if isinstance(token_str, dict):
             token_str = token_str.get("token", "")
-            
-        self.tokens = [token_str]
-        self.current_index = 0
-        self.last_round_index = -1
-        logger.info(f"设置单个令牌: {token_str[:20]}...", "TokenManager")
+
+        self.set_tokens([token_str])
+        logger.info("设置单个令牌: %.20s...", token_str, source="TokenManager")
+
+    def set_tokens(self, token_strs, persist=True):
+        """整体替换令牌列表，保留仍存在令牌的冷却/失效状态"""
+        incoming = {}
+        for token_str in token_strs:
+            record = TokenRecord(token_str)
+            incoming.setdefault(record.sso, record)
+        with self.lock:
+            removed = [sso for sso in self.records if sso not in incoming]
+            for sso in removed:
+                self._remove_locked(self.records[sso])
+            added = [record for sso, record in incoming.items() if sso not in self.records]
+            self._insert_locked(added)
+        if persist:
+            if removed:
+                self._persist("delete_tokens", removed)
+            if added:
+                self._persist("add_tokens", added)
 
     def delete_token(self, token):
         try:
             if isinstance(token, dict):
                 token = token.get("token", "")
-            
-            # 首先尝试直接匹配
-            if token in self.tokens:
-                self.tokens.remove(token)
-                # 重置轮询状态以避免索引越界
-                self.current_index = 0
-                self.last_round_index = -1
-                logger.info(f"令牌已成功移除: {token[:20]}...", "TokenManager")
+
+            # 支持完整cookie字符串或sso值
+            with self.lock:
+                record = self._find_record(token)
+                if record is not None:
+                    self._remove_locked(record)
+            if record is not None:
+                self._persist("delete_tokens", [record.sso])
+                logger.info("令牌已成功移除: %.20s...", record.cookie, source="TokenManager")
                 return True
-            
-            # 如果直接匹配失败，尝试通过SSO值匹配完整token
-            for stored_token in self.tokens[:]:  # 创建副本以避免在迭代时修改列表
-                if "sso=" in stored_token:
-                    sso_value = stored_token.split("sso=")[1].split(";")[0]
-                    if sso_value == token:
-                        self.tokens.remove(stored_token)
-                        # 重置轮询状态以避免索引越界
-                        self.current_index = 0
-                        self.last_round_index = -1
-                        logger.info(f"令牌已成功移除: {stored_token[:20]}...", "TokenManager")
-                        return True
-            
-            logger.warning(f"未找到要删除的令牌: {token[:20]}...", "TokenManager")
+
+            logger.warning("未找到要删除的令牌: %.20s...", token, source="TokenManager")
             return False
         except Exception as error:
-            logger.error(f"令牌删除失败: {str(error)}", "TokenManager")
+            logger.error("令牌删除失败: %s", error, source="TokenManager")
             return False
-    
+
+    def start_background_sync(self):
+        """多进程模式下由后台线程按 SHARED_SYNC_INTERVAL 同步变更日志，准入与选取令牌时不再读取 SQLite"""
+        if self.shared is None or self.storage is None or self.sync_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(config_manager.get("TOKEN.SHARED_SYNC_INTERVAL", 0.2))
+                self.sync_shared_state(force=True)
+
+        self.sync_thread = threading.Thread(target=run, name="token-sync", daemon=True)
+        self.sync_thread.start()
+
+    def sync_shared_state(self, force=False):
+        """多进程模式下应用其他进程写入的变更日志；后台同步线程运行时只在 force 时同步"""
+        if self.shared is None or self.storage is None:
+            return
+        if not force and self.sync_thread is not None:
+            return
+        now = time.time()
+        if not force and now - self.last_sync < config_manager.get("TOKEN.SHARED_SYNC_INTERVAL", 0.2):
+            return
+        # 同一时刻只需一个线程同步，其余线程直接使用当前视图
+        if not self.sync_lock.acquire(blocking=force):
+            return
+        try:
+            self.last_sync = now
+            events = self.storage.read_events(self.last_event_id)
+            if events is None:
+                # 所需日志已被压缩，重新全量加载
+                rows, states, last_event_id = self.storage.load()
+                self._restore_records(rows, states, now, reset=True)
+                self.last_event_id = last_event_id
+                return
+            if events:
+                with self.lock:
+                    for event in events:
+                        self._apply_event_locked(event, now)
+                self.last_event_id = events[-1][0]
+                keep = config_manager.get("TOKEN.SHARED_EVENT_RETENTION", 100000)
+                if self.last_event_id % keep < len(events):
+                    self.storage.compact_events(keep)
+        except Exception as error:
+            logger.error("同步共享令牌状态失败: %s", error, source="TokenManager")
+        finally:
+            self.sync_lock.release()
+
+    def _apply_event_locked(self, event, now):
+        _, kind, sso, model, status, until, cookie = event
+        if kind == "add":
+            if sso not in self.records:
+                self._insert_locked([TokenRecord(cookie, sso)])
+        elif kind == "delete":
+            record = self.records.get(sso)
+            if record is not None:
+                self._remove_locked(record)
+        elif sso not in self.records:
+            return
+        elif kind == "state":
+            if status == TOKEN_INVALID and model == self.storage.ALL_MODELS:
+                self.invalid_tokens.add(sso)
+                for scheduler in self.schedulers.values():
+                    scheduler.invalidate(sso)
+            elif status == TOKEN_INVALID:
+                self._get_scheduler(model).invalidate(sso)
+            elif status == TOKEN_COOLING and until > now:
+                self._get_scheduler(model).cool(sso, until)
+        elif kind == "clear":
+            if model is None:
+                self.invalid_tokens.discard(sso)
+                for scheduler in self.schedulers.values():
+                    scheduler.restore(sso)
+            else:
+                self._get_scheduler(model).restore(sso)
+
+    def _next_locked(self, model_id):
+        scheduler = self._get_scheduler(model_id)
+        max_load = config_manager.get("TOKEN.MAX_CONCURRENCY", 0)
+        in_flight = self.in_flight
+        round_robin = config_manager.get("TOKEN.SELECTION", "least_outstanding") == "round_robin"
+        load = in_flight if max_load or not round_robin else None
+        choices = 1 if round_robin else 2
+        now = time.time()
+        if self.shared is not None:
+            scheduler.promote(now)
+            sso = self.shared.next(
+                model_id, lambda tokens: scheduler.choose(tokens, load, max_load, choices), SHARED_SCAN_WINDOW
+            )
+            if sso is not None:
+                return sso
+        return scheduler.next(now, load, max_load, choices)
+
     def get_next_token_for_model(self, model_id):
-        if not self.tokens:
-            return None
-            
-        # 检查是否开始新的一轮轮询
-        if self.current_index == 0 and self.last_round_index != -1:
-            # 开始新一轮轮询，重置索引
-            self.current_index = 0
-        else:
-            # 记录上一轮的最后索引
-            if self.current_index == len(self.tokens) - 1:
-                self.last_round_index = self.current_index
-        
-        # 按序号依次轮询
-        token = self.tokens[self.current_index]
-        
-        # 移动到下一个索引
-        self.current_index = (self.current_index + 1) % len(self.tokens)
-        
-        return token
+        """选取该模型下最久未使用的可用令牌，跳过冷却中、失效与达到并发上限的令牌"""
+        self.sync_shared_state()
+        with self.lock:
+            if not self.records:
+                return None
+            sso = self._next_locked(model_id)
+            return self.records[sso].cookie if sso is not None else None
+
+    def acquire_token_for_model(self, model_id):
+        """选取令牌并计入进行中的请求，返回 TokenLease，请求结束时调用其 release"""
+        self.sync_shared_state()
+        with self.lock:
+            if not self.records:
+                return None
+            sso = self._next_locked(model_id)
+            if sso is None:
+                return None
+            self.in_flight[sso] = self.in_flight.get(sso, 0) + 1
+            return TokenLease(self, sso, self.records[sso].cookie)
+
+    def release_lease(self, sso):
+        with self.lock:
+            count = self.in_flight.get(sso, 0) - 1
+            if count > 0:
+                self.in_flight[sso] = count
+            else:
+                self.in_flight.pop(sso, None)
+
+    def mark_rate_limited(self, token, model_id, cooldown=None):
+        """令牌在该模型上返回429，进入冷却，到期后自动恢复"""
+        if cooldown is None:
+            cooldown = config_manager.get("TOKEN.RATE_LIMIT_COOLDOWN", 600)
+        until = time.time() + cooldown
+        with self.lock:
+            record = self._find_record(token)
+            if record is None:
+                return
+            self._get_scheduler(model_id).cool(record.sso, until)
+        self._persist("save_state", record.sso, model_id, TOKEN_COOLING, until)
+        logger.warning("令牌进入冷却 %ss: %.20s... (%s)", cooldown, token, model_id, source="TokenManager")
+
+    def mark_invalid(self, token, model_id=None):
+        """标记令牌失效；未指定模型时对所有模型失效"""
+        with self.lock:
+            record = self._find_record(token)
+            if record is None:
+                return
+            if model_id is None:
+                self.invalid_tokens.add(record.sso)
+                for scheduler in self.schedulers.values():
+                    scheduler.invalidate(record.sso)
+            else:
+                self._get_scheduler(model_id).invalidate(record.sso)
+        self._persist("save_state", record.sso, model_id, TOKEN_INVALID, 0)
+        logger.warning("令牌已标记为失效: %.20s...", token, source="TokenManager")
+
+    def mark_available(self, token, model_id=None):
+        """手动恢复令牌为可用"""
+        with self.lock:
+            record = self._find_record(token)
+            if record is None:
+                return
+            if model_id is None:
+                self.invalid_tokens.discard(record.sso)
+                for scheduler in self.schedulers.values():
+                    scheduler.restore(record.sso)
+            else:
+                self._get_scheduler(model_id).restore(record.sso)
+        self._persist("clear_state", record.sso, model_id)
+
+    def record_health(self, token, health):
+        """保存一次健康检查的结果，令牌已被删除时忽略"""
+        with self.lock:
+            record = self._find_record(token)
+            if record is not None:
+                self.health[record.sso] = health
+
+    def get_token_state(self, token, model_id):
+        """返回 (状态, 冷却结束时间)"""
+        with self.lock:
+            record = self._find_record(token)
+            if record is None:
+                return TOKEN_INVALID, 0
+            return self._get_scheduler(model_id).get_state(record.sso, time.time())
+
+    def get_soonest_available_time(self, model_id):
+        """该模型最早有令牌结束冷却的时间"""
+        with self.lock:
+            return self._get_scheduler(model_id).soonest_available(time.time())
+
+    def get_available_delay(self, model_id):
+        """距该模型有可用令牌的秒数：0 表示当前可用，None 表示没有会结束冷却的令牌"""
+        self.sync_shared_state()
+        with self.lock:
+            now = time.time()
+            scheduler = self._get_scheduler(model_id)
+            max_load = config_manager.get("TOKEN.MAX_CONCURRENCY", 0)
+            if scheduler.has_available(now, self.in_flight, max_load):
+                return 0
+            soonest = scheduler.soonest_available(now)
+            if max_load and scheduler.has_available(now):
+                # 有可用令牌但都达到并发上限，等待进行中的请求结束
+                return CAPACITY_RETRY_INTERVAL if soonest is None else min(soonest - now, CAPACITY_RETRY_INTERVAL)
+            return None if soonest is None else max(soonest - now, 0)
 
+    def get_state_counts(self):
+        """各模型可用、冷却中与失效的令牌数，返回 {(模型, 状态): 个数}"""
+        self.sync_shared_state()
+        now = time.time()
+        counts = {}
+        with self.lock:
+            for model in config_manager.get_models():
+                scheduler = self._get_scheduler(model)
+                scheduler.promote(now)
+                tally = {TOKEN_AVAILABLE: 0, TOKEN_COOLING: 0, TOKEN_INVALID: 0}
+                for state in scheduler.states.values():
+                    tally[state[0]] += 1
+                for status, count in tally.items():
+                    counts[(model, status)] = count
+        return counts
+
+    def get_in_flight_total(self):
+        with self.lock:
+            return sum(self.in_flight.values())
 
     def get_all_tokens(self):
-        return self.tokens.copy()
-        
+        self.sync_shared_state()
+        with self.lock:
+            return [record.cookie for record in self.records.values()]
+
     def get_token_status_map(self):
+        self.sync_shared_state(force=True)
         status_map = {}
-        for i, token in enumerate(self.tokens):
-            if "sso=" in token:
-                sso = token.split("sso=")[1].split(";")[0]
-            else:
-                sso = f"token_{i}"
-                
-            status_map[sso] = {
-                "isValid": True,
-                "index": i
-            }
+        now = time.time()
+        models = list(config_manager.get_models().keys())
+        with self.lock:
+            schedulers = {model: self._get_scheduler(model) for model in models}
+            for i, sso in enumerate(self.records):
+                model_states = {}
+                for model, scheduler in schedulers.items():
+                    status, until = scheduler.get_state(sso, now)
+                    model_states[model] = {
+                        "status": status,
+                        "cooldownUntil": int(until * 1000) if status == TOKEN_COOLING else None
+                    }
+
+                status_map[sso] = {
+                    "isValid": any(state["status"] != TOKEN_INVALID for state in model_states.values()),
+                    "index": i,
+                    "inFlight": self.in_flight.get(sso, 0),
+                    "models": model_states,
+                    "health": self.health.get(sso)
+                }
         return status_map
-    
+
     def load_from_env(self):
         sso_array = os.environ.get("SSO", "").split(',')
-        if sso_array and sso_array[0]:
-            for value in sso_array:
-                if value.strip():
-                    token_str = f"sso-rw={value.strip()};sso={value.strip()}"
-                    self.add_token(token_str)
-        
-        logger.info(f"令牌加载完成，共加载: {len(self.get_all_tokens())}个令牌", "TokenManager")
-    
+        values = [value.strip() for value in sso_array if value.strip()]
+        if values:
+            self.add_tokens_batch(values)
+
+        logger.info("令牌加载完成，共加载: %d个令牌", len(self.records), source="TokenManager")
+
     def is_empty(self):
-        return len(self.tokens) == 0
\ No newline at end of file
+        return len(self.records) == 0
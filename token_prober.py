@@ -0,0 +1,219 @@
+import json
+import threading
+import time
+from collections import Counter
+
+from curl_cffi import requests as curl_requests
+
+from config import config_manager
+from logger import logger
+import metrics
+
+PROBE_OK = "ok"
+PROBE_EXHAUSTED = "exhausted"
+PROBE_INVALID = "invalid"
+PROBE_BLOCKED = "blocked"
+# 429、超时、连接失败等：多为检查请求本身被限流（按出口 IP），不能说明令牌的状态
+PROBE_INCONCLUSIVE = "inconclusive"
+
+probe_results = metrics.registry.counter(
+    "grok2api_token_probes_total", "令牌健康检查次数（按结果 ok/exhausted/invalid/blocked/inconclusive）", ("result",))
+probe_duration = metrics.registry.histogram("grok2api_token_probe_duration_seconds", "令牌健康检查请求耗时")
+
+
+class ProbeBusy(Exception):
+    """已有全量检查正在进行"""
+
+
+class TokenProber:
+    """后台令牌健康检查
+
+    每个令牌请求一次上游额度接口（/rest/rate-limits，不产生对话、不消耗额度），结果（检查时间、耗时、
+    剩余额度）写回令牌管理器：返回 401 的令牌标记为失效，剩余额度为 0 的令牌在检查所用模型上冷却到
+    额度恢复；403 按代理出口被封处理，429 与网络异常记为无法判断，均不改变令牌状态。
+    检查请求使用独立的会话，不经过令牌轮询、不计入进行中请求、不占用会话池，不影响线上请求。
+    全量检查由 TOKEN_PROBE.CONCURRENCY 个线程并发执行，同一时间只允许一次。
+    """
+
+    def __init__(self, token_manager, proxy_pool, headers):
+        self.token_manager = token_manager
+        self.proxy_pool = proxy_pool
+        self.headers = headers
+        self.lock = threading.Lock()
+        self.sweep = None
+        self.periodic = None
+
+    @staticmethod
+    def new_session():
+        return curl_requests.Session(impersonate="chrome133a")
+
+    def probe(self, token, session):
+        """请求一次额度接口，返回检查结果；只更新代理健康状态，不修改令牌状态"""
+        model = config_manager.get("TOKEN_PROBE.MODEL", "grok-3")
+        proxy = self.proxy_pool.select(token)
+        health = {
+            "result": PROBE_INCONCLUSIVE,
+            "checkedAt": int(time.time() * 1000),
+            "latencyMs": None,
+            "httpStatus": None,
+            "remainingQueries": None,
+            "totalQueries": None,
+            "waitSeconds": None,
+            "error": None
+        }
+        started = time.perf_counter()
+        try:
+            response = session.post(
+                f"{config_manager.get('API.BASE_URL')}/rest/rate-limits",
+                headers={**self.headers, "Cookie": token},
+                data=json.dumps({"requestKind": "DEFAULT", "modelName": config_manager.get_models().get(model, model)}),
+                timeout=config_manager.get("TOKEN_PROBE.TIMEOUT", 15),
+                **(proxy.options if proxy is not None else {})
+            )
+        except Exception as e:
+            health["error"] = str(e)[:200]
+            self.proxy_pool.mark_error(proxy)
+            return health
+        finally:
+            elapsed = time.perf_counter() - started
+            health["latencyMs"] = round(elapsed * 1000, 1)
+            probe_duration.observe(elapsed)
+            # 会话在多个令牌间复用，清除上游下发的 Set-Cookie，避免带入下一个令牌的请求
+            session.cookies.clear()
+
+        status = response.status_code
+        health["httpStatus"] = status
+        if status == 200:
+            self.proxy_pool.mark_success(proxy)
+            try:
+                data = response.json()
+                health["remainingQueries"] = data.get("remainingQueries")
+                health["totalQueries"] = data.get("totalQueries")
+                health["waitSeconds"] = data.get("waitTimeSeconds") or data.get("windowSizeSeconds")
+            except (ValueError, AttributeError):
+                health["error"] = "额度接口响应格式异常"
+                return health
+            health["result"] = PROBE_EXHAUSTED if health["remainingQueries"] == 0 else PROBE_OK
+        elif status == 401:
+            health["result"] = PROBE_INVALID
+            health["error"] = "cookie已失效"
+        elif status == 429:
+            health["error"] = "检查请求过于频繁"
+        elif status == 403:
+            health["result"] = PROBE_BLOCKED
+            health["error"] = "出口IP被上游封禁"
+            self.proxy_pool.mark_banned(proxy)
+        else:
+            health["error"] = f"上游返回状态码 {status}"
+        return health
+
+    def apply(self, token, health):
+        """把检查结果写回令牌状态"""
+        result = health["result"]
+        probe_results.inc(result)
+        self.token_manager.record_health(token, health)
+        model = config_manager.get("TOKEN_PROBE.MODEL", "grok-3")
+        if result == PROBE_INVALID:
+            self.token_manager.mark_invalid(token)
+        elif result == PROBE_EXHAUSTED:
+            self.token_manager.mark_rate_limited(token, model, health["waitSeconds"] or None)
+
+    def check(self, token, session=None):
+        """检查单个令牌并写回结果，返回检查结果"""
+        own_session = session is None
+        if own_session:
+            session = self.new_session()
+        try:
+            health = self.probe(token, session)
+        finally:
+            if own_session:
+                session.close()
+        self.apply(token, health)
+        return health
+
+    def start_sweep(self):
+        """在后台检查当前全部令牌，返回进度；已有检查进行中时抛出 ProbeBusy"""
+        with self.lock:
+            if self.sweep is not None and self.sweep["running"]:
+                raise ProbeBusy("已有令牌健康检查正在进行")
+            tokens = self.token_manager.get_all_tokens()
+            progress = self.sweep = {
+                "running": True,
+                "total": len(tokens),
+                "done": 0,
+                "results": Counter(),
+                "startedAt": time.time(),
+                "finishedAt": None
+            }
+        threading.Thread(target=self._run_sweep, args=(tokens, progress), name="token-prober", daemon=True).start()
+        return self.get_progress()
+
+    def _run_sweep(self, tokens, progress):
+        logger.info("开始令牌健康检查: %d 个", len(tokens), source="TokenProber")
+        pending = iter(tokens)
+        lock = threading.Lock()
+
+        def worker():
+            session = self.new_session()
+            try:
+                while True:
+                    with lock:
+                        token = next(pending, None)
+                    if token is None:
+                        return
+                    try:
+                        result = self.check(token, session)["result"]
+                    except Exception as e:
+                        logger.error("令牌健康检查异常: %s", e, source="TokenProber")
+                        result = PROBE_INCONCLUSIVE
+                    with lock:
+                        progress["done"] += 1
+                        progress["results"][result] += 1
+            finally:
+                session.close()
+
+        concurrency = max(1, min(config_manager.get("TOKEN_PROBE.CONCURRENCY", 32), len(tokens)))
+        workers = [threading.Thread(target=worker, name=f"token-prober-{i}", daemon=True) for i in range(concurrency)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        with self.lock:
+            progress["running"] = False
+            progress["finishedAt"] = time.time()
+        logger.info(
+            "令牌健康检查完成: %d 个，用时 %.1fs，结果: %s",
+            progress["done"], progress["finishedAt"] - progress["startedAt"], dict(progress["results"]),
+            source="TokenProber"
+        )
+
+    def get_progress(self):
+        """最近一次全量检查的进度，尚未检查过时返回 None"""
+        with self.lock:
+            progress = self.sweep
+            if progress is None:
+                return None
+            elapsed = (progress["finishedAt"] or time.time()) - progress["startedAt"]
+            return {
+                "running": progress["running"],
+                "total": progress["total"],
+                "done": progress["done"],
+                "results": dict(progress["results"]),
+                "startedAt": int(progress["startedAt"] * 1000),
+                "finishedAt": int(progress["finishedAt"] * 1000) if progress["finishedAt"] else None,
+                "elapsedSeconds": round(elapsed, 1),
+                "perSecond": round(progress["done"] / elapsed, 1) if elapsed > 0 else 0
+            }
+
+    def start_periodic(self, interval):
+        """每隔 interval 秒发起一次全量检查"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.start_sweep()
+                except ProbeBusy:
+                    pass
+
+        self.periodic = threading.Thread(target=run, name="token-prober-periodic", daemon=True)
+        self.periodic.start()
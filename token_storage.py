@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+import time
+from logger import logger
+
+
+class SQLiteTokenStorage:
+    """令牌持久化存储（SQLite，WAL模式）
+
+    tokens 表按 rowid 保存令牌顺序；token_state 表保存每个 (sso, model) 的冷却/失效状态，
+    model 为 "*" 表示对所有模型失效。批量写入在单个事务内完成。
+    record_events 开启时，每次变更同时写入 token_events 变更日志，供其他工作进程增量同步。
+    """
+
+    ALL_MODELS = "*"
+
+    def __init__(self, path, record_events=False):
+        self.path = path
+        self.record_events = record_events
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            "rowid INTEGER PRIMARY KEY AUTOINCREMENT, sso TEXT NOT NULL UNIQUE, cookie TEXT NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_state ("
+            "sso TEXT NOT NULL, model TEXT NOT NULL, status TEXT NOT NULL, until REAL NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (sso, model))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS token_events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, sso TEXT NOT NULL, "
+            "model TEXT, status TEXT, until REAL, cookie TEXT)"
+        )
+
+    def _write(self, statements):
+        """在一个事务内执行 [(sql, params 或 params 列表, many)]"""
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                for sql, params, many in statements:
+                    if many:
+                        self.conn.executemany(sql, params)
+                    else:
+                        self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+            except Exception as error:
+                self.conn.execute("ROLLBACK")
+                logger.error("令牌存储写入失败: %s", error, source="TokenStorage")
+                raise
+
+    def _event(self, rows):
+        return (
+            "INSERT INTO token_events (kind, sso, model, status, until, cookie) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+            True
+        )
+
+    def load(self):
+        """返回 (按顺序的 [(sso, cookie)], 未过期的 [(sso, model, status, until)], 最新变更日志id)"""
+        now = time.time()
+        with self.lock:
+            # 在同一读事务内取快照，保证令牌、状态与日志位置一致
+            self.conn.execute("BEGIN")
+            try:
+                last_event_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM token_events").fetchone()[0]
+                tokens = self.conn.execute("SELECT sso, cookie FROM tokens ORDER BY rowid").fetchall()
+                states = self.conn.execute(
+                    "SELECT s.sso, s.model, s.status, s.until FROM token_state s JOIN tokens t ON t.sso = s.sso "
+                    "WHERE s.status = 'invalid' OR s.until > ?",
+                    (now,)
+                ).fetchall()
+            finally:
+                self.conn.execute("COMMIT")
+        return tokens, states, last_event_id
+
+    def read_events(self, after_id, limit=10000):
+        """读取 after_id 之后的变更日志；日志已被压缩掉所需部分时返回 None"""
+        with self.lock:
+            first_id = self.conn.execute("SELECT MIN(id) FROM token_events").fetchone()[0]
+            if first_id is not None and first_id > after_id + 1:
+                return None
+            return self.conn.execute(
+                "SELECT id, kind, sso, model, status, until, cookie FROM token_events WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            ).fetchall()
+
+    def compact_events(self, keep=100000):
+        """只保留最近 keep 条变更日志"""
+        self._write([(
+            "DELETE FROM token_events WHERE id <= (SELECT MAX(id) FROM token_events) - ?",
+            (keep,),
+            False
+        )])
+
+    def add_tokens(self, records):
+        statements = [(
+            "INSERT OR IGNORE INTO tokens (sso, cookie) VALUES (?, ?)",
+            [(record.sso, record.cookie) for record in records],
+            True
+        )]
+        if self.record_events:
+            statements.append(self._event([("add", record.sso, None, None, None, record.cookie) for record in records]))
+        self._write(statements)
+
+    def delete_tokens(self, ssos):
+        params = [(sso,) for sso in ssos]
+        statements = [
+            ("DELETE FROM tokens WHERE sso = ?", params, True),
+            ("DELETE FROM token_state WHERE sso = ?", params, True),
+        ]
+        if self.record_events:
+            statements.append(self._event([("delete", sso, None, None, None, None) for sso in ssos]))
+        self._write(statements)
+
+    def save_state(self, sso, model, status, until=0):
+        model = model or self.ALL_MODELS
+        statements = [(
+            "INSERT OR REPLACE INTO token_state (sso, model, status, until) VALUES (?, ?, ?, ?)",
+            (sso, model, status, until),
+            False
+        )]
+        if self.record_events:
+            statements.append(self._event([("state", sso, model, status, until, None)]))
+        self._write(statements)
+
+    def clear_state(self, sso, model=None):
+        if model is None:
+            statements = [("DELETE FROM token_state WHERE sso = ?", (sso,), False)]
+        else:
+            statements = [("DELETE FROM token_state WHERE sso = ? AND model = ?", (sso, model), False)]
+        if self.record_events:
+            statements.append(self._event([("clear", sso, model, None, None, None)]))
+        self._write(statements)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,160 @@
+import json
+import time
+
+from config import config_manager
+import metrics
+
+# 阶段耗时分布（秒），解析与编码等阶段通常在毫秒以下
+PHASE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120)
+
+phase_duration = metrics.registry.histogram(
+    "grok2api_phase_duration_seconds", "补全请求各阶段耗时（单个请求内同一阶段的累计值）", ("phase",), PHASE_BUCKETS)
+
+
+class RequestTrace:
+    """单个补全请求的分阶段耗时
+
+    每个请求都记录粗粒度阶段（排队、构造请求体、选代理、建连/TLS、上游首字节、首帧、流输出），
+    请求结束时计入各阶段的耗时分布。detailed 为真（请求显式开启追踪）时还逐块记录 NDJSON 解析、
+    工具输出过滤与 SSE 编码，并在响应中返回 Server-Timing 头与调试字段。
+    """
+
+    __slots__ = ("spans", "detailed", "started", "finished")
+
+    def __init__(self, detailed=False):
+        self.spans = {}
+        self.detailed = detailed
+        self.started = time.perf_counter()
+        self.finished = False
+
+    def add(self, phase, seconds):
+        span = self.spans.get(phase)
+        if span is None:
+            self.spans[phase] = [seconds, 1]
+        else:
+            span[0] += seconds
+            span[1] += 1
+
+    def since(self, phase, started):
+        """记录从 started（perf_counter 读数）到现在的耗时，返回当前读数"""
+        now = time.perf_counter()
+        self.add(phase, now - started)
+        return now
+
+    def add_connection_timings(self, response):
+        """从 curl 读取本次请求的 DNS、TCP 建连与 TLS 握手耗时；复用连接时均为 0"""
+        timings = connection_timings(response)
+        if timings is None:
+            return
+        for phase, seconds in timings.items():
+            if seconds > 0:
+                self.add(phase, seconds)
+
+    def to_dict(self):
+        timing = {
+            phase: {"ms": round(total * 1000, 3), "count": count} if count > 1 else round(total * 1000, 3)
+            for phase, (total, count) in self.spans.items()
+        }
+        timing["total"] = round((time.perf_counter() - self.started) * 1000, 3)
+        return timing
+
+    def server_timing(self):
+        """Server-Timing 响应头，只包含响应头发出前已完成的阶段"""
+        parts = [f"{phase};dur={total * 1000:.3f}" for phase, (total, _) in self.spans.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.3f}")
+        return ", ".join(parts)
+
+    def debug_frame(self):
+        """流式响应结束前附加的调试帧（choices 为空，兼容 OpenAI 客户端）"""
+        return "data: " + json.dumps({
+            "object": "chat.completion.chunk",
+            "choices": [],
+            "debug": {"timing": self.to_dict()}
+        }) + "\n\n"
+
+    def finish(self):
+        """请求结束，把各阶段耗时计入全局分布；重复调用无效"""
+        if self.finished:
+            return
+        self.finished = True
+        for phase, (total, _) in self.spans.items():
+            phase_duration.observe(total, phase)
+
+
+class TimedStage:
+    """把对象指定方法的调用耗时计入 trace 的某个阶段，其余属性透传；只在详细追踪时包装"""
+
+    __slots__ = ("target", "trace", "phase", "methods")
+
+    def __init__(self, target, trace, phase, methods):
+        self.target = target
+        self.trace = trace
+        self.phase = phase
+        self.methods = methods
+
+    def __getattr__(self, name):
+        attr = getattr(self.target, name)
+        if name not in self.methods:
+            return attr
+        trace, phase = self.trace, self.phase
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                trace.add(phase, time.perf_counter() - started)
+        return timed
+
+
+def connection_timings(response):
+    """返回 {"dns": 秒, "connect": 秒, "tls": 秒}，无法读取时返回 None"""
+    timings = getattr(response, "timings", None)
+    if timings is not None:
+        return timings
+    curl = getattr(response, "curl", None)
+    if curl is None:
+        return None
+    try:
+        return curl_timings(curl)
+    except Exception:
+        return None
+
+
+def curl_timings(curl):
+    from curl_cffi.const import CurlInfo
+    namelookup = curl.getinfo(CurlInfo.NAMELOOKUP_TIME)
+    connect = curl.getinfo(CurlInfo.CONNECT_TIME)
+    appconnect = curl.getinfo(CurlInfo.APPCONNECT_TIME)
+    return {
+        "dns": namelookup,
+        "connect": max(connect - namelookup, 0),
+        "tls": max(appconnect - connect, 0) if appconnect else 0
+    }
+
+
+def is_trace_requested(data, headers=None):
+    """请求体 "trace": true 或请求头 X-Trace: on 时开启详细追踪；TRACE_ENABLED=true 时默认开启"""
+    option = data.get("trace") if isinstance(data, dict) else None
+    if option is None and headers is not None:
+        option = headers.get("X-Trace")
+    if option is None:
+        return config_manager.get("TRACE.ENABLED", False)
+    if isinstance(option, str):
+        return option.strip().lower() in ("1", "true", "on", "yes")
+    return bool(option)
+
+
+def get_phase_stats():
+    """各阶段的请求数、累计与平均耗时（毫秒）"""
+    stats = {}
+    for (family, labels), counts in metrics.registry.collect().items():
+        if family is not phase_duration:
+            continue
+        count = sum(counts[:-1])
+        stats[labels[0]] = {
+            "count": count,
+            "total_ms": round(counts[-1] * 1000, 3),
+            "avg_ms": round(counts[-1] * 1000 / count, 3) if count else 0
+        }
+    return stats
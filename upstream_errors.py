@@ -0,0 +1,16 @@
+class UpstreamError(Exception):
+    """上游请求失败；在向客户端发出首个数据块之前抛出时可换令牌透明重试"""
+
+    error_type = "upstream_error"
+
+    def __init__(self, message, status_code=None, error_type=None):
+        super().__init__(message)
+        self.status_code = status_code
+        if error_type:
+            self.error_type = error_type
+
+
+class UpstreamTimeoutError(UpstreamError):
+    """上游连接、首字节或空闲超时"""
+
+    error_type = "timeout_error"
@@ -0,0 +1,107 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 解析上游 JSON 行，安装 orjson 时使用更快的实现
+loads = orjson.loads if orjson is not None else json.loads
+
+EVENT_THINKING = 1
+EVENT_FINAL = 2
+EVENT_WEB_RESULTS = 3
+EVENT_MODEL_RESPONSE = 4
+EVENT_ERROR = 5
+
+
+class UpstreamEvent:
+    """上游 NDJSON 一行解码后的事件
+
+    kind 为 EVENT_* 之一；增量事件（思考/最终/搜索结果）带 text（token）、tag（messageTag）
+    和 thinking（isThinking）；搜索结果、最终响应与错误的原始数据放在 data 中。
+    """
+
+    __slots__ = ("kind", "text", "tag", "thinking", "data")
+
+    def __init__(self, kind, text="", tag=None, thinking=False, data=None):
+        self.kind = kind
+        self.text = text
+        self.tag = tag
+        self.thinking = thinking
+        self.data = data
+
+    def __repr__(self):
+        return f"UpstreamEvent(kind={self.kind}, text={self.text!r}, tag={self.tag!r}, thinking={self.thinking})"
+
+
+class UpstreamDecoder:
+    """增量 NDJSON 解码器：直接接收原始字节块，按行解析为 UpstreamEvent
+
+    跨块的半行以分片列表暂存，超长行（如最终的 modelResponse）被切成很多块时也只拼接一次。
+    """
+
+    __slots__ = ("pending",)
+
+    def __init__(self):
+        self.pending = []
+
+    def feed(self, data):
+        """送入一个字节块，返回其中完整行解码出的事件列表"""
+        events = []
+        if b"\n" not in data:
+            if data:
+                self.pending.append(data)
+            return events
+        if self.pending:
+            self.pending.append(data)
+            data = b"".join(self.pending)
+            self.pending = []
+        lines = data.split(b"\n")
+        tail = lines.pop()
+        if tail:
+            self.pending.append(tail)
+        for line in lines:
+            self.decode_line(line, events)
+        return events
+
+    def flush(self):
+        """流结束：解码最后一个不以换行结尾的行"""
+        events = []
+        if self.pending:
+            line = b"".join(self.pending)
+            self.pending = []
+            self.decode_line(line, events)
+        return events
+
+    @staticmethod
+    def decode_line(line, events):
+        try:
+            obj = loads(line)
+            response = obj["result"]["response"]
+        except ValueError:
+            # 空行或不完整的 JSON
+            return
+        except (KeyError, TypeError):
+            if isinstance(obj, dict) and obj.get("error"):
+                events.append(UpstreamEvent(EVENT_ERROR, data=obj))
+            return
+        if not response or type(response) is not dict:
+            return
+        if "error" in obj and obj["error"]:
+            events.append(UpstreamEvent(EVENT_ERROR, data=obj))
+            return
+
+        get = response.get
+        model_response = get("modelResponse")
+        text = get("token") or ""
+        if not model_response or text:
+            web_results = get("webSearchResults")
+            if web_results:
+                events.append(UpstreamEvent(EVENT_WEB_RESULTS, text, get("messageTag"), bool(get("isThinking")), web_results))
+            elif get("isThinking"):
+                events.append(UpstreamEvent(EVENT_THINKING, text, get("messageTag"), True))
+            else:
+                events.append(UpstreamEvent(EVENT_FINAL, text, get("messageTag"), False))
+        if model_response:
+            events.append(UpstreamEvent(EVENT_MODEL_RESPONSE, data=model_response))